@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+   Compare N directories of PDF files compressed by entropy.py, e.g. one directory per encoder
+   configuration. weigh.py does the same for exactly 2 directories.
+   Ratios are (directory PDF file size) / (reference directory PDF file size). The reference is
+   the first directory unless -r is given.
+
+   e.g. python compare.py pdf.output pdf.output.ccitt pdf.output.q50
+        python compare.py -c sizes.csv -j summary.json -s bgd.pdf pdf.output*
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import json
+import math
+
+
+suffixMasked = "masked.pdf"
+suffixPng = "unmasked.png.pdf"
+suffixJpg = "unmasked.jpg.pdf"
+suffixBgd = "bgd.pdf"
+suffixes = [suffixPng, suffixJpg, suffixBgd, suffixMasked]
+percentiles = (10, 25, 50, 75, 90)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dirs", nargs="+", help="directories of PDFs created by segment.go")
+    parser.add_argument("-s", "--suffix", default=suffixMasked, choices=suffixes,
+                        help="compare the PDFs with this suffix")
+    parser.add_argument("-r", "--reference", default=None,
+                        help="reference directory. Default is the first directory")
+    parser.add_argument("-c", "--csv", help="write the per-file sizes and ratios to this CSV file")
+    parser.add_argument("-j", "--json", help="write the per-file and corpus summary to this JSON file")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="number of directories to scan concurrently")
+    args = parser.parse_args()
+
+    dirs = [directorize(d) for d in args.dirs]
+    assert len(dirs) >= 2, "Need at least 2 directories to compare. Got %s" % dirs
+    assert len(set(dirs)) == len(dirs), "Duplicate directories in %s" % dirs
+    ref = dirs.index(directorize(args.reference)) if args.reference else 0
+
+    tables = gatherSizes(dirs, args.suffix, args.workers)
+    files = commonFiles(tables)
+    assert files, "No %s files common to all of %s" % (args.suffix, dirs)
+    summary = summarize(dirs, ref, tables, files)
+
+    report(dirs, ref, tables, files, summary)
+    if args.csv:
+        writeCsv(args.csv, dirs, ref, tables, files)
+        print("Wrote %s" % args.csv)
+    if args.json:
+        writeJson(args.json, dirs, ref, tables, files, summary)
+        print("Wrote %s" % args.json)
+
+
+def directorize(fn):
+    return os.path.dirname(os.path.join(fn, "xxx"))
+
+
+def gatherSizes(dirs, suffix, numWorkers):
+    """Scan `dirs` concurrently.
+        Returns: [{base name: size in MB of the `suffix` PDF}] in the order of `dirs`
+    """
+    def scan(root):
+        return {base: sizes[suffix] for base, sizes in scanSizes(root).items()}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(numWorkers, len(dirs)))) as executor:
+        return list(executor.map(scan, dirs))
+
+
+def scanSizes(root):
+    """Return the sizes of the segmented PDFs created by segment.go in directory `root`.
+        The directory is read with a single os.scandir pass and each file is stat'ed once.
+        compression.py, weigh.py and history.py use this too.
+        Returns: {base name: {suffix: size in MB, 'mtime': masked PDF mtime}} for the PDFs whose
+            masked, png, jpg and bgd variants all exist
+    """
+    found = {}
+    with os.scandir(root) as it:
+        for entry in it:
+            for suffix in suffixes:
+                if entry.name.endswith(".%s" % suffix) and entry.is_file():
+                    base = entry.name[:-len(suffix) - 1]
+                    st = entry.stat()
+                    row = found.setdefault(base, {})
+                    row[suffix] = st.st_size / 1e6
+                    if suffix == suffixMasked:
+                        row['mtime'] = st.st_mtime
+                    break
+    return {base: row for base, row in found.items() if all(suffix in row for suffix in suffixes)}
+
+
+def commonFiles(tables):
+    """Return the base names in all of `tables`, sorted by name."""
+    common = set(tables[0])
+    for table in tables[1:]:
+        common &= set(table)
+    return sorted(common)
+
+
+def geometricMean(values):
+    return math.exp(sum(math.log(v) for v in values) / len(values))
+
+
+def percentile(values, p):
+    """Return the `p`th percentile of sorted list `values`, or None if it is empty."""
+    if not values:
+        return None
+    i = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[i]
+
+
+def summarize(dirs, ref, tables, files):
+    """Return a dict of corpus statistics for `files` in each of `dirs` relative to `dirs[ref]`.
+        wins[i][j] is the number of files that are smaller in dirs[i] than in dirs[j].
+    """
+    refTable = tables[ref]
+    perDir = []
+    for table in tables:
+        ratios = sorted(table[fn] / refTable[fn] for fn in files)
+        total = sum(table[fn] for fn in files)
+        perDir.append({
+            'total': total,
+            'totalRatio': total / sum(refTable[fn] for fn in files),
+            'geomeanRatio': geometricMean(ratios),
+            'percentiles': {p: percentile(ratios, p) for p in percentiles},
+            'min': ratios[0],
+            'max': ratios[-1],
+            'smaller': sum(r < 1.0 for r in ratios),
+            'same': sum(r == 1.0 for r in ratios),
+            'larger': sum(r > 1.0 for r in ratios),
+        })
+
+    n = len(tables)
+    wins = [[0] * n for _ in range(n)]
+    for fn in files:
+        sizes = [table[fn] for table in tables]
+        for i in range(n):
+            for j in range(n):
+                if sizes[i] < sizes[j]:
+                    wins[i][j] += 1
+    # The directory with the smallest file for each file. Ties go to the earliest directory.
+    best = [0] * n
+    for fn in files:
+        sizes = [table[fn] for table in tables]
+        best[sizes.index(min(sizes))] += 1
+
+    return {'numFiles': len(files), 'dirs': perDir, 'wins': wins, 'best': best}
+
+
+def report(dirs, ref, tables, files, summary):
+    """Print the per-directory statistics and the win/loss matrix in `summary`."""
+    n = len(dirs)
+    numMissing = [len(table) - len(files) for table in tables]
+    print("%d files common to %d directories. Ratios are relative to %s (reference)" % (
+          summary['numFiles'], n, dirs[ref]))
+    print("%3s %8s %6s %6s %6s %6s %6s %6s %6s %5s %5s %5s %5s %5s  %s" % ("", "total", "ratio",
+          "geomn", "p10", "p25", "p50", "p75", "p90", "<", "=", ">", "best", "miss", "directory"))
+    for i, (d, st) in enumerate(zip(dirs, summary['dirs'])):
+        pcts = st['percentiles']
+        print("%3d %5.1f MB %6.3f %6.3f %6.3f %6.3f %6.3f %6.3f %6.3f %5d %5d %5d %5d %5d  %s%s" % (
+              i, st['total'], st['totalRatio'], st['geomeanRatio'],
+              pcts[10], pcts[25], pcts[50], pcts[75], pcts[90],
+              st['smaller'], st['same'], st['larger'], summary['best'][i], numMissing[i],
+              d, " *" if i == ref else ""))
+
+    print("Win/loss matrix: row i, column j = number of files smaller in i than in j")
+    print("%3s %s" % ("", " ".join("%6d" % j for j in range(n))))
+    for i, row in enumerate(summary['wins']):
+        print("%3d %s" % (i, " ".join("%6s" % ("-" if i == j else w) for j, w in enumerate(row))))
+
+
+def writeCsv(path, dirs, ref, tables, files):
+    """Write a row per file with its size in MB and its ratio to the reference in each of `dirs`."""
+    refTable = tables[ref]
+    with open(path, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(["file"] + ["size %s" % d for d in dirs] + ["ratio %s" % d for d in dirs])
+        for fn in files:
+            sizes = [table[fn] for table in tables]
+            w.writerow([fn] + ["%.6f" % s for s in sizes] +
+                       ["%.6f" % (s / refTable[fn]) for s in sizes])
+
+
+def writeJson(path, dirs, ref, tables, files, summary):
+    out = {
+        'dirs': dirs,
+        'reference': dirs[ref],
+        'summary': summary,
+        'files': {fn: [table[fn] for table in tables] for fn in files},
+    }
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
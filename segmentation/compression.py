@@ -2,66 +2,82 @@
 """
    Rank the scanned PDF files compressed by entropy.py
    Ranking is by (mixture PDF file size) / (pure PNG file size)
+
+   e.g. python compression.py pdf.output
+        python compression.py -q pdf.output     # Also report rendered quality (PSNR/SSIM)
+        python compression.py -p pdf.output     # Also break down the pages of expanded PDFs
+        python compression.py -H history.sqlite -l q50 pdf.output   # Record the run. See history.py
 """
 import os
-from glob import glob
 import argparse
-import time
-import sys
+from compare import scanSizes, suffixes, suffixMasked, suffixPng, suffixJpg, suffixBgd
+from quality import measureTable, otherPdf
+from introspect import introspectFiles, totals, categories
+from history import openDb, recordRun
 
 
 # All files are saved in outPdfRoot.
 outPdfRoot = "pdf.output"
-suffixMasked = "masked.pdf"
-suffixPng = "unmasked.png.pdf"
-suffixJpg = "unmasked.jpg.pdf"
-suffixBgd = "bgd.pdf"
 
 def main():
-    # parser = argparse.ArgumentParser()
-    # args = parser.parse_args()
-    # pdfFiles = args.files
-
-    assert len(sys.argv) > 1, "Usage: python compression.py <directory>"
-    outPdfRoot = sys.argv[1]
-
-    mask = os.path.join(outPdfRoot, "*.%s" % suffixMasked)
-    pdfFiles = glob(mask)
-    pdfFiles = [fn for fn in pdfFiles if segmentedPdf(fn) ]
-
-    # pdfFiles.sort(key=lambda fn: (-suffixMB(fn, None), fn))
-    # pdfFiles.sort(key=lambda fn: (-ratio(fn, suffixPng), -ratio(fn, suffixBgd), -suffixMB(fn, None), fn))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="directory of PDFs created by segment.go")
+    parser.add_argument("-q", "--quality", action="store_true",
+                        help="also rasterize each PDF variant and report its PSNR and SSIM "
+                             "relative to the source rasters")
+    parser.add_argument("-r", "--dpi", type=int, default=300,
+                        help="resolution to rasterize at for -q")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="number of PDFs to process concurrently for -q and -p")
+    parser.add_argument("-o", "--force", action="store_true",
+                        help="rasterize and measure again for -q even if cached results exist")
+    parser.add_argument("-p", "--pages", action="store_true",
+                        help="also report the per-page image, mask, content and font bytes of the "
+                             "masked PDFs that are bigger than their png PDFs")
+    parser.add_argument("-H", "--history",
+                        help="record the sizes (and -q quality) in this history.py database")
+    parser.add_argument("-l", "--label", help="name of the run recorded with -H")
+    args = parser.parse_args()
+    outPdfRoot = args.directory
+
+    # All sizes come from one scan of the directory. Nothing below touches the file system.
+    table = {os.path.join(outPdfRoot, "%s.%s" % (base, suffixMasked)): sizes
+             for base, sizes in scanSizes(outPdfRoot).items()}
+    pdfFiles = list(table)
+
+    # pdfFiles.sort(key=lambda fn: (-suffixMB(table[fn], None), fn))
+    # pdfFiles.sort(key=lambda fn: (-ratio(table[fn], suffixPng), -ratio(table[fn], suffixBgd), -suffixMB(table[fn], None), fn))
 
     # 2nd default
-    # pdfFiles.sort(key=lambda fn: (-ratio(fn, suffixPng),
-    #                               -suffixMB(fn, None),
-    #                               -ratio(fn, suffixBgd),
+    # pdfFiles.sort(key=lambda fn: (-ratio(table[fn], suffixPng),
+    #                               -suffixMB(table[fn], None),
+    #                               -ratio(table[fn], suffixBgd),
     #                               fn))
 
-    # pdfFiles.sort(key=lambda fn: (-ratio(fn, suffixPng),
-    #                               -ratio(fn, suffixJpg), -suffixMB(fn, None), fn))
+    # pdfFiles.sort(key=lambda fn: (-ratio(table[fn], suffixPng),
+    #                               -ratio(table[fn], suffixJpg), -suffixMB(table[fn], None), fn))
 
     # Default
-    pdfFiles.sort(key=lambda fn: (ratio(fn, suffixPng) <= 1.0,
-                                  ratio(fn, suffixPng) < 0.9,
-                                  ratio(fn, suffixPng) < 0.5,
-                                  -suffixMB(fn, None),
-                                  ratio(fn, suffixPng),
-                                  ratio(fn, suffixBgd),
+    pdfFiles.sort(key=lambda fn: (ratio(table[fn], suffixPng) <= 1.0,
+                                  ratio(table[fn], suffixPng) < 0.9,
+                                  ratio(table[fn], suffixPng) < 0.5,
+                                  -suffixMB(table[fn], None),
+                                  ratio(table[fn], suffixPng),
+                                  ratio(table[fn], suffixBgd),
                                   fn))
 
-    # pdfFiles.sort(key=lambda fn: (-ratio(fn, suffixJpg), -ratio(fn, suffixBgd), -suffixMB(fn, None), fn))
-    # pdfFiles.sort(key=lambda fn: (-ratio(fn, suffixJpg) * ratio(fn, suffixPng),
-    #                               -suffixMB(fn, None), fn))
-    # pdfFiles.sort(key=lambda fn: (ratio(fn, suffixBgd),
-    #                               -suffixMB(fn, None),
-    #                               -ratio(fn, suffixJpg),
-    #                               -ratio(fn, suffixPng),
+    # pdfFiles.sort(key=lambda fn: (-ratio(table[fn], suffixJpg), -ratio(table[fn], suffixBgd), -suffixMB(table[fn], None), fn))
+    # pdfFiles.sort(key=lambda fn: (-ratio(table[fn], suffixJpg) * ratio(table[fn], suffixPng),
+    #                               -suffixMB(table[fn], None), fn))
+    # pdfFiles.sort(key=lambda fn: (ratio(table[fn], suffixBgd),
+    #                               -suffixMB(table[fn], None),
+    #                               -ratio(table[fn], suffixJpg),
+    #                               -ratio(table[fn], suffixPng),
     #                               fn))
-    # pdfFiles.sort(key=lambda fn: (ratio(fn, suffixBgd),
-    #                               -ratio(fn, suffixPng),
-    #                               -ratio(fn, suffixJpg),
-    #                               -suffixMB(fn, None),
+    # pdfFiles.sort(key=lambda fn: (ratio(table[fn], suffixBgd),
+    #                               -ratio(table[fn], suffixPng),
+    #                               -ratio(table[fn], suffixJpg),
+    #                               -suffixMB(table[fn], None),
     #                               fn))
 
     nCompressed = 0
@@ -74,10 +90,10 @@ def main():
     lines = []
     totalSize = 0.0
     for i, fn in enumerate(pdfFiles):
-        size = suffixMB(fn, None)
-        sizePng = suffixMB(fn, suffixPng)
-        sizeJpg = suffixMB(fn, suffixJpg)
-        sizeBgd = suffixMB(fn, suffixBgd)
+        size = suffixMB(table[fn], None)
+        sizePng = suffixMB(table[fn], suffixPng)
+        sizeJpg = suffixMB(table[fn], suffixJpg)
+        sizeBgd = suffixMB(table[fn], suffixBgd)
         totalSize += size
         if size < sizePng:
             nCompressed += 1
@@ -90,7 +106,7 @@ def main():
             szSame += size
         # lines.append("%6d: %4.2f %5.2f (%4.2f) %5.2f MB [%s] %s" % (i,
         #     size/sizePng,  size/sizeJpg, sizeBgd/sizePng, size,
-        #     time.ctime(os.path.getmtime(fn)), os.path.basename(fn)))
+        #     time.ctime(table[fn]['mtime']), os.path.basename(fn)))
         lines.append("%6d: %4.2f %5.2f (%4.2f) %5.2f MB %s" % (i,
             size/sizePng,  size/sizeJpg, sizeBgd/sizePng, size,
             os.path.basename(fn)))
@@ -106,35 +122,87 @@ def main():
     for l in lines:
         print(l)
 
+    if args.pages:
+        expanded = [fn for fn in pdfFiles if table[fn][suffixMasked] > table[fn][suffixPng]]
+        reportPages(expanded, args.workers)
+
+    quality = None
+    if args.quality:
+        quality = measureTable(table, dpi=args.dpi, numWorkers=args.workers, force=args.force)
+        reportQuality(pdfFiles, quality)
+
+    if args.history:
+        def baseName(fn):
+            return os.path.basename(fn)[:-len(suffixMasked) - 1]
+
+        sizes = {baseName(fn): {suffix: table[fn][suffix] for suffix in suffixes} for fn in pdfFiles}
+        if quality:
+            quality = {baseName(fn): q for fn, q in quality.items()}
+        params = {'quality': args.quality, 'dpi': args.dpi} if args.quality else {}
+        runId = recordRun(openDb(args.history), os.path.abspath(outPdfRoot), args.label, params,
+                          sizes, quality=quality)
+        print("Recorded run %d in %s" % (runId, args.history))
+
+
+def reportPages(pdfFiles, numWorkers):
+    """Print the bytes per page by category of the masked and png PDFs of each of `pdfFiles`,
+        marking the pages where the masked PDF is bigger.
+    """
+    if not pdfFiles:
+        return
+    paths = pdfFiles + [otherPdf(fn, suffixPng) for fn in pdfFiles]
+    infos = introspectFiles(paths, numWorkers)
+    cats = "  ".join("%7s" % cat for cat in categories)
+    print("=" * 80)
+    print("Expanded PDFs: masked PDF bytes per page (png PDF bytes per page)")
+    for i, fn in enumerate(pdfFiles):
+        masked = infos[fn]
+        png = infos[otherPdf(fn, suffixPng)]
+        tot = totals(masked)
+        print("%6d: %s" % (i, os.path.basename(fn)))
+        print("%8s %s  %9s  %9s" % ("page", cats, "masked", "png"))
+        for j, pg in enumerate(masked['pages']):
+            size = sum(pg.values())
+            sizePng = sum(png['pages'][j].values()) if j < len(png['pages']) else 0
+            print("%8d %s  %9d  %9d%s" % (j + 1, "  ".join("%7d" % pg[cat] for cat in categories),
+                  size, sizePng, " *" if size > sizePng else ""))
+        print("%8s %s  %9d  %9d   overhead %d %d" % ("total",
+              "  ".join("%7d" % tot[cat] for cat in categories), masked['size'], png['size'],
+              masked['overhead'], png['overhead']))
+
+
+def reportQuality(pdfFiles, quality):
+    """Print the size vs quality of each variant of `pdfFiles` followed by the corpus totals.
+        `quality` is the dict returned by quality.measureTable().
+    """
+    variants = [(suffixMasked, "masked"), (suffixPng, "png"), (suffixJpg, "jpg"), (suffixBgd, "bgd")]
+    print("=" * 80)
+    print("Size (MB) / PSNR (dB) / SSIM of each variant")
+    print("%6s  %s  %s" % ("", "  ".join("%-21s" % name for _, name in variants), "name"))
+    for i, fn in enumerate(pdfFiles):
+        print("%6d: %s  %s" % (i, "  ".join("%5.2f %5.1f %6.4f   " % (quality[fn][suffix]['size']/1e6,
+              quality[fn][suffix]['psnr'], quality[fn][suffix]['ssim']) for suffix, _ in variants),
+              os.path.basename(fn)))
 
-def ratio(filename, suffix):
-    other = otherPdf(filename, suffix)
-    size = fileSizeMB(filename)
-    otherSize = fileSizeMB(other)
-    return size / otherSize
-
-
-def segmentedPdf(filename):
-    """Return True is `filename` is a segmented PDF created by segment.go."""
-    pngPdf = otherPdf(filename, suffixPng)
-    jpgPdf = otherPdf(filename, suffixJpg)
-    bgdPdf = otherPdf(filename, suffixBgd)
-    return os.path.exists(pngPdf) and os.path.exists(jpgPdf) and os.path.exists(bgdPdf)
-
+    n = len(pdfFiles)
+    for suffix, name in variants:
+        qs = [quality[fn][suffix] for fn in pdfFiles]
+        print("%14s = %7.2f MB PSNR %5.1f dB (min %5.1f) SSIM %6.4f (min %6.4f)" % (name,
+              sum(q['size'] for q in qs)/1e6, sum(q['psnr'] for q in qs) / n,
+              min(q['psnr'] for q in qs), sum(q['ssim'] for q in qs) / n,
+              min(q['ssim'] for q in qs)))
 
-def otherPdf(filename, suffix):
-    if not suffix:
-        return filename
-    base = filename[:-len(suffixMasked)]
-    return base + suffix
 
+def ratio(sizes, suffix):
+    """Return the ratio of the masked PDF size to the `suffix` PDF size in `sizes`, a row of the
+        table returned by compare.scanSizes().
+    """
+    return sizes[suffixMasked] / sizes[suffix]
 
-def suffixMB(filename, suffix):
-    return fileSizeMB(otherPdf(filename, suffix))
 
+def suffixMB(sizes, suffix):
+    return sizes[suffix or suffixMasked]
 
-def fileSizeMB(filename):
-    return os.path.getsize(filename) / 1e6
 
 
 main()
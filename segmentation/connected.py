@@ -32,11 +32,20 @@ import struct
 import glob
 import os
 import cv2
+import numpy as np
 import zlib
+import hashlib
 import subprocess
 import argparse
+import json
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from collections import namedtuple, Counter
 from pprint import PrettyPrinter
 from time import time
+from linearize import linearize, REF
 
 pprinter = PrettyPrinter(stream=sys.stderr)
 
@@ -56,16 +65,75 @@ def main():
                         help="remove foreground")
     parser.add_argument("files", nargs="+",
                         help="input files; glob and @ expansion performed")
-    parser.add_argument("-o", "--force",
-                        help="force processing of PDF file")
+    parser.add_argument("-o", "--force", action="store_true",
+                        help="force processing of PDF file, rerunning every stage even if "
+                             "its inputs have not changed")
+    parser.add_argument("-w", "--workers", default=os.cpu_count(), type=int,
+                        help="number of CPUs shared by the jbig2 and background encoding "
+                             "processes of all jobs")
+    parser.add_argument("-j", "--jobs", default=1, type=int,
+                        help="number of input directories processed at the same time")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="keep the background JPEG files in the jbig2 data directory")
+    parser.add_argument("-k", "--shard", default=0, type=int,
+                        help="run jbig2 concurrently on groups of this many pages, each with "
+                             "its own symbol dictionary. 0 for a single dictionary")
+    parser.add_argument("-c", "--compare", action="store_true",
+                        help="also run jbig2 with a single dictionary and report the "
+                             "size/time tradeoff of sharding")
+    parser.add_argument("--codecs", default=','.join(allCodecs),
+                        help="comma separated background codecs to try. Any of %s" %
+                             ','.join(allCodecs))
+    parser.add_argument("--budget", default=defaultBgdParams.codecBudget, type=float,
+                        help="seconds per page to spend trying background codecs")
+    parser.add_argument("-x", "--objstm", action="store_true",
+                        help="write a PDF 1.5 file with object streams and a cross-reference "
+                             "stream")
+    parser.add_argument("-l", "--linearize", action="store_true",
+                        help="write a linearized (fast web view) PDF file")
+    parser.add_argument("-s", "--deskew", action="store_true",
+                        help="straighten skewed rasters before JBIG2 encoding. With -c the "
+                             "JBIG2 sizes are also compared to those of the skewed rasters")
+    parser.add_argument("-a", "--append", action="store_true",
+                        help="append new rasters to an existing PDF as an incremental update "
+                             "instead of rewriting it")
+    parser.add_argument("-r", "--dpi", default="0",
+                        help="background resolution in DPI. 0 for the raster resolution. "
+                             "'auto' to choose from %s per page" % autoDpiChoices)
 
     args = parser.parse_args()
     files = args.files
     doBgd = not args.background
     doFgd = not args.foreground
-
-    for inDir in files:
-        processDirectory(inDir, doBgd, doFgd)
+    codecs = args.codecs.split(',')
+    for codec in codecs:
+        assert codec in allCodecs, (codec, allCodecs)
+    autoDpi = args.dpi == 'auto'
+    dpi = 0 if autoDpi else int(args.dpi)
+    bgdParams = defaultBgdParams._replace(keepJpeg=args.debug, codecs=codecs,
+                                          codecBudget=args.budget, dpi=dpi, autoDpi=autoDpi,
+                                          force=args.force)
+
+    if args.jobs <= 1:
+        for inDir in files:
+            processDirectory(inDir, doBgd, doFgd, args.workers, bgdParams, args.shard,
+                             args.compare, args.objstm, args.linearize, deskew=args.deskew,
+                             append=args.append)
+    else:
+        # Concurrent jobs share one CPU budget and one background process pool so that
+        # `args.workers` bounds the total number of busy processes.
+        bases = [dirBase(inDir) for inDir in files]
+        assert len(set(bases)) == len(bases), "input directories must have distinct names"
+        budget = CpuBudget(args.workers)
+        with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor, \
+             ThreadPoolExecutor(max_workers=args.jobs) as jobs:
+            futures = [jobs.submit(processDirectory, inDir, doBgd, doFgd, args.workers,
+                                   bgdParams, args.shard, args.compare, args.objstm,
+                                   args.linearize, budget, executor, deskew=args.deskew,
+                                   append=args.append)
+                       for inDir in files]
+            for future in futures:
+                future.result()
         # processDirectory(inDir, True, True)
         # processDirectory(inDir, True, False)
         # processDirectory(inDir, False, True)
@@ -74,22 +142,55 @@ def main():
 dataDir = 'jbig2.data'
 here = os.getcwd()
 prog = os.path.join(here, 'jbig2')
+jbig2Flags = ['-s', '-S', '-p', '-a']
+# Each stage records the key of the inputs and parameters it was run with in a stamp file.
+jbig2Stamp = 'jbig2.stamp.json'
 assert os.path.exists(prog), prog
 
 
-def processDirectory(inDir, doBgd, doFgd):
+def processDirectory(inDir, doBgd, doFgd, numWorkers=1, bgdParams=None, shardSize=0,
+                     compare=False, objectStreams=False, linearized=False, budget=None,
+                     executor=None, deskew=False, append=False):
     """Create a layered PDF file from the rasters in `inDir`
         Temp files are stored in `jbigDir`
+        Backgrounds are encoded in `numWorkers` processes with BgdParams `bgdParams`.
+        If `shardSize` > 0 the pages are JBIG2 encoded in groups of `shardSize` pages by up to
+        `numWorkers` concurrent jbig2 processes, each group with its own symbol dictionary. If
+        `compare` is True a single dictionary encoding is also made and its size and time are
+        reported alongside the sharded ones. jbig2 is rerun for comparisons so that the times
+        are those of encoding.
+        If `objectStreams` is True the PDF is written with object streams.
+        If `linearized` is True the PDF is linearized. This is done by a second pass over the
+        finished file.
+        If `deskew` is True skewed rasters are rotated straight before JBIG2 encoding. If
+        `compare` is also True the skewed rasters are encoded too and the per-page changes in
+        symbol instances and bytes are recorded.
+        `budget` is the CpuBudget limiting the number of busy jbig2 and background processes. It
+        and the background process pool `executor` are shared when several directories are
+        processed at once. Neither the working directory nor any module state is changed, so
+        this is safe to call from several threads.
+        The document's metrics are written to a .metrics.json file next to the PDF. metrics.py
+        aggregates them over a corpus.
+        Each stage (jbig2, encoded background and the PDF) records a key of its inputs and
+        parameters and is skipped if they haven't changed, unless `bgdParams.force` is True.
+        The metrics file is the PDF's stamp.
+        If `append` is True and the PDF was made from the first rasters in `inDir`, the rest are
+        appended to it as an incremental update. Their jbig2 work is done in a subdirectory of
+        `jbigDir` so the cost only depends on the number of new pages. Otherwise the PDF is
+        written from scratch.
+        Returns: metrics dict
     """
     if inDir.endswith("/"):
         print("%s->%s" % (inDir, inDir[:-1]))
         inDir = inDir[:-1]
 
-    base = os.path.basename(inDir)
-    base, _ = os.path.splitext(base)
-    assert base, inDir
+    base = dirBase(inDir)
+    if bgdParams is None:
+        bgdParams = defaultBgdParams
+    force = bgdParams.force
+    if budget is None:
+        budget = CpuBudget(numWorkers)
     jbigDir = os.path.join(dataDir, base)
-    symbolPath = os.path.join(jbigDir, 'output.sym')
     if doBgd and doFgd:
         pdfPath = base + '.connected.pdf'
     elif doBgd:
@@ -98,84 +199,602 @@ def processDirectory(inDir, doBgd, doFgd):
         pdfPath = base + '.connected.fgd.pdf'
     else:
         assert False, "nothing to do"
+    assert not (objectStreams and linearized), "linearized files can't have object streams"
 
+    metricsPath = pdfPath[:-len('.pdf')] + '.metrics.json'
     print("pdfPath=%s" % pdfPath)
 
-    def jbigPath(i):
-        return os.path.join(jbigDir, 'output.%04d' % i)
-
     mask = os.path.join(os.path.abspath(inDir), '*.png')
     rasterList = sorted(glob.glob(mask))
     assert rasterList, mask
-    rasterPage = {fn: jbigPath(i) for i, fn in enumerate(rasterList)}
 
     print("** processDirectory: inDir=%s doBgd=%s doFgd=%s pdfPath=%s" % (
           inDir, doBgd, doFgd, pdfPath), file=sys.stderr)
     print("** processDirectory: base=%s" % base, file=sys.stderr)
     print("** processDirectory: jbigDir= %s" % jbigDir, file=sys.stderr)
 
-    os.makedirs(jbigDir, exist_ok=True)
-    t0 = time()
-    try:
-        os.chdir(jbigDir)
-        print("** cwd=%s" % os.getcwd())
+    old = None
+    prev = None
+    if append:
+        assert not compare, "can't compare when appending"
+        assert not linearized, "an incremental update would undo the linearization"
+        old = readStamp(metricsPath)
+        if old is None or not old.get('revision') or not os.path.exists(pdfPath) or \
+           os.path.getsize(pdfPath) != old['revision']['fileSize']:
+            print("Can't append to %s. Writing it from scratch" % pdfPath)
+            old = None
+    if old is not None:
+        oldNames = old['rasters']
+        names = [os.path.basename(fn) for fn in rasterList]
+        assert names[:len(oldNames)] == oldNames, "%s pages aren't the first rasters of %s" % (
+            pdfPath, inDir)
+        if len(names) == len(oldNames):
+            print("%s has no new pages" % pdfPath)
+            return old
+        prev = Revision(**old['revision'])
+        rasterList = rasterList[len(oldNames):]
+        jbigDir = os.path.join(jbigDir, 'append.%04d' % len(oldNames))
+        print("Appending %d pages to %s" % (len(rasterList), pdfPath))
 
-        #  jbig2 -s -S -p pdf.output.reference/AIPopularPress1985/*.png
-        cmd = [prog, '-s', '-S', '-p', '-a'] + rasterList
-        p = subprocess.Popen(cmd, shell=False)
-        retval = p.wait()
-        assert retval == 0, (retval, ' '.join(cmd))
-    finally:
-        os.chdir(here)
-
-    dtJbig = time() - t0
+    os.makedirs(jbigDir, exist_ok=True)
+    inputRasters = rasterList
+    skews = None
+    dtDeskew = 0.0
+    if deskew:
+        t0 = time()
+        # jbig2 runs in its work directory so the deskewed rasters need absolute paths.
+        deskewDir = os.path.abspath(os.path.join(jbigDir, 'deskew'))
+        skews = deskewRasters(rasterList, deskewDir, numWorkers, budget, executor, force)
+        rasterList = [sk['path'] for sk in skews]
+        dtDeskew = time() - t0
+
+    # The comparisons report encoding times so they rerun jbig2 rather than time the cache.
+    jbigForce = force or compare
+    comparison = []
+    if shardSize <= 0 or compare:
+        t0 = time()
+        shards = [runJbig2(jbigDir, rasterList, budget, jbigForce)]
+        dtJbig = time() - t0
+        comparison.append(('single', shards, dtJbig))
+    if shardSize > 0:
+        t0 = time()
+        shards = runJbig2Shards(jbigDir, rasterList, shardSize, numWorkers, budget, jbigForce)
+        dtJbig = time() - t0
+        comparison.append(('sharded', shards, dtJbig))
+    if deskew and compare:
+        t0 = time()
+        skewed = [runJbig2(os.path.join(jbigDir, 'skewed'), inputRasters, budget, jbigForce)]
+        comparison.append(('skewed', skewed, time() - t0))
 
-    pagefiles = sorted(rasterPage.values())
     print("** processDirectory: jbigDir=%s" % jbigDir, file=sys.stderr)
 
+    # The PDF depends on the jbig2 outputs, which include the background rasters, so their keys
+    # stand in for all its inputs. Its parameters include the module level encoder settings as
+    # the backgrounds are encoded with them.
+    jbig2Keys = [readStamp(os.path.join(os.path.dirname(symbolPath), jbig2Stamp))['key']
+                 for symbolPath, _ in shards]
+    if old is not None:
+        jbig2Keys = old['jbig2Keys'] + jbig2Keys
+    params = bgdParams._replace(keepJpeg=False, force=False)._asdict()
+    params.update({'doBgd': doBgd, 'doFgd': doFgd, 'objstm': objectStreams,
+                   'linearize': linearized, 'deskew': deskew, 'compare': compare,
+                   'jpegQuality': jpegQuality, 'jpxCompression': jpxCompression,
+                   'grayTolerance': grayTolerance, 'autoDpiChoices': autoDpiChoices,
+                   'autoDpiTolerance': autoDpiTolerance})
+    pdfKey = stageKey(jbig2Keys, params)
+    if not force and not compare and old is None:
+        metrics = loadStamp(metricsPath, pdfKey, [pdfPath])
+        if metrics is not None:
+            print("%s is up to date" % pdfPath)
+            return metrics
+
     t0 = time()
-    doc = buildPDF(symbolPath, pagefiles, doBgd, doFgd)
+    outPath = pdfPath + '.tmp' if linearized else pdfPath
+    print("Writing %s" % outPath)
+    with open(outPath, 'ab' if prev is not None else 'wb') as f:
+        doc, pageStats = buildPDF(f, shards, doBgd, doFgd, numWorkers, bgdParams,
+                                  objectStreams, budget, executor, prev)
     dtPdf = time() - t0
-    for i, scale in enumerate(allScales):
+    dtLinearize = 0.0
+    if linearized:
+        t0 = time()
+        linearize(doc, outPath, pdfPath)
+        os.remove(outPath)
+        dtLinearize = time() - t0
+    if skews is not None:
+        for st, sk in zip(pageStats, skews):
+            st['skew'] = sk['angle']
+
+    symbolSize, pageSize = jbig2Sizes(shards)
+    metrics = {
+        'name': base,
+        'inDir': inDir,
+        'pdfPath': pdfPath,
+        'options': {'doBgd': doBgd, 'doFgd': doFgd, 'workers': numWorkers,
+                    'shard': shardSize, 'objstm': objectStreams, 'linearize': linearized,
+                    'bgdParams': bgdParams._asdict()},
+        'numPages': len(pageStats),
+        'numShards': len(shards),
+        'numSymbols': sum(jbig2SymbolCount(readFile(symbolPath)) or 0
+                          for symbolPath, _ in shards),
+        'sizes': {'rasters': sum(os.path.getsize(fn) for fn in inputRasters),
+                  'jbig2Symbols': symbolSize,
+                  'jbig2Pages': pageSize,
+                  'text': doc.textSize,
+                  'streams': doc.streamSize,
+                  'deduped': doc.dedupedSize,
+                  'pdf': os.path.getsize(pdfPath)},
+        'numDeduped': doc.numDeduped,
+        'times': {'deskew': dtDeskew, 'jbig2': dtJbig, 'pdf': dtPdf, 'linearize': dtLinearize,
+                  'total': dtDeskew + dtJbig + dtPdf + dtLinearize},
+        'pages': pageStats,
+        'rasters': [os.path.basename(fn) for fn in inputRasters],
+        'jbig2Keys': jbig2Keys,
+        # Linearizing renumbers the objects so the file can't be appended to.
+        'revision': doc.revision()._asdict() if not linearized else None,
+        'numRevisions': 1,
+    }
+    if old is not None:
+        metrics['options']['objstm'] = prev.objstm
+        for k in ('numPages', 'numShards', 'numSymbols', 'numDeduped'):
+            metrics[k] += old[k]
+        for k in metrics['sizes']:
+            if k != 'pdf':
+                metrics['sizes'][k] += old['sizes'][k]
+        metrics['pages'] = old['pages'] + pageStats
+        metrics['rasters'] = old['rasters'] + metrics['rasters']
+        metrics['numRevisions'] = old.get('numRevisions', 1) + 1
+    if len(comparison) > 1:
+        metrics['shardComparison'] = []
+        for name, runShards, dt in comparison:
+            symbolSize, pageSize = jbig2Sizes(runShards)
+            metrics['shardComparison'].append({'name': name, 'numShards': len(runShards),
+                                               'time': dt, 'jbig2Symbols': symbolSize,
+                                               'jbig2Pages': pageSize})
+    if deskew and compare:
+        metrics['deskewComparison'] = compareDeskew(comparison[0][1], skewed)
+    writeStamp(metricsPath, pdfKey, metrics)
+    print("Wrote %s" % metricsPath)
+
+    reportMetrics(metrics)
+    if len(comparison) > 1:
+        reportShards(comparison)
+    return metrics
+
+
+def reportMetrics(metrics):
+    """Print a summary of the metrics dict returned by processDirectory."""
+    pageStats = metrics['pages']
+    sizes = metrics['sizes']
+    times = metrics['times']
+    scales = [st['scale'] for st in pageStats if st['scale'] is not None]
+    bgdSizes = [st['bgdSize'] for st in pageStats if st['bgdSize'] is not None]
+    fgdSizes = [st['fgdSize'] for st in pageStats if st['fgdSize'] is not None]
+    codecCounts = Counter(st['codec'] for st in pageStats if st['codec'] is not None)
+    dpiCounts = Counter(st['dpi'] for st in pageStats if st['dpi'] is not None)
+    kindCounts = Counter(st['bgdKind'] for st in pageStats if st['bgdKind'] is not None)
+    for i, scale in enumerate(scales):
         print("%3d: %5.3f" % (i, scale))
+    for codec, n in sorted(codecCounts.items()):
+        print("%12s: %4d pages" % (codec, n))
+    for dpi, n in sorted(dpiCounts.items()):
+        print("%8d dpi: %4d pages" % (dpi, n))
+    for kind in bgdKinds:
+        print("%8s bgd: %4d pages" % (kind, kindCounts[kind]))
+    n = sum(1 for st in pageStats if 'encode' in (st.get('bgdFresh') or []))
+    print("%6s fresh: %4d pages" % ('encode', n))
 
-    writeFile(pdfPath, bytes(doc))
     print("bgdSzes=%d %.1f MB" % (len(bgdSizes), sum(bgdSizes)/MBYTE))
     print("fgdSzes=%d %.1f MB" % (len(fgdSizes), sum(fgdSizes)/MBYTE))
-    print("  textSize=%.1f MB" % (textSize/MBYTE))
-    print("streamSize=%.1f MB" % (streamSize/MBYTE))
-    print("     total=%.1f MB" % ((textSize+streamSize)/MBYTE))
-    print("dtJbig=%6.1f sec" % dtJbig)
-    print(" dtPdf=%6.1f sec" % dtPdf)
-    print(" total=%6.1f sec" % (dtJbig+dtPdf))
+    print("  textSize=%.1f MB" % (sizes['text']/MBYTE))
+    print("streamSize=%.1f MB" % (sizes['streams']/MBYTE))
+    print("     total=%.1f MB" % ((sizes['text']+sizes['streams'])/MBYTE))
+    print("   deduped=%d objects %.1f MB" % (metrics['numDeduped'], sizes['deduped']/MBYTE))
+    skews = [st['skew'] for st in pageStats if st.get('skew') is not None]
+    if skews:
+        print("  deskewed=%d of %d pages, max %.2f deg" % (sum(1 for a in skews if a),
+              len(skews), max(abs(a) for a in skews)))
+    if metrics.get('deskewComparison'):
+        dc = metrics['deskewComparison']
+        print("   symbols=%d -> %d deskewed" % (dc['symbols'][0], dc['symbols'][1]))
+        print(" instances=%d -> %d deskewed" % (dc['instances'][0], dc['instances'][1]))
+        print("jbig2Size=%.2f MB -> %.2f MB deskewed" % (dc['bytes'][0]/MBYTE,
+              dc['bytes'][1]/MBYTE))
+    if times.get('deskew'):
+        print("dtSkew=%6.1f sec" % times['deskew'])
+    print("dtJbig=%6.1f sec" % times['jbig2'])
+    print(" dtPdf=%6.1f sec" % times['pdf'])
+    if times['linearize']:
+        print(" dtLin=%6.1f sec" % times['linearize'])
+    print(" total=%6.1f sec" % times['total'])
+
+
+def dirBase(inDir):
+    """Return the name of the outputs of input directory `inDir`."""
+    base = os.path.basename(inDir.rstrip("/"))
+    base, _ = os.path.splitext(base)
+    assert base, inDir
+    return base
 
 
-def buildPDF(symbolPath, pagefiles, doBgd, doFgd):
-    """Build a PDF from JBIG2 symbol table file `symbolPath` and page files `pagefiles`.
+class CpuBudget:
+    """CpuBudget limits the number of CPU bound processes running at once.
+        jbig2 runs hold a slot for as long as the subprocess runs. Background encoding tasks
+        hold a slot from when they are submitted to a process pool until they finish.
+    """
+    def __init__(self, numWorkers):
+        self.numWorkers = max(1, numWorkers)
+        self.slots = threading.Semaphore(self.numWorkers)
+
+    def __enter__(self):
+        self.slots.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.slots.release()
+
+    def map(self, executor, fn, items):
+        """Like executor.map(fn, items) but each call holds a slot of the budget while it is
+            queued or running. At most 2 * numWorkers results are held ahead of the caller.
+        """
+        items = iter(items)
+        futures = deque()
+        done = False
+        while True:
+            # Submit while slots are free, or block for one if nothing is in flight.
+            while not done and len(futures) < 2 * self.numWorkers:
+                if not self.slots.acquire(blocking=not futures):
+                    break
+                try:
+                    item = next(items)
+                except StopIteration:
+                    self.slots.release()
+                    done = True
+                    break
+                future = executor.submit(fn, item)
+                future.add_done_callback(lambda _: self.slots.release())
+                futures.append(future)
+            if not futures:
+                return
+            yield futures.popleft().result()
+
+
+def runJbig2(workDir, rasterList, budget=None, force=False):
+    """Run jbig2 on the rasters in `rasterList` with its output written to directory `workDir`.
+        The subprocess holds a slot of CpuBudget `budget` while it runs.
+        jbig2 is not run if the stamp in `workDir` shows it has already been run with the same
+        rasters and options, unless `force` is True.
+        Returns: symbolPath, pagefiles
+            symbolPath: the JBIG2 symbol dictionary file
+            pagefiles: the JBIG2 page files, in the same order as `rasterList`
     """
-    global bgdSizes, fgdSizes
-    print("** symbolPath=%s" % symbolPath, file=sys.stderr)
-    print("** pagefiles= %d: %s" % (len(pagefiles), pagefiles), file=sys.stderr)
-
-    doc = Doc()
-    pages = Obj({'Type': '/Pages'})
-    doc.add_object(pages)
-    catalog = Obj({'Type': '/Catalog',
-                   'Pages': ref(pages.id),
-                   'Version': b'/1.3',
-                   })
-    doc.add_catalog(catalog)
-    info = Obj({'Producer': '(connected.py)',
-                'Creator': '(yo mamma)',
-                })
-    doc.add_info(info)
-    symd = doc.add_object(Obj({}, readFile(symbolPath)))
+    os.makedirs(workDir, exist_ok=True)
+    symbolPath = os.path.join(workDir, 'output.sym')
+    pagefiles = [os.path.join(workDir, 'output.%04d' % i) for i in range(len(rasterList))]
+    stampPath = os.path.join(workDir, jbig2Stamp)
+    st = os.stat(prog)
+    key = stageKey([fileHash(fn) for fn in rasterList],
+                   {'flags': jbig2Flags, 'prog': [st.st_size, st.st_mtime_ns]})
+    if not force and loadStamp(stampPath, key, [symbolPath] + pagefiles) is not None:
+        print("** runJbig2: %s is up to date" % workDir, file=sys.stderr)
+        return symbolPath, pagefiles
+
+    #  jbig2 -s -S -p pdf.output.reference/AIPopularPress1985/*.png
+    cmd = [prog] + jbig2Flags + rasterList
+    if budget is None:
+        budget = CpuBudget(1)
+    with budget:
+        p = subprocess.Popen(cmd, shell=False, cwd=workDir)
+        retval = p.wait()
+    assert retval == 0, (retval, workDir, ' '.join(cmd))
+    writeStamp(stampPath, key)
+    return symbolPath, pagefiles
+
+
+def runJbig2Shards(jbigDir, rasterList, shardSize, numWorkers, budget=None, force=False):
+    """Run jbig2 on groups of `shardSize` consecutive rasters from `rasterList`, up to
+        `numWorkers` groups at a time, as CpuBudget `budget` allows. Each group is encoded in its
+        own subdirectory of `jbigDir` and has its own symbol dictionary. Groups whose rasters
+        are unchanged are not rerun unless `force` is True.
+        jbig2's symbol matching cost grows faster than linearly with the number of pages, so this
+        trades some file size for encoding time.
+        Returns: list of (symbolPath, pagefiles) for each group, in page order
+    """
+    groups = [rasterList[i:i + shardSize] for i in range(0, len(rasterList), shardSize)]
+    workDirs = [os.path.join(jbigDir, 'shard.%03d' % i) for i in range(len(groups))]
+    print("** runJbig2Shards: %d pages in %d shards of %d" % (len(rasterList), len(groups),
+          shardSize), file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=max(1, numWorkers)) as executor:
+        return list(executor.map(partial(runJbig2, budget=budget, force=force), workDirs,
+                                 groups))
+
+
+def jbig2Sizes(shards):
+    """Return the total sizes in bytes of the symbol dictionaries and page files in `shards`."""
+    symbolSize = sum(os.path.getsize(symbolPath) for symbolPath, _ in shards)
+    pageSize = sum(os.path.getsize(fn) for _, pagefiles in shards for fn in pagefiles)
+    return symbolSize, pageSize
+
+
+def reportShards(comparison):
+    """Print the JBIG2 size and encoding time of each (name, shards, dtJbig) in `comparison`."""
+    print("%-8s %6s %8s %9s %9s %9s" % ("jbig2", "dicts", "time", "symbols", "pages", "total"))
+    for name, shards, dtJbig in comparison:
+        symbolSize, pageSize = jbig2Sizes(shards)
+        print("%-8s %6d %6.1f s %6.2f MB %6.2f MB %6.2f MB" % (name, len(shards), dtJbig,
+              symbolSize/MBYTE, pageSize/MBYTE, (symbolSize+pageSize)/MBYTE))
+
+
+def deskewRasters(rasterList, deskewDir, numWorkers=1, budget=None, executor=None, force=False):
+    """Straighten the rasters in `rasterList`, writing the rotated ones to `deskewDir`. The
+        rasters are processed in `numWorkers` processes, or in process pool `executor` within
+        CpuBudget `budget`. Each raster's result is cached with a stamp of its hash and the
+        deskew parameters, unless `force` is True.
+        Returns: list of dicts, in `rasterList` order, with the 'path' of the raster to encode,
+            which is the original if it wasn't rotated, and its skew 'angle' in degrees
+    """
+    os.makedirs(deskewDir, exist_ok=True)
+    fn = partial(deskewRaster, deskewDir=deskewDir, force=force)
+    if executor is not None:
+        if budget is None:
+            budget = CpuBudget(numWorkers)
+        return list(budget.map(executor, fn, rasterList))
+    if numWorkers > 1:
+        with ProcessPoolExecutor(max_workers=numWorkers) as pool:
+            return list(pool.map(fn, rasterList))
+    return list(map(fn, rasterList))
+
+
+def deskewRaster(rasterPath, deskewDir, force=False):
+    """Measure the skew of raster `rasterPath` and, if it is at least deskewMinAngle, write the
+        raster rotated straight to `deskewDir`. This runs in a worker process.
+        Returns: dict with the 'path' of the raster to encode and its skew 'angle' in degrees
+    """
+    outPath = os.path.join(deskewDir, os.path.basename(rasterPath))
+    stampPath = outPath + '.json'
+    key = stageKey([fileHash(rasterPath)],
+                   {'maxAngle': deskewMaxAngle, 'step': deskewStep, 'fineStep': deskewFineStep,
+                    'minAngle': deskewMinAngle, 'width': deskewWidth})
+    stamp = None if force else loadStamp(stampPath, key)
+    if stamp is not None and os.path.exists(stamp['path']):
+        return {'path': stamp['path'], 'angle': stamp['angle']}
+
+    img = cv2.imread(rasterPath)
+    angle = estimateSkew(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+    path = rasterPath
+    if abs(angle) >= deskewMinAngle:
+        h, w = img.shape[:2]
+        m = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), angle, 1.0)
+        img = cv2.warpAffine(img, m, (w, h), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+        ok = cv2.imwrite(outPath, img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        assert ok, outPath
+        path = outPath
+    else:
+        angle = 0.0
+    print("deskewRaster: %s %.2f deg" % (os.path.basename(rasterPath), angle))
+    writeStamp(stampPath, key, {'path': path, 'angle': angle})
+    return {'path': path, 'angle': angle}
+
+
+def estimateSkew(gray):
+    """Return the skew angle in degrees of the text lines in grayscale page image `gray`.
+        A positive angle means the lines run down to the right.
+        The page is shrunk to deskewWidth pixels wide and binarized. Each candidate angle shears
+        the ink pixels' row coordinates by that angle and histograms them. The horizontal
+        projection profile is sharpest, i.e. has the largest sum of squares, when the shear
+        cancels the skew. Angles are searched every deskewStep degrees in +/-deskewMaxAngle and
+        then every deskewFineStep degrees around the best one.
+    """
+    h, w = gray.shape
+    if w > deskewWidth:
+        f = deskewWidth / w
+        gray = cv2.resize(gray, (deskewWidth, max(1, round(h * f))), interpolation=cv2.INTER_AREA)
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    ys, xs = np.nonzero(ink)
+    # Blank pages or pages that are mostly ink have no text lines to measure.
+    if len(ys) < 100 or len(ys) > ink.size // 2:
+        return 0.0
+    ys = ys.astype(np.float64)
+    xs = xs - gray.shape[1] / 2.0
+
+    def sharpness(angle):
+        rows = np.round(ys - xs * np.tan(np.radians(angle))).astype(np.int64)
+        profile = np.bincount(rows - rows.min())
+        return float(np.dot(profile, profile))
+
+    coarse = np.arange(-deskewMaxAngle, deskewMaxAngle + deskewStep / 2, deskewStep)
+    best = max(coarse, key=sharpness)
+    fine = np.arange(best - deskewStep, best + deskewStep + deskewFineStep / 2, deskewFineStep)
+    best = max(fine, key=sharpness)
+    return round(float(best), 2)
+
+
+def compareDeskew(deskewed, skewed):
+    """Compare the single dictionary JBIG2 encodings `deskewed` and `skewed`, each a list of
+        (symbolPath, pagefiles).
+        Returns: dict of (skewed, deskewed) symbol count, instance count and bytes, in total and
+            per page
+    """
+    (symbolPath0, pagefiles0), = skewed
+    (symbolPath1, pagefiles1), = deskewed
+    pages = []
+    for fn0, fn1 in zip(pagefiles0, pagefiles1):
+        data0, data1 = readFile(fn0), readFile(fn1)
+        pages.append({'instances': (jbig2Instances(data0), jbig2Instances(data1)),
+                      'bytes': (len(data0), len(data1))})
+    return {
+        'symbols': (jbig2SymbolCount(readFile(symbolPath0)),
+                    jbig2SymbolCount(readFile(symbolPath1))),
+        'instances': (sum(pg['instances'][0] or 0 for pg in pages),
+                      sum(pg['instances'][1] or 0 for pg in pages)),
+        'bytes': (jbig2Sizes(skewed)[0] + sum(pg['bytes'][0] for pg in pages),
+                  jbig2Sizes(deskewed)[0] + sum(pg['bytes'][1] for pg in pages)),
+        'pages': pages,
+    }
+
+
+def jbig2Segments(data):
+    """Yield (segment type, segment data) for each segment of JBIG2 embedded stream `data`.
+        See section 7.2 of the JBIG2 spec (ITU T.88).
+    """
+    pos = 0
+    while pos + 11 <= len(data):
+        number, flags = struct.unpack_from('>IB', data, pos)
+        pos += 5
+        count = data[pos] >> 5
+        if count == 7:
+            count = struct.unpack_from('>I', data, pos)[0] & 0x1fffffff
+            pos += 4 + (count + 8) // 8
+        else:
+            pos += 1
+        pos += count * (1 if number <= 256 else 2 if number <= 65536 else 4)
+        pos += 4 if flags & 0x40 else 1
+        length, = struct.unpack_from('>I', data, pos)
+        pos += 4
+        yield flags & 0x3f, data[pos:pos + length]
+        pos += length
+
+
+def jbig2SymbolCount(data):
+    """Return the number of symbols exported by the symbol dictionaries in JBIG2 stream `data`,
+        or None if it can't be parsed.
+    """
+    try:
+        n = 0
+        for segType, seg in jbig2Segments(data):
+            if segType != 0:
+                continue
+            flags, = struct.unpack_from('>H', seg, 0)
+            pos = 2
+            if not flags & 1:                        # SDHUFF
+                pos += 8 if (flags >> 10) & 3 == 0 else 2
+            if flags & 2 and not flags & 0x1000:     # SDREFAGG and SDRTEMPLATE 0
+                pos += 4
+            n += struct.unpack_from('>I', seg, pos)[0]
+        return n
+    except (struct.error, IndexError):
+        return None
+
+
+def jbig2Instances(data):
+    """Return the number of symbol instances in the text regions of JBIG2 page stream `data`,
+        or None if it can't be parsed.
+    """
+    try:
+        n = 0
+        for segType, seg in jbig2Segments(data):
+            if segType not in (4, 6, 7):
+                continue
+            flags, = struct.unpack_from('>H', seg, 17)
+            pos = 19
+            if flags & 1:                            # SBHUFF
+                pos += 2
+            if flags & 2 and not flags & 0x8000:     # SBREFINE and SBRTEMPLATE 0
+                pos += 4
+            n += struct.unpack_from('>I', seg, pos)[0]
+        return n
+    except (struct.error, IndexError):
+        return None
+
+
+def buildPDF(f, shards, doBgd, doFgd, numWorkers=1, bgdParams=None, objectStreams=False,
+             budget=None, executor=None, prev=None):
+    """Build a PDF from the JBIG2 symbol table files and page files in `shards` and write it to
+        file object `f`.
+        `shards` is a list of (symbolPath, pagefiles) in page order. Each symbol table is written
+        as a /JBIG2Globals object that is shared by the pages in its shard.
+        Each page's objects are written to `f` as soon as the page is built so only one page is
+        held in memory at a time.
+        The page backgrounds are prepared in process pool `executor`, or in a pool of
+        `numWorkers` processes made for this document, within CpuBudget `budget` and assembled in
+        page order.
+        `bgdParams` is the BgdParams used to encode them.
+        Objects without streams are packed into object streams if `objectStreams` is True.
+        If Revision `prev` is given, `f` is the existing PDF it describes opened for appending,
+        and the pages are appended to it in an incremental update. The update holds the new
+        objects and a new revision of the page tree. A symbol dictionary that is identical to
+        one already in the file is referenced rather than written again. `objectStreams` is
+        taken from `prev` as the update's xref must be of the same kind as the file's.
+        Returns: doc, pageStats
+            doc: the Doc that was written
+            pageStats: list of per-page size and background timing dicts
+    """
+    if doBgd and executor is None and numWorkers > 1:
+        with ProcessPoolExecutor(max_workers=numWorkers) as executor:
+            return buildPDF(f, shards, doBgd, doFgd, numWorkers, bgdParams, objectStreams,
+                            budget, executor, prev)
+
+    for symbolPath, pagefiles in shards:
+        print("** symbolPath=%s" % symbolPath, file=sys.stderr)
+        print("** pagefiles= %d: %s" % (len(pagefiles), pagefiles), file=sys.stderr)
+
+    if bgdParams is None:
+        bgdParams = defaultBgdParams
+    if prev is not None:
+        objectStreams = prev.objstm
+    # Object streams need PDF 1.5 in the header. JPEG 2000 also needs PDF 1.5 but whether any
+    # page uses it is only known once the pages are encoded, so the catalog, whose /Version
+    # overrides the header's, is written last.
+    version = b'1.5' if objectStreams else b'1.4'
+
+    if prev is None:
+        doc = Doc(f, version, objectStreams)
+        pages = doc.new_object({'Type': '/Pages'})
+        doc.pagesId = pages.id
+        catalog = doc.new_object({'Type': '/Catalog',
+                                  'Pages': ref(pages.id),
+                                  })
+        doc.catalogId = catalog.id
+        doc.defer_object(catalog)
+        info = doc.new_object({'Producer': '(connected.py)',
+                               'Creator': '(yo mamma)',
+                               })
+        doc.add_info(info)
+        oldPageIds = []
+    else:
+        version = max(version, prev.version.encode('ascii'))
+        doc = Doc(f, version, objectStreams, prev=prev)
+        # The new revision of the page tree keeps its object number so the old pages' /Parent
+        # references still point to it.
+        pages = Obj(prev.pagesId, {'Type': '/Pages'})
+        # Revised if the update raises the version.
+        catalog = Obj(prev.catalogId, {'Type': '/Catalog',
+                                       'Pages': ref(pages.id),
+                                       })
+        oldPageIds = prev.pageIds
+    # The page tree is only complete after the last page so it is written last.
+    doc.defer_object(pages)
+
+    # pagefiles is all the page files in the document and pageSymds is their symbol dictionaries.
+    pagefiles = []
+    pageSymds = []
+    symds = prev.symds if prev is not None else {}
+    for symbolPath, shardPages in shards:
+        symbols = readFile(symbolPath)
+        key = hashlib.sha1(symbols).hexdigest()
+        if key in symds:
+            symd = Obj(symds[key])
+        else:
+            symd = doc.add_object(doc.new_object({}, symbols))
+            doc.symds[key] = doc.resolve(symd.id)
+        pagefiles.extend(sorted(shardPages))
+        pageSymds.extend([symd] * len(shardPages))
 
     page_objs = []
-    pagefiles.sort()
-    for i, pageFile in enumerate(pagefiles):
-        bgdFile = pageFile + '.png'
-        jpgFile = pageFile + '.jpg'
+    pageStats = []
+    prepare = partial(prepareBackground, params=bgdParams)
+    if not doBgd:
+        backgrounds = (None for _ in pagefiles)
+    elif executor is not None:
+        if budget is None:
+            budget = CpuBudget(numWorkers)
+        backgrounds = budget.map(executor, prepare, pagefiles)
+    else:
+        backgrounds = map(prepare, pagefiles)
+
+    for i, (pageFile, symd, bgd) in enumerate(zip(pagefiles, pageSymds, backgrounds),
+                                              len(oldPageIds)):
         print("** page %d: %s" % (i, pageFile), file=sys.stderr)
 
         fgdContents = readFile(pageFile)
@@ -188,32 +807,17 @@ def buildPDF(symbolPath, pagefiles, doBgd, doFgd):
         widthPts = float(width * 72) / xres
         heightPts = float(height * 72) / yres
 
-        if os.path.exists(bgdFile):
-            bgd = cv2.imread(bgdFile)
-            h, w = bgd.shape[:2]
-            print('** bgd original    (width, height)', [w, h], file=sys.stderr)
-            assert w <= width and h <= height, 'jpeg=%s jbig2=%s' % ([w, h], [width, height])
-            if w < width or h < height:
-                top = 0
-                left = 0
-                right = width - w
-                bottom = height - h
-                WHITE = [255, 255, 255]
-                bgd = cv2.copyMakeBorder(bgd, top, bottom, left, right, cv2.BORDER_CONSTANT, value=WHITE)
-
-            # bgd[:] = [255, 0, 0]   # !@#$
-            bgd, bgdXform = clip(bgd)
-            cv2.imwrite(jpgFile, bgd, [cv2.IMWRITE_JPEG_QUALITY, 25])
-            bgdContents, bgdImproved = readJpegFile(jpgFile)
-            h, w = bgd.shape[:2]
-            print('** bgd             (width, height)', [w, h], file=sys.stderr)
-            bgdSizes.append(len(bgdContents))
+        if bgd is not None and bgd['contents'] is not None:
+            bgdContents = bgd['contents']
+            bgdXform = bgd['xform']
+            w, h = bgd['width'], bgd['height']
         else:
             bgdContents = None
-            bgdImproved = False
 
-        bgdIm = b'/ImBgd%d' % (i + 1)
-        fgdIm = b'/ImFgd%d' % (i + 1)
+        # XObject names are local to each page's resources. Using the same names on every page
+        # lets Doc dedupe the resources and content streams of identical pages.
+        bgdIm = b'/ImBgd'
+        fgdIm = b'/ImFgd'
 
         if doFgd:
             # <</Type /XObject /Subtype /Image
@@ -225,7 +829,7 @@ def buildPDF(symbolPath, pagefiles, doBgd, doFgd):
             # /Filter / JBIG2Decode
             # >>
 
-            maskXobj = Obj({'Type': '/XObject', 'Subtype': '/Image',
+            maskXobj = doc.new_object({'Type': '/XObject', 'Subtype': '/Image',
                         'Width': str(width), 'Height': str(height),
                         # 'ColorSpace': '/DeviceGray',
                         'BitsPerComponent': '1',
@@ -235,35 +839,32 @@ def buildPDF(symbolPath, pagefiles, doBgd, doFgd):
                         'DecodeParms': b'<< /JBIG2Globals %s >>' % symd.ref()},
                         fgdContents)
             black = b'\x00\x00\x00'
-            fgdXobj = Obj({'Type': '/XObject', 'Subtype': '/Image',
-                           'Width':'1', 'Height': '1',
-                           'ColorSpace': '/DeviceRGB',
-                           'BitsPerComponent': '8',
-                           'Mask': '%d 0 R' % maskXobj.id
-                           },
-                           black)
+            fgdXobj = doc.new_object({'Type': '/XObject', 'Subtype': '/Image',
+                                      'Width':'1', 'Height': '1',
+                                      'ColorSpace': '/DeviceRGB',
+                                      'BitsPerComponent': '8',
+                                      'Mask': '%d 0 R' % maskXobj.id
+                                      },
+                                      black)
             fgdDo = b'%s Do' % fgdIm
             fgdRef = b'%s %s ' % (fgdIm, fgdXobj.ref())
-            fgdSizes.append(len(fgdContents))
         else:
             maskXobj = None
             fgdXobj = None
             fgdDo = b''
             fgdRef = b''
 
-        bgdFiter = '/DCTDecode'
-        if bgdImproved:
-            bgdFiter = '[/FlateDecode /DCTDecode]'
-
         if doBgd and bgdContents is not None:
             bgdDict = {'Type': '/XObject', 'Subtype': '/Image',
                        'Width': str(w),
                        'Height': str(h),
-                       'ColorSpace': '/DeviceRGB',
+                       'ColorSpace': bgd['colorSpace'],
                        'BitsPerComponent': '8',
-                       'Filter': '[/FlateDecode /DCTDecode]'
+                       'Filter': bgd['filter'],
                        }
-            bgdXobj = Obj(bgdDict, bgdContents)
+            bgdXobj = doc.new_object(bgdDict, bgdContents)
+            if bgd['filter'] == b'/JPXDecode':
+                version = max(version, b'1.5')
             bgdDo = b'%s Do' % bgdIm
             bgdRef = b'%s %s ' % (bgdIm, bgdXobj.ref())
         else:
@@ -287,31 +888,349 @@ def buildPDF(symbolPath, pagefiles, doBgd, doFgd):
         if bgdDo:
             scaledBgd = b'q %s %s Q' % (bgdXform, bgdDo)
 
-        cmds = Obj({},  b'q %s %s %s Q' % (scale, scaledBgd, fgdDo))
-        # cmds = Obj({},  b'q %s %s Q' % (scale, scaledBgd))
-        # cmds = Obj({},  b'%s q %s %s %s Q' % (rectFill, scale, bgdDo, fgdDo))
+        cmds = doc.new_object({},  b'q %s %s %s Q' % (scale, scaledBgd, fgdDo))
+        # cmds = doc.new_object({},  b'q %s %s Q' % (scale, scaledBgd))
+        # cmds = doc.new_object({},  b'%s q %s %s %s Q' % (rectFill, scale, bgdDo, fgdDo))
 
-        resources = Obj({'XObject': b'<<%s%s>>' % (bgdRef, fgdRef)})
-        page = Obj({'Type': '/Page', 'Parent': pages.ref(),
-                    'MediaBox': '[0 0 %f %f]' % (widthPts, heightPts),
-                    'Contents': cmds.ref(),
-                    'Resources': resources.ref()
-                    })
+        resources = doc.new_object({'XObject': b'<<%s%s>>' % (bgdRef, fgdRef)})
+        page = doc.new_object({'Type': '/Page', 'Parent': pages.ref(),
+                               'MediaBox': '[0 0 %f %f]' % (widthPts, heightPts),
+                               'Contents': cmds.ref(),
+                               'Resources': resources.ref()
+                               })
         doc.add_objects([maskXobj,  fgdXobj, bgdXobj, cmds, resources, page])
-        page_objs.append(page)
+        page_objs.append(page.id)
+        bgdStats = bgd if bgd is not None else {}
+        pageStats.append({
+            'page': i,
+            'bgdKind': bgdStats.get('kind'),
+            'bgdSize': len(bgdContents) if bgdContents is not None else None,
+            'fgdSize': len(fgdContents) if doFgd else None,
+            'scale': bgdStats.get('scale'),
+            'codec': bgdStats.get('codec'),
+            'dpi': bgdStats.get('dpi'),
+            'dtBgd': bgdStats.get('dtBgd'),
+            'bgdFresh': bgdStats.get('fresh'),
+            'instances': jbig2Instances(fgdContents),
+        })
+
+    doc.pageIds = page_objs
+    pageIds = oldPageIds + page_objs
+    catalog.d.d[b'Version'] = b'/%s' % version
+    if prev is not None and version > prev.version.encode('ascii'):
+        doc.defer_object(catalog)
+    doc.version = version
+    pages.d.d[b'Count'] = b'%d' % len(pageIds)
+    pages.d.d[b'Kids'] = b'[%s]' % b' '.join(ref(i) for i in pageIds)
+    doc.close()
+    return doc, pageStats
+
+
+def prepareBackground(pageFile, params):
+    """Read, clip and encode the background raster of JBIG2 page file `pageFile` with BgdParams
+        `params`.
+        This runs in a worker process so everything buildPDF needs is returned rather than kept
+        in globals.
+        The background is resampled to `params.dpi` (or a DPI chosen from its content if
+        `params.autoDpi` is True). It only carries the low frequency colors left once the JBIG2
+        mask has removed the text so it rarely needs the raster's full resolution. The clip
+        transform maps the image to its fraction of the page whatever its pixel size, so it
+        doesn't change.
+        Backgrounds with no color are encoded as /DeviceGray, which is a third of the raw data
+        of /DeviceRGB.
+        The encoded background is cached next to `pageFile` with a stamp of its inputs and
+        parameters, and is reused while the stamp matches unless `params.force` is True. The
+        stamp holds everything else buildPDF needs so a cached page isn't decoded at all.
+        The background is encoded in memory. Its JPEG is also written to a file for debugging if
+        `params.keepJpeg` is True.
+        Returns: dict of the encoded background and its sizes. Its 'kind' is one of bgdKinds.
+            Its 'contents' is None if the page has no background raster or the background is
+            blank. Its 'dtBgd' is the time taken in seconds. Its 'fresh' lists the stages that
+            were skipped.
+    """
+    t0 = time()
+    bgdFile = pageFile + '.png'
+    jpgFile = pageFile + '.jpg'
+    if not os.path.exists(bgdFile):
+        return {'kind': 'missing', 'contents': None, 'dtBgd': time() - t0, 'fresh': []}
+
+    header = readPageHeader(pageFile)
+    encodeKey = stageKey([fileHash(bgdFile), list(header)],
+                         {'dpi': params.dpi, 'autoDpi': params.autoDpi,
+                          'autoDpiChoices': autoDpiChoices, 'autoDpiTolerance': autoDpiTolerance,
+                          'grayTolerance': grayTolerance,
+                          'codecs': params.codecs, 'codecBudget': params.codecBudget,
+                          'jpegQuality': jpegQuality, 'jpxCompression': jpxCompression})
+    encodeStamp = pageFile + '.enc.json'
+    encodePath = pageFile + '.enc'
+    outputs = [encodePath, jpgFile] if params.keepJpeg else [encodePath]
+    stamp = None if params.force else loadStamp(encodeStamp, encodeKey)
+    if stamp is not None and stamp['kind'] != 'blank' and \
+       not all(os.path.exists(fn) for fn in outputs):
+        stamp = None
+    if stamp is not None:
+        fresh = ['encode']
+    else:
+        fresh = []
+        clipped = clipBackground(readFile(bgdFile), header, params)
+        stamp = {k: v for k, v in clipped.items() if k != 'img'}
+        bgd = clipped['img']
+        if bgd is not None:
+            if params.keepJpeg:
+                writeFile(jpgFile, encodeJpeg(bgd, jpegQuality))
+            encoding = encodeBackground(pageFile, bgd, params.codecs, params.codecBudget)
+            writeFile(encodePath, encoding['contents'])
+            h, w = bgd.shape[:2]
+            stamp.update({'codec': encoding['codec'],
+                          'filter': encoding['filter'].decode('latin-1'),
+                          'colorSpace': encoding['colorSpace'].decode('latin-1'),
+                          'width': w,
+                          'height': h})
+        writeStamp(encodeStamp, encodeKey, stamp)
+    if stamp['kind'] == 'blank':
+        print('** bgd is blank', file=sys.stderr)
+        return {'kind': 'blank', 'contents': None, 'scale': stamp['scale'],
+                'dtBgd': time() - t0, 'fresh': fresh}
+
+    print('** bgd             (width, height)', [stamp['width'], stamp['height']],
+          file=sys.stderr)
+    return {'kind': stamp['kind'],
+            'contents': readFile(encodePath) if fresh else encoding['contents'],
+            'codec': stamp['codec'],
+            'filter': stamp['filter'].encode('latin-1'),
+            'colorSpace': stamp['colorSpace'].encode('latin-1'),
+            'xform': stamp['xform'].encode('latin-1'),
+            'width': stamp['width'],
+            'height': stamp['height'],
+            'scale': stamp['scale'],
+            'dpi': stamp['dpi'],
+            'dtBgd': time() - t0,
+            'fresh': fresh,
+            }
+
+
+def clipBackground(bgdData, header, params):
+    """Decode background PNG `bgdData`, clip it to its content and resample it to the DPI given
+        by BgdParams `params`. `header` is the (width, height, xres, yres) of its JBIG2 page.
+        Returns: dict with the background 'kind', the clipped image 'img', its clip transform
+            'xform', 'scale' and 'dpi'. 'img' is None for blank backgrounds.
+    """
+    width, height, xres, yres = header
+    bgd = cv2.imdecode(np.frombuffer(bgdData, dtype=np.uint8), cv2.IMREAD_COLOR)
+    h, w = bgd.shape[:2]
+    print('** bgd original    (width, height)', [w, h], file=sys.stderr)
+    assert w <= width and h <= height, 'jpeg=%s jbig2=%s' % ([w, h], [width, height])
+
+    # bgd[:] = [255, 0, 0]   # !@#$
+    bgd, bgdXform, scale = clip(bgd, width, height)
+    if bgd.size == 0:
+        return {'kind': 'blank', 'img': None, 'xform': None, 'scale': scale, 'dpi': None}
+    if params.autoDpi:
+        dpi = chooseBgdDpi(bgd, xres, autoDpiChoices, autoDpiTolerance)
+    else:
+        dpi = params.dpi
+    bgd, dpi = resample(bgd, xres, yres, dpi)
+    kind = 'color'
+    if isGray(bgd, grayTolerance):
+        kind = 'gray'
+        bgd = cv2.cvtColor(bgd, cv2.COLOR_BGR2GRAY)
+    return {'kind': kind, 'img': bgd, 'xform': bgdXform.decode('latin-1'), 'scale': scale,
+            'dpi': dpi}
+
+
+def fileHash(path):
+    """Return the SHA1 hex digest of the contents of file `path`."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stageKey(inputs, params):
+    """Return a key identifying a run of a stage with input hashes `inputs` and JSON
+        serializable parameters `params`.
+    """
+    text = json.dumps({'inputs': inputs, 'params': params}, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def readStamp(stampPath):
+    """Return the dict stored in stamp file `stampPath`, or None if there isn't one."""
+    try:
+        with open(stampPath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def loadStamp(stampPath, key, outputs=()):
+    """Return the dict stored in stamp file `stampPath` if it was written for stage key `key` and
+        all the files in `outputs` exist, otherwise None.
+    """
+    stamp = readStamp(stampPath)
+    if stamp is None or stamp.get('key') != key:
+        return None
+    if not all(os.path.exists(fn) for fn in outputs):
+        return None
+    return stamp
+
 
-        pages.d.d[b'Count'] = b'%d' % len(page_objs)
-        pages.d.d[b'Kids'] = b'[%s]' % b' '.join(o.ref() for o in page_objs)
+def writeStamp(stampPath, key, info=None):
+    """Record in `stampPath` that the stage with key `key` has written its outputs. `info` is
+        stored alongside the key.
+    """
+    stamp = dict(info or {})
+    stamp['key'] = key
+    tmpPath = stampPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(stamp, f, indent=1)
+    os.replace(tmpPath, stampPath)
 
-    return doc
+
+def isGray(img, tolerance):
+    """Return True if no pixel in BGR image `img` has channels that differ by more than
+        `tolerance`. This catches black and white scans with a faint color tint.
+    """
+    spread = img.max(axis=2) - img.min(axis=2)
+    return int(spread.max()) <= tolerance
+
+
+def resample(img, xres, yres, dpi):
+    """Resample `img` from `xres` x `yres` DPI to `dpi`. Images are only ever shrunk and a `dpi`
+        of 0 leaves `img` unchanged.
+        Returns: resampled image, its DPI
+    """
+    if dpi <= 0 or (dpi >= xres and dpi >= yres):
+        return img, xres
+    h, w = img.shape[:2]
+    w2 = max(1, round(w * min(1.0, dpi / xres)))
+    h2 = max(1, round(h * min(1.0, dpi / yres)))
+    return cv2.resize(img, (w2, h2), interpolation=cv2.INTER_AREA), dpi
+
+
+def chooseBgdDpi(img, xres, choices, tolerance):
+    """Return the lowest DPI in `choices` at which `img` loses no more than `tolerance` mean
+        absolute gray level when it is downsampled and upsampled back. Returns 0 (the raster
+        resolution) if no choice is good enough.
+        The test is run on a grayscale copy at the lowest resolutions first so smooth
+        backgrounds are cheap to check.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape[:2]
+    for dpi in sorted(choices):
+        if dpi >= xres:
+            break
+        small, _ = resample(gray, xres, xres, dpi)
+        restored = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+        err = cv2.absdiff(gray, restored).mean()
+        if err <= tolerance:
+            return dpi
+    return 0
+
+
+def readPageHeader(pageFile):
+    """Return width, height, xres, yres from the page information segment of JBIG2 page file
+        `pageFile`.
+    """
+    with open(pageFile, 'rb') as f:
+        header = f.read(27)
+    # Big endian (Network byte order) 4 byte integers.
+    return struct.unpack('>IIII', header[11:27])
 
 
 class Doc:
-  def __init__(self):
-    self.objs = []
+  """Doc writes a PDF to file object `f` as objects are added.
+      Each object is serialized once, written straight to `f` and dropped. Only the byte offsets
+      needed for the xref table are kept so memory use doesn't grow with the number of pages.
+      Objects that can't be completed until the end of the document (e.g. the page tree) are
+      added with defer_object() and written by close().
+      If `objectStreams` is True, objects without streams are packed into Flate compressed
+      object streams of up to objStmSize objects and the xref is written as a cross-reference
+      stream. This needs PDF 1.5. Stream objects can't be stored in object streams so they are
+      still written directly.
+      If `dedupe` is True, an object that is byte for byte identical to one already added is not
+      written. Its number is made an alias of the earlier object's and references to it in
+      objects added later are rewritten. Pages are never deduped as each must appear once in
+      the page tree.
+      If `prev` is given, `f` is an existing PDF opened for appending and the objects are written
+      as an incremental update of it. `prev` is the Revision of the file, as recorded by
+      revision(). New objects are numbered from its size, the xref section only lists the
+      objects in the update and points back to the previous one with /Prev.
+  """
+  def __init__(self, f, version=b'1.4', objectStreams=False, dedupe=True, prev=None):
+    self.f = f
+    self.version = version
+    self.pos = 0
+    self.offsets = {}
+    self.sizes = {}
+    self.compressed = {}
+    self.pending = []
+    self.objectStreams = objectStreams
+    self.dedupe = dedupe
+    self.hashes = {}
+    self.aliases = {}
+    self.numDeduped = 0
+    self.dedupedSize = 0
+    self.deferred = []
     self.pages = []
     self.catalogId = -1
     self.infoId = -1
+    self.pagesId = -1
+    self.numObjects = 0
+    self.objectsSize = 0
+    self.textSize = 0
+    self.streamSize = 0
+    self.nextId = 1
+    self.prev = prev
+    self.startxref = None
+    self.size = None
+    # The page object numbers, in order, and the symbol dictionary object numbers keyed by
+    # the SHA1 of their contents. buildPDF fills these in so that they can be recorded.
+    self.pageIds = []
+    self.symds = {}
+    if objectStreams:
+        assert version >= b'1.5', version
+    if prev is not None:
+        self.pos = prev.fileSize
+        self.nextId = prev.size
+        self.catalogId = prev.catalogId
+        self.infoId = prev.infoId
+        return
+    self.write(b'%%PDF-%s' % version)
+    self.write(b'%a\x01\x02\x8f')
+
+  def new_object(self, d={}, stream=None):
+    """Return a new Obj with the next object number in this Doc."""
+    o = Obj(self.nextId, d, stream)
+    self.nextId += 1
+    return o
+
+  def revision(self):
+    """Return the Revision of the file written by this Doc, which is needed to append to it.
+        This must be called after close().
+    """
+    assert self.startxref is not None
+    prev = self.prev
+    return Revision(version=self.version.decode('ascii'),
+                    objstm=self.objectStreams,
+                    fileSize=self.pos,
+                    startxref=self.startxref,
+                    size=self.size,
+                    catalogId=self.resolve(self.catalogId),
+                    infoId=self.resolve(self.infoId),
+                    pagesId=prev.pagesId if prev else self.resolve(self.pagesId),
+                    pageIds=(prev.pageIds if prev else []) + self.pageIds,
+                    symds=dict(prev.symds if prev else {}, **self.symds))
+
+  def resolve(self, objId):
+    """Return the number of the object written for object number `objId`."""
+    return self.aliases.get(objId, objId)
+
+  def write(self, x):
+    self.f.write(x)
+    self.f.write(b'\r\n')
+    self.pos += len(x) + 2
 
   def add_objects(self, objs):
     for o in objs:
@@ -319,7 +1238,78 @@ class Doc:
             self.add_object(o)
 
   def add_object(self, o):
-    self.objs.append(o)
+    assert o.id not in self.offsets and o.id not in self.compressed, o.id
+    if self.aliases:
+        o.d.replace_refs(self.aliases)
+    data = None
+    if self.dedupe and o.d.d.get(b'Type') != b'/Page':
+        data = bytes(o)
+        key = hashlib.sha1(data).digest()
+        if key in self.hashes:
+            self.aliases[o.id] = self.hashes[key]
+            self.numDeduped += 1
+            self.dedupedSize += len(data)
+            return o
+        self.hashes[key] = o.id
+    if self.objectStreams and o.stream is None:
+        self.pending.append(o)
+        if len(self.pending) >= objStmSize:
+            self.flush_object_stream()
+        return o
+    data = self.write_object(o, data)
+    streamLen = len(o.stream) if o.stream is not None else 0
+    self.numObjects += 1
+    self.objectsSize += len(data)
+    self.textSize += len(data) - streamLen
+    self.streamSize += streamLen
+    return o
+
+  def write_object(self, o, data=None):
+    """Write `o` to the file at the current position and return its serialization `data`.
+        The lengths of its dictionary and of the whole serialization are kept in `sizes`.
+    """
+    if data is None:
+        data = bytes(o)
+    streamPart = 0
+    if o.stream is not None:
+        streamPart = len(b'stream\n') + len(o.stream) + len(b'\nendstream\n')
+    self.sizes[o.id] = (len(data) - streamPart - len(b'endobj'), len(data))
+    self.offsets[o.id] = self.pos
+    self.write(b'%d 0 obj' % o.id)
+    self.write(data)
+    return data
+
+  def flush_object_stream(self):
+    """Write the pending objects as one compressed object stream."""
+    if not self.pending:
+        return
+    header = []
+    bodies = []
+    pos = 0
+    for i, o in enumerate(self.pending):
+        body = bytes(o.d)
+        header.append(b'%d %d' % (o.id, pos))
+        bodies.append(body)
+        pos += len(body)
+        self.compressed[o.id] = i
+    header = b' '.join(header) + b'\n'
+    stm = self.new_object({'Type': '/ObjStm',
+                           'N': '%d' % len(self.pending),
+                           'First': '%d' % len(header),
+                           'Filter': '/FlateDecode',
+                           },
+                          zlib.compress(header + b''.join(bodies), 9))
+    for o in self.pending:
+        self.compressed[o.id] = (stm.id, self.compressed[o.id])
+    data = self.write_object(stm)
+    # The object stream holds the dictionaries of the pending objects so it counts as text.
+    self.numObjects += len(self.pending) + 1
+    self.objectsSize += len(data)
+    self.textSize += len(data)
+    self.pending = []
+
+  def defer_object(self, o):
+    self.deferred.append(o)
     return o
 
   def add_catalog(self, o):
@@ -334,74 +1324,139 @@ class Doc:
     self.pages.append(o)
     return self.add_object(o)
 
-  pos = 0
+  def close(self):
+    """Write the deferred objects, xref and trailer."""
+    for o in self.deferred:
+        self.add_object(o)
+    self.deferred = []
+    self.flush_object_stream()
 
-  def __bytes__(self):
-    pos = 0
-    a = []
-    Doc.pos = 0
-    offsets = []
-
-    self.objs.sort(key=lambda o: o.id)
-
-    def add(x):
-        a.append(x)
-        Doc.pos += len(x) + 2
-
-    objectSizes = []
-    add(b'%PDF-1.4')
-    add(b'%a\x01\x02\x8f')
-    for o in self.objs:
-      offsets.append(Doc.pos)
-      add(b'%d 0 obj' % o.id)
-      objectSizes.append(len(bytes(o)))
-      add(bytes(o))
-
-    xrefstart = Doc.pos
-    a.append(b'xref')
-    a.append(b'0 %d' % (len(offsets) + 1))
-    line = b'0000000000 65535 f'
-    assert len(line) == 18, (len(line),line)
-    a.append(line)
-    for o in offsets:
-        line = b'%010d 00000 n' % o
-        assert len(line) == 18, (len(line), line)
-        a.append(line)
-    print("offsets=%d %s" % (len(offsets), offsets))
-    # a.append(b'')
-    a.append(b'trailer')
-    a.append(b'<<\n\t/Size %d\n\t/Root %s\n\t/Info %s\n>>' %
-             (len(offsets) + 1, ref(self.catalogId), ref(self.infoId)))
-    a.append(b'startxref')
-    a.append(b'%d' % xrefstart)
-    a.append(b'%%EOF\n')
-    data = b'\r\n'.join(a)
-    print("objects sizes = %d %.1f MB" % (len(objectSizes), sum(objectSizes)/MBYTE))
-    print("document size = %.1f MB" % (len(data)/MBYTE))
-    assert data[Doc.pos:Doc.pos+4] == b'xref'
-
-    # offsets.append(len(data))
-    # for i in range(1, len(offsets)-1):
-    #     ofs0 = offsets[i]
-    #     ofs1 = offsets[i+1]
-    #     section = data[ofs0:ofs1]
-    #     print("### %d: %6d  %s ... %s" % (i, len(section), section[:48], section[-32:]))
+    if self.objectStreams:
+        xrefstart = self.write_xref_stream()
+    else:
+        xrefstart = self.write_xref_table()
+    self.startxref = xrefstart
+    self.write(b'startxref')
+    self.write(b'%d' % xrefstart)
+    self.f.write(b'%%EOF\n')
+    self.pos += len(b'%%EOF\n')
+    print("objects sizes = %d %.1f MB" % (self.numObjects, self.objectsSize/MBYTE))
+    print("document size = %.1f MB" % (self.pos/MBYTE))
+
+  def write_xref_table(self):
+    """Write a classic xref table and trailer and return the xref offset.
+        An incremental update's table only has subsections for the objects it wrote.
+    """
+    xrefstart = self.pos
+    size = max(self.offsets) + 1 if self.offsets else 1
+    self.write(b'xref')
+    if self.prev is None:
+        sections = [(0, size)]
+    else:
+        size = max(size, self.prev.size)
+        # Readers that check the table starts at object 0 expect its free entry first.
+        sections = xrefSections([0] + sorted(self.offsets))
+    for start, count in sections:
+        self.write(b'%d %d' % (start, count))
+        for i in range(start, start + count):
+            if i == 0:
+                line = b'0000000000 65535 f'
+            elif i in self.offsets:
+                line = b'%010d 00000 n' % self.offsets[i]
+            else:
+                line = b'0000000000 65535 f'
+            assert len(line) == 18, (len(line), line)
+            self.write(line)
+    prev = b''
+    if self.prev is not None:
+        prev = b'\n\t/Prev %d' % self.prev.startxref
+    self.write(b'trailer')
+    self.write(b'<<\n\t/Size %d\n\t/Root %s\n\t/Info %s%s\n>>' %
+               (size, ref(self.resolve(self.catalogId)), ref(self.resolve(self.infoId)), prev))
+    self.size = size
+    return xrefstart
+
+  def write_xref_stream(self):
+    """Write a cross-reference stream, which is also the trailer, and return its offset.
+        Entries are 1 byte type, 4 byte offset or object stream number, 2 byte generation or
+        index in object stream.
+    """
+    xrefstart = self.pos
+    xrefId = self.nextId
+    self.offsets[xrefId] = xrefstart
+    size = xrefId + 1
+    assert xrefstart < 1 << 32, xrefstart
+    extra = {}
+    if self.prev is None:
+        sections = [(0, size)]
+    else:
+        sections = xrefSections(sorted(set(self.offsets) | set(self.compressed)))
+        extra = {'Index': '[%s]' % ' '.join('%d %d' % sc for sc in sections),
+                 'Prev': '%d' % self.prev.startxref}
+    rows = []
+    for i in (i for start, count in sections for i in range(start, start + count)):
+        if i in self.offsets:
+            rows.append(struct.pack('>BIH', 1, self.offsets[i], 0))
+        elif i in self.compressed:
+            stmId, index = self.compressed[i]
+            rows.append(struct.pack('>BIH', 2, stmId, index))
+        else:
+            rows.append(struct.pack('>BIH', 0, 0, 65535))
+    xref = self.new_object({'Type': '/XRef',
+                            'Size': '%d' % size,
+                            'W': '[1 4 2]',
+                            'Root': ref(self.resolve(self.catalogId)),
+                            'Info': ref(self.resolve(self.infoId)),
+                            'Filter': '/FlateDecode',
+                            **extra,
+                            },
+                           zlib.compress(b''.join(rows), 9))
+    assert xref.id == xrefId, (xref.id, xrefId)
+    del self.offsets[xrefId]
+    self.write_object(xref)
+    self.size = size
+    return xrefstart
+
+
+def xrefSections(ids):
+    """Return the (first, count) runs of consecutive object numbers in sorted list `ids`."""
+    sections = []
+    for i in ids:
+        if sections and sections[-1][0] + sections[-1][1] == i:
+            sections[-1] = (sections[-1][0], sections[-1][1] + 1)
+        else:
+            sections.append((i, 1))
+    return sections
 
-    return data
 
-class Obj:
-  next_id = 1
+# Revision is what's needed to append an incremental update to a PDF written by Doc. It is
+# stored in the document's metrics.
+#   version: PDF version
+#   objstm: True if the file has object streams and a cross-reference stream
+#   fileSize, startxref, size: the file's length, last xref offset and /Size
+#   catalogId, infoId, pagesId: object numbers of the catalog, info dict and page tree
+#   pageIds: object numbers of the pages in order
+#   symds: JBIG2 symbol dictionary object numbers keyed by the SHA1 hex of their contents
+Revision = namedtuple('Revision', ['version', 'objstm', 'fileSize', 'startxref', 'size',
+                                   'catalogId', 'infoId', 'pagesId', 'pageIds', 'symds'])
+
+
+# Max number of objects in each object stream.
+objStmSize = 200
+
 
-  def __init__(self, d={}, stream=None):
+class Obj:
+  """A PDF object. Object numbers are allocated by Doc.new_object so that several Docs can be
+      built at the same time in different threads.
+  """
+  def __init__(self, objId, d={}, stream=None):
     if stream is not None:
       d[b'Length'] = b'%d' % (len(stream))
     self.d = Dict(d)
     self.stream = stream
-    self.id = Obj.next_id
-    Obj.next_id += 1
+    self.id = objId
 
   def __bytes__(self):
-    global textSize, streamSize
     s = []
     s.append(bytes(self.d))
     if self.stream is not None:
@@ -409,13 +1464,7 @@ class Obj:
       s.append(self.stream)
       s.append(b'\nendstream\n')
     s.append(b'endobj')
-    data = b''.join(s)
-    streamLen = len(self.stream) if self.stream is not None else 0
-    textSize += len(data) - streamLen
-    streamSize += streamLen
-    # print(" textSize=%d" % textSize)
-    # print("streamSize=%d" % streamSize)
-    return data
+    return b''.join(s)
 
   def ref(self):
       return ref(self.id)
@@ -438,76 +1487,202 @@ class Dict:
     s.append(b'>>\n')
     return b''.join(s)
 
+  def replace_refs(self, aliases):
+    """Replace references to the object numbers in `aliases` with references to their values."""
+    def replace(m):
+        return ref(aliases.get(int(m.group(1)), int(m.group(1))))
+    for k, v in self.d.items():
+        self.d[k] = REF.sub(replace, v)
+
 
 def ref(i):
     """ref returns a string with a reference to object number `i`"""
     return b'%d 0 R' % i
 
 
-def readJpegFile(orig):
-    # filename = orig + '.lo.jpg'
-    # img = cv2.imread(orig)
-    # cv2.imwrite(filename, img, [int(cv2.IMWRITE_JPEG_QUALITY), 25])
-    filename = orig
-    data = readFile(filename)
-    compressed = zlib.compress(data, level=9)
-    improved = float(len(compressed)) <= 0.95 * float(len(data))
-    print("readJpegFile: %s %d -> %d = %.1f%%" % (orig, len(data), len(compressed),
-                                                  100.0 * len(compressed) / len(data),
-    ))
-    if improved:
-        data = compressed
-    return compressed, improved
-
-
-allScales = []
-bgdSizes = []
-fgdSizes = []
-textSize = 0
-streamSize = 0
+def encodeJpeg(img, quality):
+    """Return `img` encoded as a JPEG with quality `quality`. The encoding is done in memory."""
+    ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    assert ok, img.shape
+    return buf.tobytes()
 
 
-def clip(img):
-    global allScales
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    h, w = gray.shape[:2]
-    y0, y1 = roiY(gray)
-    region = gray[y0:y1, :].T
-    x0, x1 = roiY(region)
+def encodeBackground(name, img, codecs, budget):
+    """Encode background `img` with each of `codecs` in turn until `budget` seconds have been
+        spent and return the smallest encoding. DCT is always tried.
+        `img` is BGR or, for gray backgrounds, single channel.
+        `name` is only used for diagnostics.
+        Returns: dict with the codec name, encoded contents and matching PDF filter and color
+            space
+    """
+    t0 = time()
+    jpg = encodeJpeg(img, jpegQuality)
+    colorSpace = deviceColorSpace(img)
+    candidates = [('DCT', jpg, b'/DCTDecode', colorSpace)]
+    encoders = {
+        'Flate+DCT': lambda: (zlib.compress(jpg, 9), b'[/FlateDecode /DCTDecode]', colorSpace),
+        'palette': lambda: encodePalette(img),
+        'JPX': lambda: encodeJpx(img),
+    }
+    for codec in codecs:
+        if codec == 'DCT':
+            continue
+        if time() - t0 > budget:
+            print("encodeBackground: %s out of time. skipping %s" % (name, codec))
+            break
+        encoded = encoders[codec]()
+        if encoded is not None:
+            candidates.append((codec,) + encoded)
+
+    codec, contents, filter, colorSpace = min(candidates, key=lambda c: len(c[1]))
+    print("encodeBackground: %s %s %s -> %s %d bytes %.2f sec" % (name,
+          ['%s=%d' % (c[0], len(c[1])) for c in candidates], img.shape, codec, len(contents),
+          time() - t0))
+    return {'codec': codec,
+            'contents': contents,
+            'filter': filter,
+            'colorSpace': colorSpace,
+            }
+
+
+def deviceColorSpace(img):
+    """Return the PDF device color space of BGR or single channel image `img`."""
+    return b'/DeviceGray' if img.ndim == 2 else b'/DeviceRGB'
+
+
+def encodePalette(img):
+    """Return `img` encoded as a Flate compressed /Indexed image, or None if it has more than
+        256 colors. A gray image is its own palette so it is Flate compressed as it is.
+        Returns: contents, filter, color space
+    """
+    if img.ndim == 2:
+        return zlib.compress(img.tobytes(), 9), b'/FlateDecode', b'/DeviceGray'
+    # Pack BGR pixels into 24 bit RGB values.
+    packed = ((img[:, :, 2].astype(np.uint32) << 16) |
+              (img[:, :, 1].astype(np.uint32) << 8) |
+              img[:, :, 0].astype(np.uint32))
+    # A subsample rejects most images with many colors cheaply.
+    if len(np.unique(packed[::8, ::8])) > 256:
+        return None
+    colors, indexes = np.unique(packed, return_inverse=True)
+    if len(colors) > 256:
+        return None
+    palette = b''.join(struct.pack('>I', int(c))[1:] for c in colors)
+    colorSpace = b'[/Indexed /DeviceRGB %d <%s>]' % (len(colors) - 1, palette.hex().encode('ascii'))
+    contents = zlib.compress(indexes.astype(np.uint8).tobytes(), 9)
+    return contents, b'/FlateDecode', colorSpace
+
+
+def encodeJpx(img):
+    """Return `img` encoded as JPEG 2000, or None if OpenCV can't encode JPEG 2000.
+        Returns: contents, filter, color space
+    """
+    try:
+        ok, buf = cv2.imencode('.jp2', img, [cv2.IMWRITE_JPEG2000_COMPRESSION_X1000, jpxCompression])
+    except cv2.error as e:
+        print("encodeJpx: %s" % e, file=sys.stderr)
+        return None
+    if not ok:
+        return None
+    return buf.tobytes(), b'/JPXDecode', deviceColorSpace(img)
+
+
+# Background encoding.
+# jpegQuality: JPEG quality of the DCT background
+# jpxCompression: JPEG 2000 compression ratio x 1000. Smaller values give smaller files
+allCodecs = ['DCT', 'Flate+DCT', 'palette', 'JPX']
+jpegQuality = 25
+jpxCompression = 5
+
+# Background resolution.
+# autoDpiChoices: background DPIs that are tried, lowest first, when the DPI is chosen per page
+# autoDpiTolerance: max mean absolute gray level error of the chosen DPI
+autoDpiChoices = [75, 100, 150]
+autoDpiTolerance = 2.0
+
+# Background kinds.
+# grayTolerance: max difference between the channels of a pixel in a gray background
+bgdKinds = ['color', 'gray', 'blank', 'missing']
+grayTolerance = 8
+
+# Deskew.
+# Skew is searched in +/- deskewMaxAngle degrees, first every deskewStep degrees then every
+# deskewFineStep degrees, on a page shrunk to deskewWidth pixels wide. Pages skewed by less than
+# deskewMinAngle degrees are left alone.
+deskewMaxAngle = 5.0
+deskewStep = 0.5
+deskewFineStep = 0.05
+deskewMinAngle = 0.1
+deskewWidth = 800
+
+# BgdParams are the background encoding parameters that are passed to the worker processes.
+#   keepJpeg: write the background JPEGs to files for debugging
+#   codecs: candidate background codecs. The smallest encoding is used
+#   codecBudget: seconds per page to spend trying codecs
+#   dpi: background resolution. 0 for the raster resolution
+#   autoDpi: choose the background resolution for each page from autoDpiChoices
+#   force: clip and encode the background even if the cached results are up to date
+BgdParams = namedtuple('BgdParams', ['keepJpeg', 'codecs', 'codecBudget', 'dpi', 'autoDpi',
+                                     'force'])
+defaultBgdParams = BgdParams(keepJpeg=False, codecs=allCodecs, codecBudget=1.0, dpi=0,
+                             autoDpi=False, force=False)
+
+
+def clip(img, width=None, height=None):
+    """Clip the white margins from `img`.
+        `img` is placed at the top left of a white `width` x `height` page. This is how
+        backgrounds that are smaller than their JBIG2 page are padded, so there is no need to pad
+        them before clipping.
+        Returns: view of `img` clipped to its non-white pixels, cm operator that places it on the
+            page, fraction of page area kept
+    """
+    h, w = img.shape[:2]
+    if width is None:
+        width = w
+    if height is None:
+        height = h
+    x0, x1, y0, y1 = contentBox(img)
 
-    print("-- x0=%d x1=%d w=%d" % (x0, x1, w))
-    print("-- y0=%d y1=%d h=%d" % (y0, y1, h))
+    print("-- x0=%d x1=%d w=%d" % (x0, x1, width))
+    print("-- y0=%d y1=%d h=%d" % (y0, y1, height))
 
     img = img[y0:y1, x0:x1]
 
-    scaleX = (x1 - x0) / w
-    scaleY = (y1 - y0) / h
-    dx = x0 / w
-    dy = (h-y1) / h
+    scaleX = (x1 - x0) / width
+    scaleY = (y1 - y0) / height
+    dx = x0 / width
+    dy = (height - y1) / height
     m = b'%f 0 0 %f %f %f cm' % (scaleX, scaleY, dx, dy)
 
     print("-- scale = %.2f x %.2f = %.2f" % (scaleX, scaleY, scaleX * scaleY))
-    allScales.append(scaleX * scaleY)
     print("-- m=%s" % m)
-    return img, m
+    return img, m, scaleX * scaleY
 
 
-def roiY(gray):
-    h, w = gray.shape[:2]
-    y0 = 0
-    for y in range(h):
-        if any(gray[y, :] != 255):
-            break
-        y0 = y + 1
-    y1 = 0
-    for y in range(h-1, y0, -1):
-        if any(gray[y, :] != 255):
-            break
-        y1 = y
+def contentBox(img):
+    """Return the bounding box x0, x1, y0, y1 of the non-white pixels in `img`.
+        The box is half-open: x0 <= x < x1, y0 <= y < y1. It is empty if `img` is all white.
+        A single non-white mask is built and reduced along each axis.
+    """
+    if img.ndim == 3:
+        mask = img.min(axis=2) != 255
+    else:
+        mask = img != 255
+    x0, x1 = span(mask.any(axis=0))
+    y0, y1 = span(mask.any(axis=1))
+    return x0, x1, y0, y1
+
 
-    # print("** y0=%d y1=%d h=%d w=%d" % (y0, y1, h, w))
-    return y0, y1
+def span(occupied):
+    """Return the half-open range i0, i1 from the first to the last True element of 1D boolean
+        array `occupied`. The range is empty (i0 == i1 == len(occupied)) if there are no True
+        elements.
+    """
+    n = len(occupied)
+    # Appending a True sentinel makes argmax return n for an all False array.
+    i0 = int(np.argmax(np.append(occupied, True)))
+    i1 = n - int(np.argmax(np.append(occupied[::-1], True)))
+    return i0, max(i0, i1)
 
 
 def readFile(filename):
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+   Keep a history of compression results in a SQLite database and flag regressions between runs.
+
+   A run records
+     - the size of each variant of each segmented PDF in a directory created by segment.go
+       (and its PSNR/SSIM when recorded by compression.py -q -H)
+     - the PDF and raster sizes and stage timings in connected.py *.metrics.json files
+
+   e.g. python history.py ingest -l baseline -p jpegQuality=25 pdf.output
+        python history.py ingest -l q50 -p jpegQuality=50 pdf.output
+        python history.py runs
+        python history.py regressions -b baseline q50
+        python compression.py -H history.sqlite pdf.output     # record a run while reporting
+"""
+import os
+import argparse
+import json
+import sqlite3
+import sys
+import time
+from compare import scanSizes, suffixes, suffixMasked, suffixPng
+from metrics import expandFiles, loadMetrics
+
+
+defaultDb = "history.sqlite"
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    label TEXT,
+    root TEXT,
+    params TEXT
+);
+CREATE TABLE IF NOT EXISTS sizes (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    file TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    size REAL NOT NULL,
+    psnr REAL,
+    ssim REAL,
+    PRIMARY KEY (run, file, variant)
+);
+CREATE TABLE IF NOT EXISTS times (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    file TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (run, file, stage)
+);
+"""
+
+# connected.py documents are recorded as these variants. Their ratio is pdf / rasters.
+variantPdf = "connected.pdf"
+variantRasters = "rasters"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--db", default=defaultDb, help="history database")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("ingest", help="record a run of all the paths")
+    p.add_argument("paths", nargs="+",
+                   help="segment.go output directories and/or connected.py metrics files or "
+                        "directories")
+    p.add_argument("-l", "--label", help="name of the run")
+    p.add_argument("-p", "--param", action="append", default=[],
+                   help="key=value parameter of the run. May be repeated")
+
+    sub.add_parser("runs", help="list the recorded runs")
+
+    p = sub.add_parser("regressions",
+                       help="flag files that got worse in a run compared to a baseline run")
+    p.add_argument("run", nargs="?", default=None,
+                   help="run id or label to check. Default is the latest run")
+    p.add_argument("-b", "--baseline", default=None,
+                   help="run id or label to compare against. Default is the run before `run`")
+    p.add_argument("-t", "--threshold", type=float, default=0.02,
+                   help="flag size ratios that grew by more than this fraction")
+    p.add_argument("-T", "--time-threshold", type=float, default=0.25,
+                   help="flag stage times that grew by more than this fraction")
+    p.add_argument("-m", "--min-seconds", type=float, default=1.0,
+                   help="ignore stage time increases smaller than this")
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    db = openDb(args.db)
+    if args.command == "ingest":
+        params = dict(kv.split("=", 1) for kv in args.param)
+        runId = ingest(db, args.paths, args.label, params)
+        print("Recorded run %d: %s" % (runId, " ".join(args.paths)))
+    elif args.command == "runs":
+        listRuns(db)
+    elif args.command == "regressions":
+        run = findRun(db, args.run)
+        baseline = findRun(db, args.baseline) if args.baseline else previousRun(db, run)
+        numFlagged = regressions(db, baseline, run, args.threshold, args.time_threshold,
+                                 args.min_seconds)
+        sys.exit(1 if numFlagged else 0)
+
+
+def openDb(path):
+    db = sqlite3.connect(path)
+    db.executescript(schema)
+    return db
+
+
+def recordRun(db, root, label, params, sizes, quality=None, times=None):
+    """Add a run to history database `db`.
+        `sizes`: {file: {variant: size in MB}}
+        `quality`: {file: {variant: {'psnr', 'ssim'}}} or None
+        `times`: {file: {stage: seconds}} or None
+        Returns: the id of the new run
+    """
+    quality = quality or {}
+    times = times or {}
+    with db:
+        cur = db.execute("INSERT INTO runs (created, label, root, params) VALUES (?, ?, ?, ?)",
+                         (time.time(), label, root, json.dumps(params, sort_keys=True)))
+        runId = cur.lastrowid
+        db.executemany("INSERT INTO sizes VALUES (?, ?, ?, ?, ?, ?)",
+                       [(runId, fn, variant, size,
+                         quality.get(fn, {}).get(variant, {}).get('psnr'),
+                         quality.get(fn, {}).get(variant, {}).get('ssim'))
+                        for fn, row in sizes.items()
+                        for variant, size in row.items()])
+        db.executemany("INSERT INTO times VALUES (?, ?, ?, ?)",
+                       [(runId, fn, stage, dt)
+                        for fn, row in times.items()
+                        for stage, dt in row.items()])
+    return runId
+
+
+def ingest(db, paths, label, params):
+    """Record one run of the segment.go PDFs and/or connected.py metrics files in `paths`.
+        connected.py documents are recorded under their PDF file names, as the .bgd and .fgd
+        variants of a document share its name.
+    """
+    sizes = {}
+    times = {}
+
+    def add(fn, row, where):
+        assert fn not in sizes, "%s is in %s and an earlier path" % (fn, where)
+        sizes[fn] = row
+
+    for path in paths:
+        if os.path.isdir(path):
+            for base, row in scanSizes(path).items():
+                add(base, {suffix: row[suffix] for suffix in suffixes}, path)
+        for fn in expandFiles([path]):
+            m = loadMetrics(fn)
+            name = os.path.basename(m['pdfPath'])
+            add(name, {variantPdf: m['sizes']['pdf'] / 1e6,
+                       variantRasters: m['sizes']['rasters'] / 1e6}, fn)
+            times[name] = m['times']
+    assert sizes, "No segment.go PDFs or connected.py metrics in %s" % paths
+    root = " ".join(os.path.abspath(path) for path in paths)
+    return recordRun(db, root, label, params, sizes, times=times)
+
+
+def listRuns(db):
+    rows = db.execute("""SELECT r.id, r.created, r.label, r.root, r.params,
+                                (SELECT COUNT(DISTINCT file) FROM sizes WHERE run = r.id)
+                         FROM runs r ORDER BY r.id""").fetchall()
+    print("%5s %19s %6s %-12s %s" % ("run", "created", "files", "label", "root params"))
+    for runId, created, label, root, params, numFiles in rows:
+        print("%5d %19s %6d %-12s %s %s" % (runId,
+              time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)), numFiles,
+              label or "", root, params))
+
+
+def findRun(db, run):
+    """Return the id of the run with id or label `run`. The latest run if `run` is None. A label
+        refers to the latest run with that label.
+    """
+    if run is None:
+        row = db.execute("SELECT MAX(id) FROM runs").fetchone()
+    elif run.isdigit():
+        row = db.execute("SELECT id FROM runs WHERE id = ?", (int(run),)).fetchone()
+    else:
+        row = db.execute("SELECT MAX(id) FROM runs WHERE label = ?", (run,)).fetchone()
+    assert row and row[0] is not None, "No run %r" % run
+    return row[0]
+
+
+def previousRun(db, run):
+    row = db.execute("SELECT MAX(id) FROM runs WHERE id < ?", (run,)).fetchone()
+    assert row[0] is not None, "No run before run %d" % run
+    return row[0]
+
+
+def fileRatios(db, run):
+    """Returns: {file: size ratio} for run `run`. The ratio is masked / png for segment.go PDFs
+        and pdf / rasters for connected.py documents.
+    """
+    ratios = {}
+    for num, den in ((suffixMasked, suffixPng), (variantPdf, variantRasters)):
+        rows = db.execute("""SELECT a.file, a.size / b.size FROM sizes a JOIN sizes b
+                             ON a.run = b.run AND a.file = b.file
+                             WHERE a.run = ? AND a.variant = ? AND b.variant = ? AND b.size > 0""",
+                          (run, num, den))
+        ratios.update(rows)
+    return ratios
+
+
+def stageTimes(db, run):
+    """Returns: {(file, stage): seconds} for run `run`."""
+    rows = db.execute("SELECT file, stage, seconds FROM times WHERE run = ?", (run,))
+    return {(fn, stage): dt for fn, stage, dt in rows}
+
+
+def regressions(db, baseline, run, threshold, timeThreshold, minSeconds):
+    """Print the files in run `run` whose size ratio grew by more than `threshold` or whose stage
+        times grew by more than `timeThreshold` (and `minSeconds`) compared to run `baseline`.
+        Returns: number of regressions
+    """
+    print("Run %d vs baseline run %d" % (run, baseline))
+    baseRatios = fileRatios(db, baseline)
+    ratios = fileRatios(db, run)
+    common = sorted(set(baseRatios) & set(ratios))
+    flagged = [(ratios[fn] / baseRatios[fn] - 1.0, fn) for fn in common
+               if ratios[fn] > baseRatios[fn] * (1.0 + threshold)]
+    flagged.sort(key=lambda x: (-x[0], x[1]))
+    print("Size ratio: %d of %d files regressed by more than %.1f%%" % (len(flagged), len(common),
+          100.0 * threshold))
+    for change, fn in flagged:
+        print("  %+6.1f%% %6.3f -> %6.3f %s" % (100.0 * change, baseRatios[fn], ratios[fn], fn))
+
+    baseTimes = stageTimes(db, baseline)
+    times = stageTimes(db, run)
+    commonTimes = sorted(set(baseTimes) & set(times))
+    slow = [(times[k] / baseTimes[k] - 1.0 if baseTimes[k] else float('inf'), k)
+            for k in commonTimes
+            if times[k] > baseTimes[k] * (1.0 + timeThreshold) and
+            times[k] - baseTimes[k] >= minSeconds]
+    slow.sort(key=lambda x: (-x[0], x[1]))
+    print("Stage times: %d of %d regressed by more than %.1f%%" % (len(slow), len(commonTimes),
+          100.0 * timeThreshold))
+    for change, (fn, stage) in slow:
+        print("  %+6.1f%% %7.1f -> %7.1f sec %-10s %s" % (100.0 * change, baseTimes[(fn, stage)],
+              times[(fn, stage)], stage, fn))
+
+    missing = sorted((set(baseRatios) - set(ratios)) | (set(ratios) - set(baseRatios)))
+    if missing:
+        print("%d files are in only one of the runs" % len(missing))
+    return len(flagged) + len(slow)
+
+
+if __name__ == '__main__':
+    main()
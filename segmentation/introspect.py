@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+"""
+   Report how the bytes of PDF files are spent, page by page, without rendering them.
+
+   The file is read through its cross-reference table(s) or stream(s). Only object dictionaries
+   are parsed. Stream data is never read, apart from cross-reference and object streams, so
+   the cost is a few small reads per object.
+
+   The size of an object is the distance from its offset to the next object (or xref section)
+   in the file. Each object is charged to the first page that uses it, in one of these categories
+        images:  image XObjects, including JBIG2 global symbol dictionaries and ICC profiles
+        masks:   /SMask and /Mask images and /ImageMask images (e.g. JBIG2 text layers)
+        content: page content streams and form XObjects
+        fonts:   fonts and everything they refer to (descriptors, font files, widths, cmaps)
+        other:   page objects, resource dictionaries, graphics states, patterns, etc.
+   Bytes not charged to any page (header, catalog, page tree, xref, unused objects) are overhead.
+
+   e.g. python introspect.py pdf.output/doc.masked.pdf
+        python introspect.py -p -j sizes.json pdf.output
+"""
+import os
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+import argparse
+import json
+import re
+import zlib
+
+
+categories = ['images', 'masks', 'content', 'fonts', 'other']
+
+# Read object dictionaries in chunks of this many bytes.
+CHUNK = 1 << 14
+
+SKIP = re.compile(rb'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*')
+REGULAR = re.compile(rb'[^\x00\t\n\x0c\r ()<>\[\]{}/%]+')
+NUMBER = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)$')
+OBJ = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b')
+REF_TAIL = re.compile(rb'\s+(\d+)\s+R\b')
+STREAM = re.compile(rb'\s*stream(\r\n|\n|\r)')
+STARTXREF = re.compile(rb'startxref\s+(\d+)')
+XREF_ENTRY = re.compile(rb'(\d{10}) (\d{5}) ([nf])')
+
+
+class Ref(namedtuple('Ref', 'num gen')):
+    pass
+
+
+class Name(str):
+    pass
+
+
+class Stream(dict):
+    """A stream's dictionary. `offset` is the file offset of the stream data."""
+    def __init__(self, d, offset):
+        super().__init__(d)
+        self.offset = offset
+
+
+class Truncated(Exception):
+    """The bytes being parsed end before the object does."""
+
+
+class Parser:
+    """Parser for PDF objects in `data`, starting at `pos`. Stream data is not parsed."""
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def skip(self):
+        self.pos = SKIP.match(self.data, self.pos).end()
+        if self.pos >= len(self.data):
+            raise Truncated()
+
+    def parse(self):
+        """Return the next object in `data`."""
+        self.skip()
+        data = self.data
+        c = data[self.pos:self.pos + 1]
+        if c == b'/':
+            m = REGULAR.match(data, self.pos + 1)
+            self.pos = m.end() if m else self.pos + 1
+            return Name((m.group(0) if m else b'').decode('latin-1'))
+        if data.startswith(b'<<', self.pos):
+            self.pos += 2
+            d = {}
+            while True:
+                self.skip()
+                if data.startswith(b'>>', self.pos):
+                    self.pos += 2
+                    return d
+                key = self.parse()
+                d[key] = self.parse()
+        if c == b'[':
+            self.pos += 1
+            a = []
+            while True:
+                self.skip()
+                if data.startswith(b']', self.pos):
+                    self.pos += 1
+                    return a
+                a.append(self.parse())
+        if c == b'<':
+            end = data.find(b'>', self.pos)
+            if end < 0:
+                raise Truncated()
+            s = data[self.pos + 1:end]
+            self.pos = end + 1
+            return s
+        if c == b'(':
+            return self.parseString()
+        m = REGULAR.match(data, self.pos)
+        assert m, "Unexpected %r at %d" % (data[self.pos:self.pos + 20], self.pos)
+        self.pos = m.end()
+        tok = m.group(0)
+        if NUMBER.match(tok):
+            if b'.' in tok:
+                return float(tok)
+            # An integer may be the start of a reference "num gen R".
+            save = self.pos
+            r = REF_TAIL.match(data, self.pos)
+            if r:
+                self.pos = r.end()
+                return Ref(int(tok), int(r.group(1)))
+            self.pos = save
+            return int(tok)
+        if tok == b'true':
+            return True
+        if tok == b'false':
+            return False
+        if tok == b'null':
+            return None
+        return tok
+
+    def parseString(self):
+        data = self.data
+        depth = 0
+        i = self.pos
+        while i < len(data):
+            c = data[i]
+            if c == 0x5c:  # backslash
+                i += 2
+                continue
+            if c == 0x28:
+                depth += 1
+            elif c == 0x29:
+                depth -= 1
+                if depth == 0:
+                    s = data[self.pos + 1:i]
+                    self.pos = i + 1
+                    return s
+            i += 1
+        raise Truncated()
+
+
+class PdfFile:
+    """A PDF file read through its cross-reference data.
+        offsets: {object number: file offset} of uncompressed objects
+        compressed: {object number: (object stream number, index)}
+        sizes: {object number: bytes in the file}
+        trailer: the newest trailer dictionary
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.size = os.path.getsize(path)
+        self.offsets = {}
+        self.compressed = {}
+        self.trailer = None
+        self.cache = {}
+        self.objStreams = {}
+        xrefOffsets = self.readXrefs()
+
+        # Each uncompressed object ends where the next object or xref section starts.
+        bounds = sorted(set(self.offsets.values()) | set(xrefOffsets) | {self.size})
+        nextBound = {b: bounds[i + 1] for i, b in enumerate(bounds[:-1])}
+        self.sizes = {num: nextBound[offset] - offset for num, offset in self.offsets.items()}
+
+    def close(self):
+        self.f.close()
+
+    def read(self, offset, n):
+        self.f.seek(offset)
+        return self.f.read(n)
+
+    def readXrefs(self):
+        """Read the xref sections from the last one back through the /Prev chain.
+            Returns: the offsets of the xref sections
+        """
+        tail = self.read(max(0, self.size - 1024), 1024)
+        m = None
+        for m in STARTXREF.finditer(tail):
+            pass
+        assert m, "%s: no startxref" % self.path
+        offset = int(m.group(1))
+        seen = []
+        while offset is not None and offset not in seen:
+            seen.append(offset)
+            head = self.read(offset, 4)
+            if head == b'xref':
+                trailer = self.readXrefTable(offset)
+                if 'XRefStm' in trailer:
+                    seen.append(trailer['XRefStm'])
+                    self.readXrefStream(trailer['XRefStm'])
+            else:
+                trailer = self.readXrefStream(offset)
+            if self.trailer is None:
+                self.trailer = trailer
+            offset = trailer.get('Prev')
+        return seen
+
+    def addEntry(self, num, entry):
+        """Record the xref `entry` for object `num` unless a newer section already has."""
+        if num in self.offsets or num in self.compressed:
+            return
+        kind, a, b = entry
+        if kind == 1:
+            self.offsets[num] = a
+        elif kind == 2:
+            self.compressed[num] = (a, b)
+        else:
+            # Free. Mark it so older sections don't resurrect it.
+            self.compressed[num] = None
+
+    def readXrefTable(self, offset):
+        self.f.seek(offset)
+        line = self.f.readline()
+        assert line.startswith(b'xref'), line
+        while True:
+            line = self.f.readline()
+            if not line.strip():
+                continue
+            if line.startswith(b'trailer'):
+                break
+            start, count = (int(x) for x in line.split()[:2])
+            entries = XREF_ENTRY.findall(self.f.read(count * 20))
+            assert len(entries) == count, (start, count, len(entries))
+            for i, (off, gen, kind) in enumerate(entries):
+                self.addEntry(start + i, (1 if kind == b'n' else 0, int(off), int(gen)))
+        pos = self.f.tell() - len(line) + len(b'trailer')
+        return self.parseAt(pos)
+
+    def readXrefStream(self, offset):
+        d, data = self.readStreamAt(offset)
+        widths = d['W']
+        index = d.get('Index', [0, d['Size']])
+        rowLen = sum(widths)
+        row = 0
+        for start, count in zip(index[0::2], index[1::2]):
+            for num in range(start, start + count):
+                fields = []
+                pos = row * rowLen
+                for w in widths:
+                    fields.append(int.from_bytes(data[pos:pos + w], 'big') if w else None)
+                    pos += w
+                kind = 1 if fields[0] is None else fields[0]
+                self.addEntry(num, (kind, fields[1], fields[2] or 0))
+                row += 1
+        return d
+
+    def parseAt(self, offset):
+        """Return the object that starts at file `offset`, reading as much as it needs."""
+        n = CHUNK
+        while True:
+            data = self.read(offset, n)
+            try:
+                return Parser(data).parse()
+            except Truncated:
+                if len(data) < n:
+                    raise
+                n *= 4
+
+    def readObjectAt(self, offset):
+        """Return the object whose "num gen obj" header is at `offset`. For a stream, a Stream of
+            its dictionary.
+        """
+        n = CHUNK
+        while True:
+            data = self.read(offset, n)
+            m = OBJ.match(data)
+            assert m, "%s: no object at %d" % (self.path, offset)
+            p = Parser(data, m.end())
+            try:
+                value = p.parse()
+                if isinstance(value, dict):
+                    m2 = STREAM.match(data, p.pos)
+                    if m2:
+                        return Stream(value, offset + m2.end())
+                    if p.pos + 16 >= len(data) and len(data) == n:
+                        raise Truncated()
+                return value
+            except Truncated:
+                if len(data) < n:
+                    raise
+                n *= 4
+
+    def readStreamAt(self, offset):
+        """Return the dictionary and decoded data of the stream object at `offset`."""
+        d = self.readObjectAt(offset)
+        assert isinstance(d, Stream), "%s: no stream at %d" % (self.path, offset)
+        length = self.resolve(d['Length'])
+        data = self.read(d.offset, length)
+        return d, decode(d, data)
+
+    def object(self, num):
+        """Return the value of object `num`."""
+        if num in self.cache:
+            return self.cache[num]
+        if num in self.offsets:
+            value = self.readObjectAt(self.offsets[num])
+        elif self.compressed.get(num):
+            stmNum, index = self.compressed[num]
+            value = self.objectStream(stmNum)[index][1]
+        else:
+            value = None
+        self.cache[num] = value
+        return value
+
+    def objectStream(self, stmNum):
+        """Return [(object number, value, share of the stream's bytes)] of object stream `stmNum`."""
+        if stmNum not in self.objStreams:
+            d, data = self.readStreamAt(self.offsets[stmNum])
+            first = d['First']
+            header = [int(x) for x in data[:first].split()]
+            nums = header[0::2]
+            offs = header[1::2] + [len(data) - first]
+            objs = []
+            for i, num in enumerate(nums):
+                value = Parser(data, first + offs[i]).parse()
+                share = self.sizes[stmNum] * (offs[i + 1] - offs[i]) / max(1, len(data) - first)
+                objs.append((num, value, share))
+            self.objStreams[stmNum] = objs
+        return self.objStreams[stmNum]
+
+    def objectSize(self, num):
+        """Return the number of bytes object `num` takes in the file."""
+        if num in self.sizes:
+            return self.sizes[num]
+        if self.compressed.get(num):
+            stmNum, index = self.compressed[num]
+            return self.objectStream(stmNum)[index][2]
+        return 0
+
+    def resolve(self, value):
+        while isinstance(value, Ref):
+            value = self.object(value.num)
+        return value
+
+
+def decode(d, data):
+    filters = d.get('Filter', [])
+    if not isinstance(filters, list):
+        filters = [filters]
+    assert all(f == 'FlateDecode' for f in filters), "Unsupported filter %s" % filters
+    for _ in filters:
+        data = zlib.decompress(data)
+    parms = d.get('DecodeParms') or {}
+    if isinstance(parms, list):
+        parms = parms[0] or {}
+    predictor = parms.get('Predictor', 1)
+    if predictor >= 10:
+        data = unpredict(data, parms.get('Columns', 1) * parms.get('Colors', 1) *
+                         parms.get('BitsPerComponent', 8) // 8)
+    return data
+
+
+def unpredict(data, columns):
+    """Undo the PNG predictors on `data`, which has rows of `columns` bytes (plus a type byte)."""
+    out = bytearray()
+    prev = bytearray(columns)
+    for i in range(0, len(data), columns + 1):
+        kind = data[i]
+        row = bytearray(data[i + 1:i + 1 + columns])
+        for j in range(len(row)):
+            left = row[j - 1] if j else 0
+            up = prev[j]
+            if kind == 1:
+                row[j] = (row[j] + left) & 0xff
+            elif kind == 2:
+                row[j] = (row[j] + up) & 0xff
+            elif kind == 3:
+                row[j] = (row[j] + (left + up) // 2) & 0xff
+            elif kind == 4:
+                upLeft = prev[j - 1] if j else 0
+                p = left + up - upLeft
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - upLeft)
+                pred = left if pa <= pb and pa <= pc else up if pb <= pc else upLeft
+                row[j] = (row[j] + pred) & 0xff
+        out += row
+        prev = row
+    return bytes(out)
+
+
+class PageSizes:
+    """Charges the objects of `pdf` to its pages."""
+    def __init__(self, pdf):
+        self.pdf = pdf
+        self.owner = {}
+        self.users = {}
+        self.pages = []
+
+    def charge(self, value, category, pageIndex):
+        """Charge `value` to page `pageIndex` if it is an indirect object. Returns its value."""
+        if isinstance(value, Ref):
+            users = self.users.setdefault(value.num, set())
+            users.add(pageIndex)
+            if value.num not in self.owner:
+                self.owner[value.num] = pageIndex
+                self.pages[pageIndex][category] += self.pdf.objectSize(value.num)
+        return self.pdf.resolve(value)
+
+    def chargeAll(self, value, category, pageIndex, seen=None):
+        """Charge `value` and everything it refers to, except pages, to page `pageIndex`."""
+        seen = set() if seen is None else seen
+        if isinstance(value, Ref):
+            if value.num in seen:
+                return
+            seen.add(value.num)
+        value = self.charge(value, category, pageIndex)
+        if isinstance(value, dict):
+            if value.get('Type') in ('Page', 'Pages'):
+                return
+            for k, v in value.items():
+                if k not in ('Parent', 'P'):
+                    self.chargeAll(v, category, pageIndex, seen)
+        elif isinstance(value, list):
+            for v in value:
+                self.chargeAll(v, category, pageIndex, seen)
+
+    def walk(self):
+        root = self.pdf.resolve(self.pdf.trailer['Root'])
+        for page, resources in self.pageTree(root['Pages'], None, set()):
+            i = len(self.pages)
+            self.pages.append({cat: 0 for cat in categories})
+            page = self.charge(page, 'other', i)
+            contents = self.charge(page.get('Contents'), 'content', i)
+            if isinstance(contents, list):
+                for c in contents:
+                    self.charge(c, 'content', i)
+            self.resources(resources, i, set())
+
+    def pageTree(self, node, resources, seen):
+        """Yield (page ref, inherited resources) for the pages under page tree `node`."""
+        if node.num in seen:
+            return
+        seen.add(node.num)
+        d = self.pdf.resolve(node)
+        resources = d.get('Resources', resources)
+        if d.get('Type') == 'Pages' or 'Kids' in d:
+            for kid in self.pdf.resolve(d.get('Kids', [])):
+                yield from self.pageTree(kid, resources, seen)
+        else:
+            yield node, resources
+
+    def resources(self, value, i, seen):
+        if isinstance(value, Ref):
+            if value.num in seen:
+                return
+            seen.add(value.num)
+        res = self.charge(value, 'other', i)
+        if not isinstance(res, dict):
+            return
+        for name, xobj in (self.charge(res.get('XObject'), 'other', i) or {}).items():
+            self.xobject(xobj, i, seen)
+        for name, font in (self.charge(res.get('Font'), 'fonts', i) or {}).items():
+            self.chargeAll(font, 'fonts', i)
+        for key in ('ExtGState', 'ColorSpace', 'Pattern', 'Shading', 'Properties'):
+            self.chargeAll(res.get(key), 'other', i)
+
+    def xobject(self, ref, i, seen):
+        if isinstance(ref, Ref) and ref.num in self.owner:
+            self.users.setdefault(ref.num, set()).add(i)
+            return
+        d = self.pdf.resolve(ref)
+        if not isinstance(d, dict):
+            return
+        if d.get('Subtype') == 'Form':
+            self.charge(ref, 'content', i)
+            self.resources(d.get('Resources'), i, seen)
+            return
+        self.charge(ref, 'masks' if d.get('ImageMask') else 'images', i)
+        for key in ('SMask', 'Mask'):
+            if isinstance(d.get(key), Ref):
+                self.chargeAll(d[key], 'masks', i)
+        parms = self.pdf.resolve(d.get('DecodeParms'))
+        if isinstance(parms, list):
+            parms = parms[0]
+        if isinstance(parms, dict):
+            self.chargeAll(parms.get('JBIG2Globals'), 'images', i)
+        self.chargeAll(d.get('ColorSpace'), 'images', i)
+
+
+def pageCount(path):
+    """Return the number of pages in PDF file `path`, the /Count of its page tree."""
+    pdf = PdfFile(path)
+    try:
+        root = pdf.resolve(pdf.trailer['Root'])
+        return pdf.resolve(pdf.resolve(root['Pages'])['Count'])
+    finally:
+        pdf.close()
+
+
+def introspect(path):
+    """Return a dict describing the bytes used per page by category in PDF file `path`."""
+    pdf = PdfFile(path)
+    try:
+        ps = PageSizes(pdf)
+        ps.walk()
+    finally:
+        pdf.close()
+    charged = sum(sum(pg.values()) for pg in ps.pages)
+    shared = sum(pdf.objectSize(num) for num, users in ps.users.items() if len(users) > 1)
+    return {
+        'path': path,
+        'size': pdf.size,
+        'numObjects': len(pdf.offsets) + sum(1 for v in pdf.compressed.values() if v),
+        'pages': [{cat: int(round(n)) for cat, n in pg.items()} for pg in ps.pages],
+        'shared': int(round(shared)),
+        'overhead': int(round(pdf.size - charged)),
+    }
+
+
+def introspectFiles(paths, numWorkers=1):
+    """Return {path: introspect(path)} for `paths`, introspected concurrently."""
+    with ProcessPoolExecutor(max_workers=max(1, numWorkers)) as executor:
+        return dict(zip(paths, executor.map(introspect, paths)))
+
+
+def totals(info):
+    """Return the {category: bytes} totals over the pages of introspect() result `info`."""
+    total = {cat: 0 for cat in categories}
+    for pg in info['pages']:
+        for cat in categories:
+            total[cat] += pg[cat]
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="PDF files or directories containing PDF files")
+    parser.add_argument("-p", "--pages", action="store_true", help="report every page")
+    parser.add_argument("-j", "--json", help="also write the results to this JSON file")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="number of files to introspect concurrently")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.files:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob(os.path.join(path, "*.pdf"))))
+        else:
+            paths.append(path)
+    results = introspectFiles(paths, args.workers)
+
+    header = "%5s %9s %9s %9s %9s %9s" % tuple(["pages"] + categories)
+    print("%6s %s %9s %9s %9s  %s" % ("", header, "shared", "overhead", "total", "name"))
+    for i, path in enumerate(paths):
+        info = results[path]
+        tot = totals(info)
+        print("%6d: %5d %s %9d %9d %9d  %s" % (i, len(info['pages']),
+              " ".join("%9d" % tot[cat] for cat in categories), info['shared'],
+              info['overhead'], info['size'], path))
+        if args.pages:
+            for j, pg in enumerate(info['pages']):
+                print("%6s  %5d %s %9s %9s %9d" % ("", j + 1,
+                      " ".join("%9d" % pg[cat] for cat in categories), "", "",
+                      sum(pg.values())))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+        print("Wrote %s" % args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+"""
+    Linearize (fast web view) PDF files written by connected.py's Doc.
+
+    A linearized PDF starts with a linearization dictionary, a cross-reference table for the
+    first page, a hint stream and then everything needed to show the first page. A viewer reading
+    the file over HTTP can display page 1 as soon as that section has arrived and use the hint
+    tables to fetch other pages with range requests.
+
+    linearize() is a second pass over a finished, non-linearized file. It only needs the object
+    offsets and sizes that Doc recorded while writing it, so it reads one object at a time and
+    copies stream data from the source file in chunks.
+
+    File layout (PDF 32000-1:2008 Annex F)
+        header
+        linearization dictionary
+        first-page xref and trailer
+        catalog
+        primary hint stream
+        first page: page object, its private objects, the shared objects it uses
+        remaining pages: page object, its private objects
+        shared objects not used by the first page
+        other objects: page tree, info
+        main xref and trailer
+
+    The first-page section objects are numbered after all the other objects so that the main
+    xref table is a single subsection starting at object 0.
+"""
+import re
+
+REF = re.compile(rb'(?<![\d.])(\d+) 0 R\b')
+KIDS = re.compile(rb'/Kids\s*\[([^\]]*)\]')
+PAGES = re.compile(rb'/Pages\s+(\d+) 0 R\b')
+CONTENTS = re.compile(rb'/Contents\s+(\d+) 0 R\b')
+
+# Copy stream data in chunks of this many bytes.
+CHUNK = 1 << 20
+
+EOL = b'\r\n'
+
+
+def linearize(doc, srcPath, dstPath):
+    """Write a linearized copy of `srcPath` to `dstPath`.
+        `doc` is the connected.Doc that wrote `srcPath`. Its offsets, sizes, catalogId, infoId
+        and version describe the file. It must not have used object streams.
+    """
+    assert not doc.compressed, "linearize doesn't support object streams"
+    with open(srcPath, 'rb') as src:
+        objects = readObjects(src, doc)
+        layout = Layout(objects, doc.catalogId, doc.infoId)
+        with open(dstPath, 'wb') as dst:
+            size = layout.write(src, dst, doc.version)
+    print("linearize: %s -> %s %d pages %d objects %d bytes" % (srcPath, dstPath,
+          len(layout.pageIds), len(objects), size))
+    return size
+
+
+class SrcObject:
+    """An object in the source file.
+        dict: the object's dictionary
+        refs: the object numbers `dict` refers to
+        dataOffset: offset of the data after the dictionary (stream, endobj) in the source file
+        dataLen: length of that data
+    """
+    def __init__(self, d, dataOffset, dataLen):
+        self.dict = d
+        self.refs = [int(r) for r in REF.findall(d)]
+        self.dataOffset = dataOffset
+        self.dataLen = dataLen
+
+
+def readObjects(src, doc):
+    """Return {object number: SrcObject} for the objects written by `doc` to file `src`."""
+    objects = {}
+    for objId, offset in doc.offsets.items():
+        dictLen, size = doc.sizes[objId]
+        start = offset + len(b'%d 0 obj' % objId) + len(EOL)
+        src.seek(start)
+        d = src.read(dictLen)
+        objects[objId] = SrcObject(d, start + dictLen, size - dictLen)
+    return objects
+
+
+class Layout:
+    """Layout assigns the objects in `objects` to the sections of a linearized file, renumbers
+        them and computes their offsets.
+    """
+    def __init__(self, objects, catalogId, infoId):
+        self.objects = objects
+        self.catalogId = catalogId
+        self.infoId = infoId
+        catalog = objects[catalogId].dict
+        self.pagesId = int(PAGES.search(catalog).group(1))
+        kids = KIDS.search(objects[self.pagesId].dict).group(1)
+        self.pageIds = [int(r) for r in REF.findall(kids)]
+        assert self.pageIds, "no pages"
+
+        # Objects used by each page, not counting the page tree and catalog.
+        stop = {self.pagesId, self.catalogId}
+        pageObjs = [self.reachable(pageId, stop) for pageId in self.pageIds]
+        users = {}
+        for objs in pageObjs:
+            for objId in objs:
+                users[objId] = users.get(objId, 0) + 1
+        shared = {objId for objId, n in users.items() if n > 1}
+
+        first = pageObjs[0]
+        # Part 6: first page object, its private objects, the shared objects it uses.
+        self.part6 = ([self.pageIds[0]] +
+                      [o for o in first if o != self.pageIds[0] and o not in shared] +
+                      [o for o in first if o in shared])
+        # Part 7: the other pages, each page object followed by its private objects.
+        self.pageParts = [self.part6]
+        self.part7 = []
+        for pageId, objs in zip(self.pageIds[1:], pageObjs[1:]):
+            part = [pageId] + [o for o in objs if o != pageId and o not in shared]
+            self.pageParts.append(part)
+            self.part7.extend(part)
+        # Part 8: shared objects not used by the first page.
+        firstSet = set(first)
+        self.part8 = [o for o in sorted(shared) if o not in firstSet]
+        # Part 9: everything else.
+        placed = set(self.part6) | set(self.part7) | set(self.part8) | {catalogId}
+        self.part9 = [o for o in sorted(objects) if o not in placed]
+
+        # Page references to shared objects, as indexes into the shared object hint table
+        # whose entries are the part 6 objects followed by the part 8 objects.
+        sharedIndex = {o: i for i, o in enumerate(self.part6 + self.part8)}
+        self.pageShared = [[]] + [[sharedIndex[o] for o in objs if o in shared]
+                                  for objs in pageObjs[1:]]
+        self.pageContents = []
+        for pageId in self.pageIds:
+            m = CONTENTS.search(objects[pageId].dict)
+            self.pageContents.append(int(m.group(1)) if m else None)
+
+        # Renumber. The main xref covers 0 .. numMain - 1.
+        mainIds = self.part7 + self.part8 + self.part9
+        self.numMain = len(mainIds) + 1
+        self.linId = self.numMain
+        self.hintId = self.numMain + 2
+        firstIds = [catalogId] + self.part6
+        self.newId = {o: i + 1 for i, o in enumerate(mainIds)}
+        self.newId[catalogId] = self.numMain + 1
+        for i, o in enumerate(self.part6):
+            self.newId[o] = self.numMain + 3 + i
+        self.size = self.numMain + 3 + len(self.part6)
+        self.numFirst = self.size - self.numMain
+        assert len(self.newId) == len(objects), (len(self.newId), len(objects))
+        self.firstIds = firstIds
+        self.mainIds = mainIds
+
+        # Renumbered dictionaries and serialized object lengths.
+        self.dicts = {o: REF.sub(lambda m: b'%d 0 R' % self.newId[int(m.group(1))], obj.dict)
+                      for o, obj in objects.items()}
+        self.lengths = {o: len(self.header(o)) + len(self.dicts[o]) + objects[o].dataLen +
+                        len(EOL) for o in objects}
+
+    def reachable(self, objId, stop):
+        """Return the objects reachable from `objId`, not following objects in `stop`, in
+            depth first order starting with `objId`.
+        """
+        seen = set()
+        order = []
+        todo = [objId]
+        while todo:
+            o = todo.pop()
+            if o in seen or o in stop or o not in self.objects:
+                continue
+            seen.add(o)
+            order.append(o)
+            todo.extend(reversed(self.objects[o].refs))
+        return order
+
+    def header(self, objId):
+        return b'%d 0 obj' % self.newId[objId] + EOL
+
+    def write(self, src, dst, version):
+        """Write the linearized file to `dst`, copying data from `src`. Returns the file size."""
+        head = b'%%PDF-%s' % version + EOL + b'%a\x01\x02\x8f' + EOL
+
+        # Sections before the hint stream have fixed sizes.
+        linLen = len(self.linearizationObj(0, 0, 0, 0, 0))
+        firstXrefLen = len(self.firstXref({}, 0))
+        catalogStart = len(head) + linLen + firstXrefLen
+        hintStart = catalogStart + self.lengths[self.catalogId]
+
+        # Offsets in the hint tables are computed as if there was no hint stream.
+        offsets = {self.catalogId: catalogStart}
+        pos = hintStart
+        for o in self.part6 + self.mainIds:
+            offsets[o] = pos
+            pos += self.lengths[o]
+        mainXrefNoHint = pos
+        hintData, sharedOffset = self.hintTables(offsets, mainXrefNoHint)
+        hintObj = self.hintObj(hintData, sharedOffset)
+        hintLen = len(hintObj)
+        for o in self.part6 + self.mainIds:
+            offsets[o] += hintLen
+        endOfFirstPage = hintStart + hintLen + sum(self.lengths[o] for o in self.part6)
+        mainXref = mainXrefNoHint + hintLen
+        mainXrefData = self.mainXref(offsets, len(head) + linLen)
+        fileLen = mainXref + len(mainXrefData)
+        # /T is the offset of the end of line before the first entry of the main xref table.
+        firstEntry = mainXref + len(b'xref' + EOL + b'0 %d' % self.numMain)
+
+        linObj = self.linearizationObj(fileLen, hintStart, hintLen, endOfFirstPage, firstEntry)
+        assert len(linObj) == linLen
+        offsets[None] = len(head)
+        offsets['hint'] = hintStart
+        firstXref = self.firstXref(offsets, mainXref)
+        assert len(firstXref) == firstXrefLen
+
+        pos = 0
+        for data in (head, linObj, firstXref):
+            dst.write(data)
+            pos += len(data)
+        assert pos == catalogStart, (pos, catalogStart)
+        pos += self.copyObject(src, dst, self.catalogId)
+        assert pos == hintStart, (pos, hintStart)
+        dst.write(hintObj)
+        pos += hintLen
+        for o in self.part6 + self.mainIds:
+            assert pos == offsets[o], (o, pos, offsets[o])
+            pos += self.copyObject(src, dst, o)
+        assert pos == mainXref, (pos, mainXref)
+        dst.write(mainXrefData)
+        pos += len(mainXrefData)
+        assert pos == fileLen, (pos, fileLen)
+        return pos
+
+    def copyObject(self, src, dst, o):
+        """Write renumbered object `o` to `dst`, copying its stream data from `src`."""
+        obj = self.objects[o]
+        dst.write(self.header(o))
+        dst.write(self.dicts[o])
+        src.seek(obj.dataOffset)
+        n = obj.dataLen
+        while n > 0:
+            chunk = src.read(min(n, CHUNK))
+            assert chunk, (o, n)
+            dst.write(chunk)
+            n -= len(chunk)
+        dst.write(EOL)
+        return self.lengths[o]
+
+    def linearizationObj(self, fileLen, hintStart, hintLen, endOfFirstPage, firstEntry):
+        """Return the linearization parameter dictionary object. Its numbers have fixed widths so
+            its size is known before they are.
+        """
+        d = (b'<</Linearized 1 /L %10d /H [%10d %10d] /O %d /E %10d /N %d /T %10d>>' %
+             (fileLen, hintStart, hintLen, self.newId[self.pageIds[0]], endOfFirstPage,
+              len(self.pageIds), firstEntry))
+        return b'%d 0 obj' % self.linId + EOL + d + EOL + b'endobj' + EOL
+
+    def firstXref(self, offsets, mainXref):
+        """Return the first-page xref table and trailer. `offsets` is empty when only the size is
+            needed.
+        """
+        ids = [None, self.catalogId, 'hint'] + self.part6
+        lines = [b'xref', b'%d %d' % (self.numMain, self.numFirst)]
+        for o in ids:
+            lines.append(b'%010d 00000 n' % offsets.get(o, 0))
+        lines.append(b'trailer')
+        lines.append(b'<</Size %d /Root %d 0 R /Info %d 0 R /Prev %10d>>' % (
+                     self.size, self.newId[self.catalogId], self.newId[self.infoId], mainXref))
+        lines.append(b'startxref')
+        lines.append(b'0')
+        lines.append(b'%%EOF')
+        return EOL.join(lines) + EOL
+
+    def mainXref(self, offsets, firstXref):
+        """Return the main xref table and trailer. `firstXref` is the offset of the first-page
+            xref table.
+        """
+        lines = [b'xref', b'0 %d' % self.numMain, b'0000000000 65535 f']
+        for o in self.mainIds:
+            lines.append(b'%010d 00000 n' % offsets[o])
+        lines.append(b'trailer')
+        lines.append(b'<</Size %d>>' % self.numMain)
+        lines.append(b'startxref')
+        # A linearized file's last startxref points at the first-page xref.
+        lines.append(b'%d' % firstXref)
+        lines.append(b'%%EOF')
+        return EOL.join(lines) + EOL
+
+    def hintObj(self, data, sharedOffset):
+        return (b'%d 0 obj' % self.hintId + EOL +
+                b'<</S %d /Length %d>>' % (sharedOffset, len(data)) + EOL +
+                b'stream' + EOL + data + EOL + b'endstream' + EOL + b'endobj' + EOL)
+
+    def hintTables(self, offsets, mainXref):
+        """Return the primary hint stream data and the offset of its shared object hint table.
+            `offsets` are object offsets computed as if there was no hint stream.
+        """
+        w = BitWriter()
+
+        # Page offset hint table.
+        nObjects = [len(part) for part in self.pageParts]
+        pageStarts = [offsets[part[0]] for part in self.pageParts]
+        pageLens = [sum(self.lengths[o] for o in part) for part in self.pageParts]
+        contentOffsets = []
+        contentLens = []
+        for part, start, contentId in zip(self.pageParts, pageStarts, self.pageContents):
+            # Content streams shared by several pages are not in the page's section.
+            if contentId is None or contentId not in part:
+                contentOffsets.append(0)
+                contentLens.append(0)
+            else:
+                contentOffsets.append(offsets[contentId] - start)
+                contentLens.append(self.lengths[contentId])
+        nShared = [len(s) for s in self.pageShared]
+        maxSharedId = max([i for s in self.pageShared for i in s], default=0)
+
+        minObjects, objectsBits = minBits(nObjects)
+        minLen, lenBits = minBits(pageLens)
+        minContentOffset, contentOffsetBits = minBits(contentOffsets)
+        minContentLen, contentLenBits = minBits(contentLens)
+        sharedBits = max(nShared).bit_length()
+        sharedIdBits = maxSharedId.bit_length()
+
+        w.write(minObjects, 32)
+        w.write(pageStarts[0], 32)
+        w.write(objectsBits, 16)
+        w.write(minLen, 32)
+        w.write(lenBits, 16)
+        w.write(minContentOffset, 32)
+        w.write(contentOffsetBits, 16)
+        w.write(minContentLen, 32)
+        w.write(contentLenBits, 16)
+        w.write(sharedBits, 16)
+        w.write(sharedIdBits, 16)
+        w.write(0, 16)  # numerator bits. Shared objects aren't split.
+        w.write(0, 16)  # denominator
+
+        for n in nObjects:
+            w.write(n - minObjects, objectsBits)
+        w.flush()
+        for n in pageLens:
+            w.write(n - minLen, lenBits)
+        w.flush()
+        for n in nShared:
+            w.write(n, sharedBits)
+        w.flush()
+        for s in self.pageShared:
+            for i in s:
+                w.write(i, sharedIdBits)
+        w.flush()
+        # No numerators as they have 0 bits.
+        for n in contentOffsets:
+            w.write(n - minContentOffset, contentOffsetBits)
+        w.flush()
+        for n in contentLens:
+            w.write(n - minContentLen, contentLenBits)
+        w.flush()
+
+        # Shared object hint table. The first page's objects come first, then part 8.
+        sharedOffset = len(w.data)
+        groups = self.part6 + self.part8
+        groupLens = [self.lengths[o] for o in groups]
+        minGroupLen, groupLenBits = minBits(groupLens)
+        if self.part8:
+            w.write(self.newId[self.part8[0]], 32)
+            w.write(offsets[self.part8[0]], 32)
+        else:
+            w.write(0, 32)
+            w.write(0, 32)
+        w.write(len(self.part6), 32)
+        w.write(len(groups), 32)
+        w.write(0, 16)  # bits for number of objects in a group. Groups are single objects.
+        w.write(minGroupLen, 32)
+        w.write(groupLenBits, 16)
+        for n in groupLens:
+            w.write(n - minGroupLen, groupLenBits)
+        w.flush()
+        for _ in groups:
+            w.write(0, 1)  # no MD5 signature
+        w.flush()
+        return bytes(w.data), sharedOffset
+
+
+def minBits(values):
+    """Return the least of `values` and the number of bits needed for the differences between
+        `values` and it.
+    """
+    least = min(values)
+    return least, (max(values) - least).bit_length()
+
+
+class BitWriter:
+    """BitWriter packs unsigned integers into a big endian bit stream."""
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, bits):
+        assert 0 <= value < (1 << bits) or (value == 0 and bits == 0), (value, bits)
+        self.acc = (self.acc << bits) | value
+        self.nbits += bits
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.data.append((self.acc >> self.nbits) & 0xFF)
+        self.acc &= (1 << self.nbits) - 1
+
+    def flush(self):
+        """Pad to a byte boundary."""
+        if self.nbits:
+            self.write(0, 8 - self.nbits)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+   Aggregate the *.metrics.json files written by connected.py into a throughput and compression
+   summary of a corpus.
+
+   e.g. python metrics.py *.connected.metrics.json
+        python metrics.py -j corpus.json .
+"""
+import os
+from glob import glob
+from collections import Counter
+import argparse
+import json
+from compare import percentile
+
+
+MBYTE = 1024.0 * 1024.0
+suffixMetrics = ".metrics.json"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+",
+                        help="metrics files or directories containing *%s files" % suffixMetrics)
+    parser.add_argument("-j", "--json",
+                        help="also write the corpus summary to this JSON file")
+    args = parser.parse_args()
+
+    metricsFiles = expandFiles(args.files)
+    assert metricsFiles, "no %s files in %s" % (suffixMetrics, args.files)
+    docs = [loadMetrics(fn) for fn in metricsFiles]
+    docs.sort(key=lambda m: (-m['sizes']['pdf'], m['name']))
+
+    summary = aggregate(docs)
+    report(docs, summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=1)
+        print("Wrote %s" % args.json)
+
+
+def expandFiles(paths):
+    """Return the metrics files in `paths`. Directories are searched for *.metrics.json files."""
+    metricsFiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            metricsFiles.extend(sorted(glob(os.path.join(path, "*%s" % suffixMetrics))))
+        else:
+            metricsFiles.append(path)
+    return metricsFiles
+
+
+def loadMetrics(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def aggregate(docs):
+    """Return a dict summarizing the per-document metrics dicts in `docs`."""
+    sizes = Counter()
+    times = Counter()
+    codecCounts = Counter()
+    kindCounts = Counter()
+    dpiCounts = Counter()
+    bgdTimes = []
+    numPages = 0
+    for m in docs:
+        sizes.update(m['sizes'])
+        times.update(m['times'])
+        numPages += m['numPages']
+        for st in m['pages']:
+            if st['codec'] is not None:
+                codecCounts[st['codec']] += 1
+            if st['bgdKind'] is not None:
+                kindCounts[st['bgdKind']] += 1
+            if st['dpi'] is not None:
+                dpiCounts[str(st['dpi'])] += 1
+            if st.get('dtBgd') is not None:
+                bgdTimes.append(st['dtBgd'])
+    bgdTimes.sort()
+
+    total = times['total']
+    return {
+        'numDocs': len(docs),
+        'numPages': numPages,
+        'sizes': dict(sizes),
+        'times': dict(times),
+        'ratio': sizes['pdf'] / sizes['rasters'] if sizes['rasters'] else None,
+        'pagesPerSec': numPages / total if total else None,
+        'rasterMBPerSec': sizes['rasters'] / MBYTE / total if total else None,
+        'bgdTimePercentiles': {p: percentile(bgdTimes, p) for p in (50, 90, 99)},
+        'codecs': dict(codecCounts),
+        'bgdKinds': dict(kindCounts),
+        'dpis': dict(dpiCounts),
+    }
+
+
+def report(docs, summary):
+    """Print a line per document in `docs` followed by the corpus `summary`."""
+    print("%6s %5s %8s %8s %5s %7s %7s %7s %6s  %s" % ("", "pages", "rasters", "pdf", "ratio",
+          "jbig2", "pdf", "total", "pg/s", "name"))
+    for i, m in enumerate(docs):
+        sizes = m['sizes']
+        times = m['times']
+        print("%6d: %5d %5.1f MB %5.1f MB %5.3f %5.1f s %5.1f s %5.1f s %6.2f  %s" % (i,
+              m['numPages'], sizes['rasters']/MBYTE, sizes['pdf']/MBYTE,
+              sizes['pdf'] / sizes['rasters'] if sizes['rasters'] else 0.0,
+              times['jbig2'], times['pdf'], times['total'],
+              m['numPages'] / times['total'] if times['total'] else 0.0,
+              m['name']))
+
+    sizes = summary['sizes']
+    times = summary['times']
+    total = times.get('total', 0.0)
+    print("          docs = %d" % summary['numDocs'])
+    print("         pages = %d" % summary['numPages'])
+    print("       rasters = %7.2f MB" % (sizes.get('rasters', 0)/MBYTE))
+    print("           pdf = %7.2f MB" % (sizes.get('pdf', 0)/MBYTE))
+    print("  jbig2 pages  = %7.2f MB" % (sizes.get('jbig2Pages', 0)/MBYTE))
+    print(" jbig2 symbols = %7.2f MB" % (sizes.get('jbig2Symbols', 0)/MBYTE))
+    print("       deduped = %7.2f MB" % (sizes.get('deduped', 0)/MBYTE))
+    if summary['ratio'] is not None:
+        print("         ratio = %7.3f" % summary['ratio'])
+    for stage in ('deskew', 'jbig2', 'pdf', 'linearize'):
+        dt = times.get(stage, 0.0)
+        print("%14s = %7.1f sec %5.1f%%" % (stage, dt, 100.0 * dt / total if total else 0.0))
+    print("         total = %7.1f sec" % total)
+    if summary['pagesPerSec'] is not None:
+        print("    throughput = %7.2f pages/sec %6.2f MB/sec" % (summary['pagesPerSec'],
+              summary['rasterMBPerSec']))
+    pcts = summary['bgdTimePercentiles']
+    if pcts[50] is not None:
+        print("  bgd per page = p50 %.3f p90 %.3f p99 %.3f sec" % (pcts[50], pcts[90], pcts[99]))
+    for codec, n in sorted(summary['codecs'].items()):
+        print("%14s = %5d pages" % (codec, n))
+    for kind, n in sorted(summary['bgdKinds'].items()):
+        print("%10s bgd = %5d pages" % (kind, n))
+    for dpi, n in sorted(summary['dpis'].items(), key=lambda kv: int(kv[0])):
+        print("%10s dpi = %5d pages" % (dpi, n))
+
+
+if __name__ == '__main__':
+    main()
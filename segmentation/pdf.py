@@ -24,6 +24,10 @@
   Typical usage:
     jbig2 -s -S -p pdf.output.reference/hobbes/doc-001.png
     python pdf.py output > a.pdf
+
+  or, from a single multipage JBIG2 file
+    jbig2 -s -S pdf.output.reference/hobbes/*.png > hobbes.jb2
+    python pdf.py hobbes.jb2 > a.pdf
 """
 
 import sys
@@ -32,7 +36,9 @@ import struct
 import glob
 import os
 import cv2
+import hashlib
 from pprint import PrettyPrinter
+from linearize import REF
 
 pprinter = PrettyPrinter(stream=sys.stderr)
 
@@ -48,23 +54,30 @@ def main():
         import msvcrt
         msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
 
-    if len(sys.argv) == 2:
-        sym = sys.argv[1] + '.sym'
-        pages = glob.glob(sys.argv[1] + '.[0-9]*')
-    elif len(sys.argv) == 1:
+    # -d keeps the background JPEG files for debugging.
+    keepJpeg = '-d' in sys.argv[1:]
+    argv = [a for a in sys.argv if a != '-d']
+
+    if len(argv) == 2 and isJbig2File(argv[1]):
+        jig2FileMain(argv[1], keepJpeg)
+        return
+    if len(argv) == 2:
+        sym = argv[1] + '.sym'
+        pages = glob.glob(argv[1] + '.[0-9]*')
+    elif len(argv) == 1:
         sym = 'symboltable'
         pages = glob.glob('page-*')
     else:
-        usage(sys.argv[0], "wrong number of args!")
+        usage(argv[0], "wrong number of args!")
 
-    print("** argv=%d %s" % (len(sys.argv), sys.argv[1:]), file=sys.stderr)
+    print("** argv=%d %s" % (len(argv), argv[1:]), file=sys.stderr)
     if not os.path.exists(sym):
-        usage(sys.argv[0], "symbol table %s not found!" % sym)
+        usage(argv[0], "symbol table %s not found!" % sym)
     elif len(pages) == 0:
-        usage(sys.argv[0], "no pages found!")
+        usage(argv[0], "no pages found!")
 
     pages = [p for p in pages if isOutput(p)]
-    jig2Main(sym, pages)
+    jig2Main(sym, pages, keepJpeg)
 
 
 OUTPUT = re.compile(r'\.\d+$')
@@ -74,41 +87,78 @@ def isOutput(p):
     return OUTPUT.search(p) is not None
 
 
-def jig2Main(symbolPath='symboltable', pagefiles=glob.glob('page-*')):
-    """Build a PDF from JBIG2 symbol table file `symbolPath` and page files `pagefiles`.
+def jig2Main(symbolPath='symboltable', pagefiles=glob.glob('page-*'), keepJpeg=False, out=None):
+    """Build a PDF from JBIG2 symbol table file `symbolPath` and page files `pagefiles` and write
+        it to binary file object `out` (stdout by default).
+        The JBIG2 files are not read into memory. Only the page headers are read and the files
+        are copied to `out` by the kernel as the PDF is written.
+        Backgrounds are JPEG encoded in memory. The JPEGs are also written next to the page files
+        if `keepJpeg` is True.
     """
     print("** symbolPath=%s" % symbolPath, file=sys.stderr)
     print("** pagefiles= %d: %s" % (len(pagefiles), pagefiles), file=sys.stderr)
 
-    doc = Doc()
-    pages = Obj({'Type': '/Pages'})
-    doc.add_object(pages)
-    catalog = Obj({'Type': '/Catalog',  'Pages': ref(pages.id)})
+    pagefiles.sort()
+    pages = [(FileStream(fn), readPageHeader(fn), fn) for fn in pagefiles]
+    writePdf(FileStream(symbolPath), pages, keepJpeg, out)
+
+
+def jig2FileMain(jbig2Path, keepJpeg=False, out=None):
+    """Build a PDF from multipage JBIG2 file `jbig2Path` and write it to binary file object `out`
+        (stdout by default).
+        The page boundaries are found by walking the segment headers, so jbig2 doesn't need to
+        write a file per page. Like jig2Main, the segment data is copied straight from
+        `jbig2Path` to `out`.
+        The background of page i is read from <jbig2Path without extension>.NNNN.png where NNNN
+        is i, as jbig2 names them.
+    """
+    print("** jbig2Path=%s" % jbig2Path, file=sys.stderr)
+    symbols, pageStreams = splitJbig2File(jbig2Path)
+    base, _ = os.path.splitext(jbig2Path)
+    pages = [(stream, header, '%s.%04d' % (base, i))
+             for i, (stream, header) in enumerate(pageStreams)]
+    writePdf(symbols, pages, keepJpeg, out)
+
+
+def writePdf(symbols, pages, keepJpeg=False, out=None):
+    """Write a PDF to binary file object `out` (stdout by default).
+        `symbols` is the JBIG2 global stream (the symbol dictionaries) shared by all pages.
+        `pages` is a list of (page stream, (width, height, xres, yres), page name) in page order.
+        Page i's background is read from <page name>.png and, if `keepJpeg` is True, its JPEG is
+        written to <page name>.jpg.
+    """
+    if out is None:
+        out = sys.stdout.buffer
+    doc = Doc(out)
+    pages_obj = Obj({'Type': '/Pages'})
+    # The page tree is only complete after the last page so it is written last.
+    doc.defer_object(pages_obj)
+    catalog = Obj({'Type': '/Catalog',  'Pages': ref(pages_obj.id)})
     doc.add_catalog(catalog)
-    symd = doc.add_object(Obj({}, readFile(symbolPath)))
+    symd = doc.add_object(Obj({}, symbols)) if len(symbols) else None
 
     page_objs = []
-    pagefiles.sort()
-    for i, pageFile in enumerate(pagefiles):
-        bgdFile = pageFile + '.png'
-        jpgFile = pageFile + '.jpg'
-        print("** page %d: %s" % (i, pageFile), file=sys.stderr)
+    for i, (fgdContents, header, pageName) in enumerate(pages):
+        bgdFile = pageName + '.png'
+        jpgFile = pageName + '.jpg'
+        print("** page %d: %s" % (i, pageName), file=sys.stderr)
         # assert os.path.exists(bgdFile), bgdFile
 
         if os.path.exists(bgdFile):
             bgd = cv2.imread(bgdFile)
             assert bgd is not None, bgdFile
-            cv2.imwrite(jpgFile, bgd, [cv2.IMWRITE_JPEG_QUALITY, 25])
-            bgdContents = readFile(jpgFile)
+            ok, buf = cv2.imencode('.jpg', bgd, [cv2.IMWRITE_JPEG_QUALITY, 25])
+            assert ok, bgdFile
+            bgdContents = buf.tobytes()
+            if keepJpeg:
+                with open(jpgFile, 'wb') as f:
+                    f.write(bgdContents)
             h, w = bgd.shape[:2]
             print('** bgd (width, height)', [w, h], file=sys.stderr)
         else:
             bgdContents = None
 
-        fgdContents = readFile(pageFile)
-
-        # Big endian. Network byte order
-        width, height, xres, yres = struct.unpack('>IIII', fgdContents[11:27])
+        width, height, xres, yres = header
 
         print('** fgd (width, height, xres, yres)', [width, height, xres, yres], file=sys.stderr)
 
@@ -123,32 +173,33 @@ def jig2Main(symbolPath='symboltable', pagefiles=glob.glob('page-*')):
                         'BitsPerComponent': '8',
                         'Filter': '/DCTDecode'},
                         bgdContents)
-            bgdDo = b'/Im%d Do' % bgdXobj.id
-            bgdRef = b'/Im%d %s' % (bgdXobj.id, ref(bgdXobj.id))
+            bgdDo = b'/ImBgd Do'
+            bgdRef = b'/ImBgd %s' % ref(bgdXobj.id)
         else:
             bgdXobj = None
             bgdDo = b''
             bgdRef = b''
 
-        fgdXobj = Obj({'Type': '/XObject', 'Subtype': '/Image',
-                    'Width': str(width),
-                    'Height': str(height),
-                    'ColorSpace': '/DeviceGray',
-                    'ImageMask': 'true',
-                    'BlackIs1': 'false',
-                    'BitsPerComponent': '1',
-                    'Filter': '/JBIG2Decode',
-                    'DecodeParms': b'<< /JBIG2Globals %s >>' % symd.ref()},
-                    fgdContents)
-        fgdDo = b'/Im%d Do' % fgdXobj.id
-        fgdRef = b'/Im%d %s' % (fgdXobj.id, fgdXobj.ref())
+        fgdDict = {'Type': '/XObject', 'Subtype': '/Image',
+                   'Width': str(width),
+                   'Height': str(height),
+                   'ColorSpace': '/DeviceGray',
+                   'ImageMask': 'true',
+                   'BlackIs1': 'false',
+                   'BitsPerComponent': '1',
+                   'Filter': '/JBIG2Decode'}
+        if symd is not None:
+            fgdDict['DecodeParms'] = b'<< /JBIG2Globals %s >>' % symd.ref()
+        fgdXobj = Obj(fgdDict, fgdContents)
+        fgdDo = b'/ImFgd Do'
+        fgdRef = b'/ImFgd %s' % fgdXobj.ref()
 
         # scale image to widthPts x heightPts points
         scale = b'%f 0 0 %f 0 0 cm' % (widthPts, heightPts)
 
         cmds = Obj({},  b'q %s %s %s Q' % (scale, bgdDo, fgdDo))
         resources = Obj({'XObject': b'<<%s%s>>' % (bgdRef, fgdRef)})
-        page = Obj({'Type': '/Page', 'Parent': pages.ref(),
+        page = Obj({'Type': '/Page', 'Parent': pages_obj.ref(),
                     'MediaBox': '[0 0 %f %f]' % (widthPts, heightPts),
                     'Contents': cmds.ref(),
                     'Resources': resources.ref()
@@ -156,10 +207,197 @@ def jig2Main(symbolPath='symboltable', pagefiles=glob.glob('page-*')):
         doc.add_objects([bgdXobj, fgdXobj, cmds, resources, page])
         page_objs.append(page)
 
-        pages.d.d[b'Count'] = b'%d' % len(page_objs)
-        pages.d.d[b'Kids'] = b'[%s]' % b' '.join(o.ref() for o in page_objs)
+    pages_obj.d.d[b'Count'] = b'%d' % len(page_objs)
+    pages_obj.d.d[b'Kids'] = b'[%s]' % b' '.join(o.ref() for o in page_objs)
+    doc.close()
+    print("** deduped %d objects %d bytes" % (doc.numDeduped, doc.dedupedSize), file=sys.stderr)
 
-    sys.stdout.buffer.write(bytes(doc))
+
+def readPageHeader(pageFile):
+    """Return width, height, xres, yres from the page information segment of JBIG2 page file
+        `pageFile`. Only the header is read.
+    """
+    with open(pageFile, 'rb') as f:
+        header = f.read(27)
+    # Big endian. Network byte order
+    return struct.unpack('>IIII', header[11:27])
+
+
+# A standalone JBIG2 file starts with this id string. See section D.4 of the JBIG2 spec.
+JBIG2_MAGIC = b'\x97JB2\r\n\x1a\n'
+
+
+def isJbig2File(path):
+    """Return True if `path` is a standalone JBIG2 file."""
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(JBIG2_MAGIC)) == JBIG2_MAGIC
+
+
+def splitJbig2File(path):
+    """Split standalone, sequentially organized, JBIG2 file `path` into the streams PDF embeds.
+        The segment headers are walked to find each segment's page. The segment data is not
+        read, except for the page information segments' sizes and resolutions.
+        Segments associated with no page (the symbol dictionaries) go in the global stream. Each
+        page's segments go in that page's stream with their page association changed to 1, as
+        PDF requires. End of page and end of file segments are dropped.
+        Returns: globals, pages
+            globals: SplicedStream of the global segments
+            pages: list of (SplicedStream, (width, height, xres, yres)) in page order
+    """
+    size = os.path.getsize(path)
+    globalParts = []
+    pageParts = {}
+    headers = {}
+    with open(path, 'rb') as f:
+        head = f.read(13)
+        assert head[:8] == JBIG2_MAGIC, path
+        flags = head[8]
+        assert flags & 1, "%s: random-access organisation is not supported" % path
+        # The number of pages is only present if it is known.
+        pos = 9 if flags & 2 else 13
+        while pos < size:
+            f.seek(pos)
+            raw, segType, page, pageOffset, length = readSegmentHeader(f)
+            assert length != 0xffffffff, "%s: segments of unknown length are not supported" % path
+            dataPos = pos + len(raw)
+            pos = dataPos + length
+            if segType in (49, 51):
+                continue
+            data = FileStream(path, dataPos, length)
+            if page == 0:
+                globalParts.extend([raw, data])
+                continue
+            # Point the segment at page 1, keeping the size of the field.
+            pageSize = len(raw) - 4 - pageOffset
+            raw = raw[:pageOffset] + (1).to_bytes(pageSize, 'big') + raw[pageOffset + pageSize:]
+            pageParts.setdefault(page, []).extend([raw, data])
+            if segType == 48:
+                f.seek(dataPos)
+                headers[page] = struct.unpack('>IIII', f.read(16))
+    pages = []
+    for page in sorted(pageParts):
+        assert page in headers, "%s: page %d has no page information segment" % (path, page)
+        pages.append((SplicedStream(pageParts[page]), headers[page]))
+    return SplicedStream(globalParts), pages
+
+
+def readSegmentHeader(f):
+    """Read the JBIG2 segment header at the current position of binary file object `f`.
+        See section 7.2 of the JBIG2 spec.
+        Returns: raw, segType, page, pageOffset, length
+            raw: the header bytes
+            segType: the segment type
+            page: the page association
+            pageOffset: the offset of the page association field in `raw`
+            length: the segment data length
+    """
+    raw = f.read(6)
+    number, flags, count = struct.unpack('>IBB', raw)
+    count >>= 5
+    if count == 7:
+        raw += f.read(3)
+        count = struct.unpack('>I', raw[5:9])[0] & 0x1fffffff
+        raw += f.read((count + 8) // 8)
+    refSize = 1 if number <= 256 else 2 if number <= 65536 else 4
+    raw += f.read(count * refSize)
+    pageOffset = len(raw)
+    if flags & 0x40:
+        raw += f.read(4)
+        page, = struct.unpack('>I', raw[pageOffset:])
+    else:
+        raw += f.read(1)
+        page = raw[pageOffset]
+    raw += f.read(4)
+    length, = struct.unpack('>I', raw[-4:])
+    return raw, flags & 0x3f, page, pageOffset, length
+
+
+class SplicedStream:
+  """The data of a stream made of `parts`, each bytes or a FileStream, in order."""
+  def __init__(self, parts):
+    self.parts = parts
+
+  def __len__(self):
+    return sum(len(p) for p in self.parts)
+
+  def digest(self):
+    h = hashlib.sha1()
+    for p in self.parts:
+      h.update(p.digest() if isinstance(p, FileStream) else p)
+    return h.digest()
+
+  def copy_to(self, f):
+    for p in self.parts:
+      if isinstance(p, FileStream):
+        p.copy_to(f)
+      else:
+        f.write(p)
+
+
+class FileStream:
+  """The data of a stream that is `length` bytes at `offset` in file `path`.
+      The data is never held in memory. It is copied from the file to the output when the PDF is
+      written.
+  """
+  def __init__(self, path, offset=0, length=None):
+    self.path = path
+    self.offset = offset
+    self.length = os.path.getsize(path) - offset if length is None else length
+
+  def __len__(self):
+    return self.length
+
+  def digest(self):
+    """Return the SHA1 of the data, read in blocks."""
+    h = hashlib.sha1()
+    with open(self.path, 'rb') as f:
+      f.seek(self.offset)
+      n = self.length
+      while n > 0:
+        block = f.read(min(n, 1 << 20))
+        assert block, (self.path, self.offset, self.length)
+        h.update(block)
+        n -= len(block)
+    return h.digest()
+
+  def copy_to(self, f):
+    """Copy the data to binary file object `f`."""
+    with open(self.path, 'rb') as src:
+      copyRange(src, f, self.offset, self.length)
+
+
+def copyRange(src, f, offset, length):
+    """Copy `length` bytes at `offset` in binary file object `src` to binary file object `f`.
+        os.sendfile copies in the kernel, without the data passing through user space. It works
+        for any output file descriptor on Linux, including pipes. Where it isn't available, or
+        `f` has no file descriptor, the data is copied in blocks.
+    """
+    done = 0
+    try:
+        outFd = f.fileno()
+    except (OSError, ValueError):
+        outFd = None
+    if outFd is not None and hasattr(os, 'sendfile'):
+        f.flush()
+        try:
+            while done < length:
+                n = os.sendfile(outFd, src.fileno(), offset + done, length - done)
+                if n == 0:
+                    break
+                done += n
+        except OSError:
+            if done:
+                raise
+    src.seek(offset + done)
+    while done < length:
+        block = src.read(min(length - done, 1 << 20))
+        if not block:
+            break
+        f.write(block)
+        done += len(block)
+    assert done == length, (src.name, offset, length, done)
 
 
 class Dict:
@@ -177,8 +415,16 @@ class Dict:
     s.append(b'>>\n')
     return b''.join(s)
 
+  def replace_refs(self, aliases):
+    """Replace references to the object numbers in `aliases` with references to their values."""
+    def replace(m):
+        return ref(aliases.get(int(m.group(1)), int(m.group(1))))
+    for k, v in self.d.items():
+        self.d[k] = REF.sub(replace, v)
+
 
 class Obj:
+  """A PDF object. Its `stream` is bytes, a FileStream or a SplicedStream."""
   next_id = 1
 
   def __init__(self, d = {}, stream = None):
@@ -191,6 +437,7 @@ class Obj:
     pprint(self.d.d)
 
   def __bytes__(self):
+    assert not isinstance(self.stream, (FileStream, SplicedStream)), self.id
     s = []
     s.append(bytes(self.d))
     if self.stream is not None:
@@ -200,15 +447,42 @@ class Obj:
     s.append(b'endobj')
     return b''.join(s)
 
+  def digest(self):
+    """Return the SHA1 of the serialized object."""
+    if isinstance(self.stream, (FileStream, SplicedStream)):
+      return hashlib.sha1(bytes(self.d) + self.stream.digest()).digest()
+    return hashlib.sha1(bytes(self)).digest()
+
   def ref(self):
       return ref(self.id)
 
 
 class Doc:
-  def __init__(self):
-    self.objs = []
+  """Doc writes a PDF to binary file object `f` as objects are added.
+      Each object is written as soon as it is added and dropped, so memory use doesn't grow with
+      the number of pages. Objects that can't be completed until the end of the document (e.g.
+      the page tree) are added with defer_object() and written by close().
+      An object that is byte for byte identical to one already added is dropped. Its number is
+      made an alias of the earlier object's and references to it in objects added later are
+      rewritten. Pages are never deduped as each must appear once in the page tree.
+  """
+  def __init__(self, f):
+    self.f = f
+    self.pos = 0
+    self.offsets = {}
+    self.deferred = []
     self.pages = []
     self.catalogId = -1
+    self.hashes = {}
+    self.aliases = {}
+    self.numDeduped = 0
+    self.dedupedSize = 0
+    self.write(b'%PDF-1.4')
+
+  def write(self, x):
+    self.f.write(x)
+    self.f.write(b'\n')
+    self.pos += len(x) + 1
 
   def add_objects(self, objs):
     for o in objs:
@@ -216,7 +490,34 @@ class Doc:
             self.add_object(o)
 
   def add_object(self, o):
-    self.objs.append(o)
+    if self.aliases:
+        o.d.replace_refs(self.aliases)
+    if o.d.d.get(b'Type') != b'/Page':
+        key = o.digest()
+        if key in self.hashes:
+            self.aliases[o.id] = self.hashes[key]
+            self.numDeduped += 1
+            self.dedupedSize += len(bytes(o.d)) + (len(o.stream) if o.stream is not None else 0)
+            return o
+        self.hashes[key] = o.id
+    self.write_object(o)
+    return o
+
+  def write_object(self, o):
+    """Write `o` at the current position. File stream data is copied straight from its file."""
+    self.offsets[o.id] = self.pos
+    self.write(b'%d 0 obj' % o.id)
+    if isinstance(o.stream, (FileStream, SplicedStream)):
+      head = bytes(o.d) + b'stream\n'
+      self.f.write(head)
+      o.stream.copy_to(self.f)
+      self.pos += len(head) + len(o.stream)
+      self.write(b'\nendstream\nendobj')
+    else:
+      self.write(bytes(o))
+
+  def defer_object(self, o):
+    self.deferred.append(o)
     return o
 
   def add_catalog(self, o):
@@ -227,36 +528,33 @@ class Doc:
     self.pages.append(o)
     return self.add_object(o)
 
-  pos = 0
+  def close(self):
+    """Write the deferred objects, xref and trailer."""
+    for o in self.deferred:
+      self.add_object(o)
+    self.deferred = []
 
-  def __bytes__(self):
+    xrefstart = self.pos
+    # Deduped objects leave gaps in the object numbers. They are marked free.
+    size = max(self.offsets) + 1
     a = []
-    Doc.pos = 0
-    offsets = []
-
-    def add(x):
-        a.append(x)
-        Doc.pos += len(x) + 1
-
-    add(b'%PDF-1.4')
-    for o in self.objs:
-      offsets.append(Doc.pos)
-      add(b'%d 0 obj' % o.id)
-      add(bytes(o))
-    xrefstart = Doc.pos
     a.append(b'xref')
-    a.append(b'0 %d' % (len(offsets) + 1))
+    a.append(b'0 %d' % size)
     a.append(b'0000000000 65535 f ')
-    for o in offsets:
-        a.append(b'%010d 00000 n ' % o)
+    for i in range(1, size):
+        if i in self.offsets:
+            a.append(b'%010d 00000 n ' % self.offsets[i])
+        else:
+            a.append(b'0000000000 65535 f ')
     a.append(b'')
     a.append(b'trailer')
-    a.append(b'<</Size %d\n/Root %s>>' % (len(offsets) + 1, ref(self.catalogId)))
+    a.append(b'<</Size %d\n/Root %s>>' % (size, ref(self.aliases.get(self.catalogId,
+                                                                       self.catalogId))))
     a.append(b'startxref')
-    a.append(bytes(xrefstart))
+    a.append(b'%d' % xrefstart)
     a.append(b'%%EOF')
-
-    return b'\n'.join(a)
+    self.f.write(b'\n'.join(a))
+    self.f.flush()
 
 
 def ref(x):
@@ -266,7 +564,7 @@ def ref(x):
 def usage(script, msg):
     if msg:
         sys.stderr.write("%s: %s\n" % (script, msg))
-        sys.stderr.write("Usage: %s [file_basename] > out.pdf\n" % script)
+        sys.stderr.write("Usage: %s [-d] [file_basename | file.jb2] > out.pdf\n" % script)
     sys.exit(1)
 
 
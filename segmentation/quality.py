@@ -0,0 +1,208 @@
+"""
+   Rate-distortion measurements for the segmented PDFs created by segment.go.
+
+   Each variant (masked, png, jpg, bgd) of a PDF is rasterized with Ghostscript and compared to
+   the source rasters listed in the segment.go JSON file that it was built from.
+   Renders and measurements are cached in a <base>.render.<dpi>/<variant>/ directory next to the
+   PDF and are reused until the PDF or its source rasters change.
+
+   Used by compression.py -q
+"""
+import os
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+import subprocess
+import json
+import math
+import cv2
+import numpy as np
+from compare import suffixes, suffixMasked
+
+
+# DPI used for the rasters being tested
+rasterDPI = 300
+
+# segment.go places each page image centered on a US letter page, scaled to fit.
+pageWidthPt = 8.5 * 72.0
+pageHeightPt = 11.0 * 72.0
+
+# PSNR of identical images.
+maxPsnr = 100.0
+
+renderFormat = "doc-%03d.png"
+stampName = "render.json"
+
+
+def measureTable(table, dpi=rasterDPI, numWorkers=1, force=False):
+    """Measure the quality of all variants of the PDFs in `table`, a dict whose keys are masked
+        PDF paths, as in compression.py.
+        Returns: {masked PDF path: {suffix: measurement dict returned by measureVariant()}}
+    """
+    jobs = [(fn, suffix) for fn in table for suffix in suffixes]
+    pdfPaths = [otherPdf(fn, suffix) for fn, suffix in jobs]
+    n = len(jobs)
+    with ProcessPoolExecutor(max_workers=max(1, numWorkers)) as executor:
+        results = executor.map(measureVariant, pdfPaths, [sourceRasters(fn) for fn, _ in jobs],
+                               [renderDir(fn, suffix, dpi) for fn, suffix in jobs],
+                               [dpi] * n, [force] * n)
+        quality = {}
+        for (fn, suffix), q in zip(jobs, results):
+            quality.setdefault(fn, {})[suffix] = q
+    return quality
+
+
+def otherPdf(filename, suffix):
+    base = filename[:-len(suffixMasked)]
+    return base + suffix
+
+
+def renderDir(filename, suffix, dpi):
+    """Return the directory that renders of the `suffix` variant of masked PDF `filename` are
+        cached in.
+    """
+    base = filename[:-len(suffixMasked)]
+    return "%srender.%d" % (base, dpi) + os.sep + suffix[:-len(".pdf")]
+
+
+def sourceRasters(filename):
+    """Return the source rasters of masked PDF `filename` in page order. They are the keys of
+        the segment.go JSON file it was built from. segment.go sorts them.
+    """
+    jsonPath = filename[:-len(suffixMasked)] + "json"
+    with open(jsonPath) as f:
+        pageRects = json.load(f)
+    return sorted(pageRects)
+
+
+def measureVariant(pdfPath, sources, outDir, dpi, force):
+    """Rasterize `pdfPath` at `dpi` into `outDir` and compare each page to the corresponding
+        raster in `sources`.
+        Returns: {'size', 'psnr', 'ssim', 'pages': [{'psnr', 'ssim'}]} where psnr and ssim are
+            the means over the pages.
+    """
+    key = {
+        'pdf': fileKey(pdfPath),
+        'sources': [fileKey(fn) for fn in sources],
+        'dpi': dpi,
+    }
+    stampPath = os.path.join(outDir, stampName)
+    stamp = {}
+    if not force and os.path.exists(stampPath):
+        with open(stampPath) as f:
+            stamp = json.load(f)
+        if stamp.get('pdf') != key['pdf'] or stamp.get('dpi') != dpi:
+            stamp = {}
+    if stamp.get('quality') and stamp.get('sources') == key['sources']:
+        return stamp['quality']
+
+    if not stamp:
+        renderPdf(pdfPath, outDir, dpi)
+    renders = sorted(glob(os.path.join(outDir, "doc-*.png")))
+    assert len(renders) == len(sources), "%s: %d pages rendered, %d source rasters" % (
+        pdfPath, len(renders), len(sources))
+
+    pages = [comparePage(rfn, sfn, dpi) for rfn, sfn in zip(renders, sources)]
+    quality = {
+        'size': os.path.getsize(pdfPath),
+        'psnr': float(np.mean([pg['psnr'] for pg in pages])) if pages else maxPsnr,
+        'ssim': float(np.mean([pg['ssim'] for pg in pages])) if pages else 1.0,
+        'pages': pages,
+    }
+    key['quality'] = quality
+    tmpPath = stampPath + ".tmp"
+    with open(tmpPath, 'w') as f:
+        json.dump(key, f, indent=1)
+    os.replace(tmpPath, stampPath)
+    return quality
+
+
+def fileKey(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def renderPdf(pdf, outDir, dpi):
+    """Rasterize `pdf` at `dpi` to one png file per page in directory `outDir`, replacing any
+        previous renders.
+    """
+    os.makedirs(outDir, exist_ok=True)
+    for fn in glob(os.path.join(outDir, "doc-*.png")) + glob(os.path.join(outDir, stampName)):
+        os.remove(fn)
+    cmd = ["gs",
+           "-q",
+           "-dSAFER",
+           "-dBATCH",
+           "-dNOPAUSE",
+           "-r%d" % dpi,
+           "-sDEVICE=png16m",
+           "-dTextAlphaBits=1",
+           "-dGraphicsAlphaBits=1",
+           "-sOutputFile=%s" % os.path.join(outDir, renderFormat),
+           pdf]
+    retval = subprocess.call(cmd, shell=False)
+    assert retval == 0, "%s failed: %d" % (' '.join(cmd), retval)
+
+
+def comparePage(renderPath, sourcePath, dpi):
+    """Compare the page rendered in `renderPath` to the source raster `sourcePath`.
+        The part of the render the source raster was placed on is scaled back to the source raster
+        size before comparison.
+    """
+    src = cv2.imread(sourcePath, cv2.IMREAD_COLOR)
+    rnd = cv2.imread(renderPath, cv2.IMREAD_COLOR)
+    assert src is not None, sourcePath
+    assert rnd is not None, renderPath
+    h, w = src.shape[:2]
+    x0, y0, x1, y1 = placement(w, h, dpi, rnd.shape[1], rnd.shape[0])
+    rnd = rnd[y0:y1, x0:x1]
+    if rnd.shape[:2] != (h, w):
+        interp = cv2.INTER_AREA if rnd.shape[0] > h else cv2.INTER_CUBIC
+        rnd = cv2.resize(rnd, (w, h), interpolation=interp)
+    return {'psnr': psnr(src, rnd), 'ssim': ssim(cv2.cvtColor(src, cv2.COLOR_BGR2GRAY),
+                                                 cv2.cvtColor(rnd, cv2.COLOR_BGR2GRAY))}
+
+
+def placement(w, h, dpi, renderW, renderH):
+    """Return the rectangle x0, y0, x1, y1 in a `dpi` render of size `renderW` x `renderH` that
+        segment.go's computeScale() places a `w` x `h` image in.
+    """
+    scale = min(pageWidthPt / w, pageHeightPt / h)
+    xOfs = 0.5 * (pageWidthPt - scale * w)
+    yOfs = 0.5 * (pageHeightPt - scale * h)
+    k = dpi / 72.0
+    x0, y0 = int(round(xOfs * k)), int(round(yOfs * k))
+    x1 = min(renderW, int(round((xOfs + scale * w) * k)))
+    y1 = min(renderH, int(round((yOfs + scale * h) * k)))
+    return x0, y0, x1, y1
+
+
+def psnr(a, b):
+    """Return the peak signal to noise ratio in dB of 8 bit image `b` relative to `a`."""
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return maxPsnr
+    return min(maxPsnr, 10.0 * math.log10(255.0 ** 2 / mse))
+
+
+def ssim(a, b):
+    """Return the mean structural similarity of 8 bit gray images `a` and `b`, using the usual
+        11 x 11 Gaussian window with sigma 1.5.
+    """
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+
+    def blur(x):
+        return cv2.GaussianBlur(x, (11, 11), 1.5)
+
+    muA = blur(a)
+    muB = blur(b)
+    muAA = muA * muA
+    muBB = muB * muB
+    muAB = muA * muB
+    varA = blur(a * a) - muAA
+    varB = blur(b * b) - muBB
+    covAB = blur(a * b) - muAB
+    ssimMap = ((2 * muAB + c1) * (2 * covAB + c2)) / ((muAA + muBB + c1) * (varA + varB + c2))
+    return float(ssimMap.mean())
@@ -10,8 +10,13 @@ from glob import glob
 import argparse
 import cv2
 import json
+import math
+from time import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pprint
 from deoverlap import reduceRectDicts
+from introspect import pageCount
 
 
 # All files are saved in outPdfRoot.
@@ -20,6 +25,40 @@ outPdfRoot = os.path.abspath("pdf.rasterized")
 # DPI used for the rasters being tested
 rasterDPI = 300
 
+# How rasters are stored.
+#   device: Ghostscript output device
+#   ext: file extension of the stored rasters
+#   pngLevel: zlib level for PNGs that are encoded from the Ghostscript output by OpenCV
+RasterFormat = namedtuple('RasterFormat', ['name', 'device', 'ext', 'pngLevel'])
+
+rasterFormats = {
+    # Ghostscript's own PNG encoder. The default.
+    'png': RasterFormat('png', 'png16m', 'png', None),
+    # Uncompressed. Fastest to write and read but about 25 MB per 300 dpi letter page.
+    'ppm': RasterFormat('ppm', 'ppmraw', 'ppm', None),
+    'pgm': RasterFormat('pgm', 'pgmraw', 'pgm', None),
+    # NumPy arrays of the OpenCV (BGR) image that loadRaster() memory maps.
+    'npy': RasterFormat('npy', 'ppmraw', 'npy', None),
+}
+
+# File extensions of the Ghostscript output devices.
+deviceExt = {'png16m': 'png', 'ppmraw': 'ppm', 'pgmraw': 'pgm'}
+
+# Records in a document's output directory whether all its pages have been rasterized.
+doneName = "rasterized.json"
+
+
+def rasterFormat(name):
+    """Return the RasterFormat called `name`. "png:N" is a PNG encoded with zlib level N."""
+    if name.startswith("png:"):
+        level = int(name[4:])
+        assert 0 <= level <= 9, name
+        return RasterFormat(name, 'ppmraw', 'png', level)
+    assert name in rasterFormats, "Unknown raster format %r. Use one of %s or png:N" % (
+        name, sorted(rasterFormats))
+    return rasterFormats[name]
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--start", default=-1, type=int,
@@ -34,6 +73,20 @@ def main():
                         help="input files; glob and @ expansion performed")
     parser.add_argument("-o", "--force", action="store_true",
                         help="force processing of PDF file")
+    parser.add_argument("-w", "--workers", default=os.cpu_count(), type=int,
+                        help="max number of Ghostscript processes running at once, across all "
+                             "PDF files")
+    parser.add_argument("-k", "--shard", default=20, type=int,
+                        help="rasterize PDF files in page ranges of about this many pages, each "
+                             "in its own Ghostscript process. 0 for one process per PDF file")
+    parser.add_argument("-t", "--threads", default=1, type=int,
+                        help="Ghostscript -dNumRenderingThreads for each process")
+    parser.add_argument("-f", "--format", default="png",
+                        help="raster file format: png, png:N (PNG with zlib level N, e.g. png:1 "
+                             "for fast deflate), ppm, pgm or npy")
+    parser.add_argument("-b", "--benchmark", action="store_true",
+                        help="report the render + store and load times of each raster format "
+                             "for the input files instead of rasterizing them")
 
     args = parser.parse_args()
     os.makedirs(outPdfRoot, exist_ok=True)
@@ -47,20 +100,128 @@ def main():
     for i, fn in enumerate(pdfFiles):
         print("%3d: %4.2f MB %s" % (i, os.path.getsize(fn)/1e6, fn))
 
-    processedFiles = []
+    if args.benchmark:
+        benchmark(pdfFiles, args.workers, args.shard, args.threads)
+        return
+
+    fmt = rasterFormat(args.format)
+    processedFiles = processPdfFiles(pdfFiles, args.needed, args.force, args.workers, args.shard,
+                                     args.threads, fmt)
+    print("=" * 80)
+    print("Processed %d files %s" % (len(processedFiles), processedFiles))
+
+
+def processPdfFiles(pdfFiles, needed, force, numWorkers, shardPages, numThreads,
+                    fmt=rasterFormats['png']):
+    """Rasterize `pdfFiles` to `fmt` rasters with at most `numWorkers` Ghostscript processes
+        running at once. See rasterizeFiles().
+        Returns: the PDF files that were rasterized, in the order of `pdfFiles`
+    """
+    assert needed >= 0, needed
+    todo = []
     for i, inFile in enumerate(pdfFiles):
         print("*" * 80)
         print("** %3d: %s" % (i, inFile))
-        if not processPdfFile(inFile, args.start, args.end, args.needed, args.force):
+        outRoot = outputRoot(inFile, force, fmt)
+        if outRoot:
+            todo.append((inFile, outRoot))
+
+    failed = rasterizeFiles(todo, numWorkers, shardPages, numThreads, fmt)
+
+    processedFiles = []
+    for i, (inFile, outRoot) in enumerate(todo):
+        if inFile in failed:
+            print("runGhostscript failed outRoot=%s. skipping" % outRoot)
             continue
+        listRasters(outRoot, fmt)
+        markDone(inFile, outRoot, fmt)
         processedFiles.append(inFile)
-        print("Processed %d (%d of %d): %s" % (len(processedFiles), i + 1, len(pdfFiles), inFile))
+        print("Processed %d (%d of %d): %s" % (len(processedFiles), i + 1, len(todo), inFile))
+    return processedFiles
+
+
+def rasterizeFiles(todo, numWorkers, shardPages, numThreads, fmt):
+    """Rasterize the PDF files in `todo`, a list of (PDF file, output directory), to `fmt`
+        rasters with at most `numWorkers` Ghostscript processes running at once.
+        Each PDF file is split into page ranges of about `shardPages` pages that are rasterized
+        by separate processes. The page counts are probed first so that the ranges of a
+        document are the same size and the longest ranges, across all documents, start first.
+        Returns: the set of PDF files that failed
+    """
+    with ThreadPoolExecutor(max_workers=max(1, numWorkers)) as executor:
+        pageCounts = list(executor.map(countPages, [inFile for inFile, _ in todo]))
+        shards = []
+        for (inFile, outRoot), numPages in zip(todo, pageCounts):
+            print("%s: %s pages" % (inFile, numPages))
+            for first, last in pageRanges(numPages, shardPages):
+                shards.append((inFile, outRoot, first, last))
+        # Longest first, so the short ranges fill in at the end.
+        shards.sort(key=lambda sh: -(sh[3] - sh[2] + 1) if sh[2] else -math.inf)
+
+        futures = {executor.submit(runGhostscript, inFile, outRoot, 1, first, last, numThreads,
+                                   fmt): inFile for inFile, outRoot, first, last in shards}
+        failed = set()
+        for future in as_completed(futures):
+            if future.result() != 0:
+                failed.add(futures[future])
+    return failed
+
+
+def benchmark(pdfFiles, numWorkers, shardPages, numThreads):
+    """Rasterize `pdfFiles` to each raster format and print the times to render and store the
+        rasters, the times to load them and their sizes.
+    """
+    names = ['png', 'png:1', 'png:6', 'ppm', 'pgm', 'npy']
+    results = []
+    for name in names:
+        fmt = rasterFormat(name)
+        benchRoot = os.path.join(outPdfRoot, "benchmark", name.replace(":", ""))
+        todo = []
+        for inFile in pdfFiles:
+            baseBase, _ = os.path.splitext(os.path.basename(inFile))
+            outRoot = os.path.join(benchRoot, baseBase)
+            shutil.rmtree(outRoot, ignore_errors=True)
+            os.makedirs(outRoot)
+            todo.append((inFile, outRoot))
+
+        t0 = time()
+        failed = rasterizeFiles(todo, numWorkers, shardPages, numThreads, fmt)
+        dtRender = time() - t0
+        assert not failed, "%s: %s failed" % (name, sorted(failed))
+
+        rasters = []
+        for _, outRoot in todo:
+            rasters.extend(sorted(glob(os.path.join(outRoot, "doc-*.%s" % fmt.ext))))
+        t0 = time()
+        for fn in rasters:
+            # Touch every pixel so that memory mapped rasters are actually read.
+            loadRaster(fn).max()
+        dtLoad = time() - t0
+        size = sum(os.path.getsize(fn) for fn in rasters)
+        results.append((name, len(rasters), dtRender, dtLoad, size))
+
     print("=" * 80)
-    print("Processed %d files %s" % (len(processedFiles), processedFiles))
+    print("%-8s %6s %9s %9s %9s %10s" % ("format", "pages", "render", "load", "total", "size"))
+    for name, numPages, dtRender, dtLoad, size in results:
+        print("%-8s %6d %7.2f s %7.2f s %7.2f s %7.1f MB" % (name, numPages, dtRender, dtLoad,
+              dtRender + dtLoad, size / 1e6))
 
 
-def processPdfFile(pdfFile, start, end, needed, force):
-    assert needed >= 0, needed
+def loadRaster(path):
+    """Return the raster in `path` as an OpenCV image. .npy rasters are memory mapped.
+        Reads any of the formats in rasterFormats.
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode='r')
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    assert img is not None, path
+    return img
+
+
+def outputRoot(pdfFile, force, fmt=rasterFormats['png']):
+    """Return the directory to rasterize `pdfFile` into, or None if it has already been
+        rasterized and `force` is False.
+    """
     baseName = os.path.basename(pdfFile)
     baseBase, _ = os.path.splitext(baseName)
     outPdfFile = os.path.join(outPdfRoot, baseName)
@@ -69,53 +230,113 @@ def processPdfFile(pdfFile, start, end, needed, force):
 
     if not force and os.path.exists(outJsonFile):
         print("%s exists. skipping" % outPdfFile)
-        return False
+        return None
 
-    page1 = os.path.join(outRoot, "doc-001.png")
-    if not force and os.path.exists(page1):
+    donePath = os.path.join(outRoot, doneName)
+    page1 = os.path.join(outRoot, gsImageFormat(fmt) % 1)
+    if not force and os.path.exists(donePath):
+        with open(donePath) as f:
+            done = json.load(f)
+        if done.get('format') == fmt.name and done.get('numPages') is not None:
+            print("%s exists. skipping" % donePath)
+            return None
+    elif not force and fmt.name == 'png' and os.path.exists(page1):
+        # Rasterized before the record was written, when page 1 was taken to mean the document
+        # was done.
         print("%s exists. skipping" % page1)
-        return False
+        return None
 
     os.makedirs(outRoot, exist_ok=True)
-    retval = runGhostscript(pdfFile, outRoot, resample=1)
-    if retval != 0:
-        print("runGhostscript failed outRoot=%s retval=%d. skipping" % (outPdfFile, retval))
-        return False
-    assert retval == 0
+    markDone(pdfFile, outRoot, fmt, finished=False)
+    return outRoot
+
+
+def markDone(pdfFile, outRoot, fmt, finished=True):
+    """Record in `outRoot` whether all pages of `pdfFile` have been rasterized to `fmt` rasters.
+        outputRoot() records an unfinished render before any pages are written and skips
+        documents whose record is finished, so a sharded run that was interrupted after
+        rendering only some pages is rasterized again.
+    """
+    rasters = glob(os.path.join(outRoot, "doc-*.%s" % fmt.ext))
+    done = {'pdf': pdfFile, 'format': fmt.name, 'numPages': len(rasters) if finished else None}
+    donePath = os.path.join(outRoot, doneName)
+    tmpPath = donePath + ".tmp"
+    with open(tmpPath, 'w') as f:
+        json.dump(done, f, indent=1)
+    os.replace(tmpPath, donePath)
 
-    searchMask = os.path.join(outRoot, "doc-*.png")
+
+def pageRanges(numPages, shardPages):
+    """Return [(first page, last page)] ranges of about `shardPages` pages that cover `numPages`
+        pages. [(None, None)], the whole document, if `numPages` is unknown or `shardPages` is 0.
+    """
+    if not numPages or shardPages <= 0:
+        return [(None, None)]
+    numShards = math.ceil(numPages / shardPages)
+    size = math.ceil(numPages / numShards)
+    return [(first, min(numPages, first + size - 1)) for first in range(1, numPages + 1, size)]
+
+
+def countPages(pdf):
+    """Return the number of pages in `pdf`, or None if it can't tell.
+        The page tree is read with introspect.py rather than Ghostscript, which would need its
+        SAFER sandbox turned off to open the file from PostScript.
+    """
+    try:
+        return int(pageCount(pdf))
+    except Exception as e:
+        print("countPages: can't count pages in %s: %r" % (pdf, e))
+        return None
+
+
+def listRasters(outRoot, fmt=rasterFormats['png']):
+    searchMask = os.path.join(outRoot, "doc-*.%s" % fmt.ext)
     print("searchMask=%s" % searchMask)
     fileList = glob(searchMask)
     fileList = [fn for fn in fileList if ".denoised.png" not in fn]
 
     print("fileList=%d %s" % (len(fileList), fileList))
-    return True
 
 
-gsImageFormat = "doc-%03d.png"
+def gsImageFormat(fmt):
+    return "doc-%%03d.%s" % fmt.ext
 
 
-def runGhostscript(pdf, outputDir, resample=1):
-    """runGhostscript runs Ghostscript on file `pdf` to create file one png file per page in
-        directory `outputDir`.
+def runGhostscript(pdf, outputDir, resample=1, firstPage=None, lastPage=None, numThreads=1,
+                   fmt=rasterFormats['png']):
+    """runGhostscript runs Ghostscript on file `pdf` to create file one `fmt` raster file per page
+        in directory `outputDir`.
+        If `firstPage` is given, only pages `firstPage` .. `lastPage` are rasterized. They are
+        rendered into a subdirectory, as Ghostscript numbers its output from 1, and then moved
+        into `outputDir` under their page numbers in the document.
     """
-    print("runGhostscript: pdf=%s outputDir=%s" % (pdf, outputDir))
-    outputPath = os.path.join(outputDir, gsImageFormat)
+    print("runGhostscript: pdf=%s outputDir=%s pages=%s-%s" % (pdf, outputDir, firstPage,
+          lastPage))
+    renderDir = outputDir
+    pageArgs = []
+    if firstPage is not None:
+        renderDir = os.path.join(outputDir, "shard.%03d" % firstPage)
+        pageArgs = ["-dFirstPage=%d" % firstPage, "-dLastPage=%d" % lastPage]
+    if numThreads > 1:
+        pageArgs.append("-dNumRenderingThreads=%d" % numThreads)
+    gsFormat = "doc-%%03d.%s" % deviceExt[fmt.device]
+    outputPath = os.path.join(renderDir, gsFormat)
     output = "-sOutputFile=%s" % outputPath
     cmd = ["gs",
            "-dSAFER",
            "-dBATCH",
            "-dNOPAUSE",
            "-r%d" % (rasterDPI * resample),
-           "-sDEVICE=png16m",
+           "-sDEVICE=%s" % fmt.device,
            "-dTextAlphaBits=1",
            "-dGraphicsAlphaBits=1",
+           *pageArgs,
            output,
            pdf]
 
     print("runGhostscript: cmd=%s" % cmd)
     print("%s" % ' '.join(cmd))
-    os.makedirs(outputDir, exist_ok=True)
+    os.makedirs(renderDir, exist_ok=True)
     p = subprocess.Popen(cmd, shell=False)
 
     retval = p.wait()
@@ -125,9 +346,42 @@ def runGhostscript(pdf, outputDir, resample=1):
     print("outputPath=%s" % outputPath)
     assert os.path.exists(outputDir)
 
+    if retval == 0:
+        convertRasters(renderDir, gsFormat, fmt)
+
+    if firstPage is not None:
+        imageFormat = gsImageFormat(fmt)
+        for i in range(lastPage - firstPage + 1):
+            src = os.path.join(renderDir, imageFormat % (i + 1))
+            if os.path.exists(src):
+                os.replace(src, os.path.join(outputDir, imageFormat % (firstPage + i)))
+        shutil.rmtree(renderDir, ignore_errors=True)
+
     return retval
 
 
+def convertRasters(renderDir, gsFormat, fmt):
+    """Convert the Ghostscript output files in `renderDir` that are named with pattern `gsFormat`
+        to `fmt` rasters, if it is a format that Ghostscript doesn't write.
+    """
+    imageFormat = gsImageFormat(fmt)
+    if gsFormat == imageFormat:
+        return
+    i = 1
+    while True:
+        src = os.path.join(renderDir, gsFormat % i)
+        if not os.path.exists(src):
+            break
+        dst = os.path.join(renderDir, imageFormat % i)
+        img = cv2.imread(src, cv2.IMREAD_UNCHANGED)
+        if fmt.ext == "npy":
+            np.save(dst, img)
+        else:
+            cv2.imwrite(dst, img, [cv2.IMWRITE_PNG_COMPRESSION, fmt.pngLevel])
+        os.remove(src)
+        i += 1
+
+
 def derived(filename):
     """Return True if `filename` is one of the PDF files we create.
     """
@@ -135,4 +389,5 @@ def derived(filename):
     return name.count(".") > 1
 
 
-main()
+if __name__ == '__main__':
+    main()
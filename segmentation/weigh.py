@@ -6,18 +6,14 @@
    e.g. python weigh.py pdf.output.ccitt pdf.output
 """
 import os
-from glob import glob
 import argparse
 import time
 import sys
+from compare import scanSizes, suffixMasked
 
 
 # All files are saved in outPdfRoot.
 outPdfRoot = "pdf.output"
-suffixMasked = "masked.pdf"
-suffixPng = "unmasked.png.pdf"
-suffixJpg = "unmasked.jpg.pdf"
-suffixBgd = "bgd.pdf"
 
 usage = """Usage: python weigh.py <test directory> <reference directory>
     Compare size of *.masked.pdf files in <test directory> to those in <reference directory>
@@ -35,20 +31,16 @@ def main():
         return os.path.dirname(os.path.join(fn, "xxx"))
 
     def matchFiles(outPdfRoot):
-        mask = os.path.join(outPdfRoot, "*.%s" % suffixMasked)
-        pdfFiles = glob(mask)
-        pdfFiles = [fn for fn in pdfFiles if segmentedPdf(fn)]
-        return pdfFiles
+        # {base name: sizes} from a single scan of `outPdfRoot`.
+        table = scanSizes(outPdfRoot)
+        return {"%s.%s" % (base, suffixMasked): sizes for base, sizes in table.items()}
 
     def baseFiles(pdfFiles):
-        return {os.path.basename(fn) for fn in pdfFiles}
-
-    def joinFiles(dirName, baseNames):
-        return [os.path.join(dirName, name) for name in baseNames]
+        return set(pdfFiles)
 
     def sortKey(fn):
-        szTest = fileSizeMB(os.path.join(rootTest, fn))
-        szRef = fileSizeMB(os.path.join(rootRef, fn))
+        szTest = filesTest[fn][suffixMasked]
+        szRef = filesRef[fn][suffixMasked]
         return -szTest / szRef, -szTest
 
     rootTest = directorize(rootTest)
@@ -57,17 +49,14 @@ def main():
     filesRef = matchFiles(rootRef)
     filesCommon = sorted(baseFiles(filesTest) & baseFiles(filesRef), key=sortKey)
 
-    filesTest = joinFiles(rootTest, filesCommon)
-    filesRef = joinFiles(rootRef, filesCommon)
-
     totalSizeTest = 0.0
     totalSizeRef = 0.0
     numContracted = 0
     numExpanded = 0
     lines = []
     for i, fn in enumerate(filesCommon):
-        sizeTest = fileSizeMB(os.path.join(rootTest, fn))
-        sizeRef = fileSizeMB(os.path.join(rootRef, fn))
+        sizeTest = filesTest[fn][suffixMasked]
+        sizeRef = filesRef[fn][suffixMasked]
         ratio = sizeTest / sizeRef
         totalSizeTest += sizeTest
         totalSizeRef += sizeRef
@@ -94,23 +83,5 @@ def main():
         print(l)
 
 
-def segmentedPdf(filename):
-    """Return True is `filename` is a segmented PDF created by segment.go."""
-    pngPdf = otherPdf(filename, suffixPng)
-    jpgPdf = otherPdf(filename, suffixJpg)
-    bgdPdf = otherPdf(filename, suffixBgd)
-    return os.path.exists(pngPdf) and os.path.exists(jpgPdf) and os.path.exists(bgdPdf)
-
-
-def otherPdf(filename, suffix):
-    if not suffix:
-        return filename
-    base = filename[:-len(suffixMasked)]
-    return base + suffix
-
-
-def fileSizeMB(filename):
-    return os.path.getsize(filename) / 1e6
-
 
 main()